@@ -0,0 +1,200 @@
+"""
+Irrigation alert engine
+- Listens to the forecast cache: every fetched or refreshed forecast is
+  evaluated once for all subscribers of its grid cell; only confirmed
+  subscriptions are alerted
+- Advice changes are collected per recipient and sent as one email, through
+  the shared email queue (durable outbox + pooled SMTP workers)
+- Each recipient gets at most one alert per min_interval; changes that arrive
+  in between are merged into the next alert, changes that flip back are dropped
+- Every alert links to the unsubscribe endpoint of each subscription it reports
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from subscriptions import Subscription, SubscriptionRegistry
+from weather_cache import CacheEntry
+from weather_report import soil_moisture_level
+
+logger = logging.getLogger(__name__)
+
+# notify(recipient, subject, body, idempotency_key)
+Notifier = Callable[[str, str, str, str], Awaitable[object]]
+
+
+def unsubscribe_url(base_url: str, subscription: Subscription) -> str:
+    return f"{base_url}/api/subscriptions/{subscription.id}/unsubscribe?token={subscription.unsubscribe_token}"
+
+
+def alert_email(changes: Dict[str, tuple], base_url: str = "") -> tuple:
+    """Subject and plain-text body for one recipient's advice changes"""
+    lines = []
+    for subscription, needs_water, level, version in changes.values():
+        advice = "Give water" if needs_water else "Watering not needed now"
+        comparison = "<=" if needs_water else ">"
+        lines.append(
+            f"- {subscription.label}: {advice} "
+            f"(soil moisture {level:.3f} {comparison} threshold {subscription.threshold:.3f})\n"
+            f"  Unsubscribe: {unsubscribe_url(base_url, subscription)}"
+        )
+    if len(changes) == 1:
+        subject = f"TropoMetrics irrigation alert: {advice} at {subscription.label}"
+    else:
+        subject = f"TropoMetrics irrigation alert: {len(changes)} locations changed"
+    body = (
+        "The irrigation advice changed for your subscribed location(s):\n\n"
+        + "\n".join(lines)
+        + "\n\nTropoMetrics"
+    )
+    return subject, body
+
+
+class AlertEngine:
+    """Evaluates subscriptions on forecast updates and sends rate-limited alerts"""
+
+    def __init__(self, registry: SubscriptionRegistry, notify: Notifier, base_url: str = "",
+                 min_interval: float = 3600, flush_seconds: float = 5, batch_size: int = 200):
+        self.registry = registry
+        self.notify = notify
+        # Public address of the API, start of the unsubscribe links
+        self.base_url = base_url
+        self.min_interval = min_interval
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        # recipient -> subscription id -> (subscription, needs_water, level, forecast version)
+        self._pending: Dict[str, Dict[str, tuple]] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.evaluations = 0
+        self.changes = 0
+        self.cancelled = 0
+        self.sent = 0
+        self.errors = 0
+
+    def on_forecast(self, key: Hashable, entry: CacheEntry):
+        """Cache listener - cheap, runs inline after every forecast fetch"""
+        group = self.registry.group(key)
+        if group is None:
+            return
+        try:
+            level = soil_moisture_level(entry.value)
+        except (KeyError, IndexError, TypeError):
+            return
+        if level is None:
+            return
+        self.evaluations += 1
+        # Unconfirmed subscriptions keep the baseline but get no alerts (double opt-in)
+        flips = [(subscription, needs_water) for subscription, needs_water in group.update(level)
+                 if subscription.confirmed]
+        for subscription, needs_water in flips:
+            self._record(subscription, needs_water, level, entry.version)
+        if flips:
+            self.changes += len(flips)
+            self._wakeup.set()
+
+    def _record(self, subscription: Subscription, needs_water: bool, level: float, version: str):
+        pending = self._pending.setdefault(subscription.recipient, {})
+        previous = pending.pop(subscription.id, None)
+        if previous is not None and previous[1] != needs_water:
+            # Flipped back before the recipient was told - nothing to report
+            self.cancelled += 1
+            if not pending:
+                del self._pending[subscription.recipient]
+            return
+        pending[subscription.id] = (subscription, needs_water, level, version)
+
+    def forget(self, subscription: Subscription):
+        """Drop undelivered changes of a deleted or unsubscribed subscription"""
+        pending = self._pending.get(subscription.recipient)
+        if pending is not None:
+            pending.pop(subscription.id, None)
+            if not pending:
+                del self._pending[subscription.recipient]
+
+    async def _send(self, recipient: str, changes: Dict[str, tuple]) -> bool:
+        subject, body = alert_email(changes, self.base_url)
+        # Same changes -> same key, so a retried flush never queues a second email
+        fingerprint = ",".join(
+            f"{sid}:{int(needs_water)}:{version}"
+            for sid, (_, needs_water, _, version) in sorted(changes.items())
+        )
+        key = "alert:" + hashlib.blake2b(f"{recipient}|{fingerprint}".encode(), digest_size=12).hexdigest()
+        try:
+            await self.notify(recipient, subject, body, key)
+        except Exception as e:
+            logger.error(f"Alert for {recipient} not queued: {str(e)}")
+            self.errors += 1
+            return False
+        return True
+
+    async def flush(self, now: Optional[float] = None) -> int:
+        """Queue one email per recipient whose rate limit allows it, returns the number queued"""
+        now = time.time() if now is None else now
+        # Rate-limit state is only needed while the interval runs
+        self._last_sent = {r: t for r, t in self._last_sent.items() if now - t < self.min_interval}
+        due = [
+            recipient for recipient in self._pending
+            if now - self._last_sent.get(recipient, 0) >= self.min_interval
+        ]
+        queued = 0
+        for start in range(0, len(due), self.batch_size):
+            chunk = [(recipient, self._pending.pop(recipient)) for recipient in due[start:start + self.batch_size]]
+            results = await asyncio.gather(*[self._send(recipient, changes) for recipient, changes in chunk])
+            for (recipient, changes), ok in zip(chunk, results):
+                if ok:
+                    self._last_sent[recipient] = now
+                    queued += 1
+                else:
+                    # Keep for the next flush, merged with anything that arrived meanwhile
+                    self._pending[recipient] = {**changes, **self._pending.get(recipient, {})}
+        self.sent += queued
+        if queued:
+            logger.info(f"Queued {queued} irrigation alert(s), {len(self._pending)} recipient(s) waiting")
+        return queued
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            # Let the rest of a refresh round land so each recipient gets one email
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Alert flush failed: {str(e)}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        """Stop the loop, queueing whatever is due so it lands in the outbox"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            **self.registry.stats(),
+            "evaluations": self.evaluations,
+            "changes": self.changes,
+            "cancelled": self.cancelled,
+            "alerts_queued": self.sent,
+            "errors": self.errors,
+            "waiting_recipients": len(self._pending),
+        }
@@ -0,0 +1,474 @@
+"""
+API key store (SQLite, WAL mode)
+- Only SHA-256 hashes of keys are stored; a key is shown once, when it is created
+- Lookups go through an in-memory LRU with a short TTL, so the request path
+  is a dict hit and management changes apply within the TTL without a redeploy
+- Each key has a plan: rate limit, allowed response formats and allowed
+  locations (field ids or "lat,lon"); a key can narrow the plan's locations
+- Usage is counted in memory per (key, day, endpoint) and flushed in batches;
+  billing exports read the database from a separate process
+- Admin keys may use operational features such as request profiling
+- RemoteApiKeyStore: the same cache and counters on the scaled API replicas, with
+  lookups and usage flushes going to the state service that owns the database
+
+Management (same database file, while the API is running):
+    python api_keys.py create --name "Farm 1" --plan free [--locations "field-1;52.01,4.36"] [--admin]
+    python api_keys.py list | revoke <id> | set-plan <id> <plan> | set-admin <id> on|off
+    python api_keys.py plan <name> [--rate 600/minute] [--formats json,html] [--locations ...]
+    python api_keys.py plans | export --since 2026-10-01 [--until 2026-10-31] > usage.csv
+"""
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import logging
+import os
+import secrets
+import sqlite3
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import httpx
+
+from locations import snap_location
+from rate_limit import parse_rate
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAN = "free"
+# Header with the token shared by the state service and the API replicas
+STATE_TOKEN_HEADER = "X-State-Token"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    name TEXT PRIMARY KEY,
+    rate TEXT,
+    formats TEXT,
+    locations TEXT
+);
+CREATE TABLE IF NOT EXISTS api_keys (
+    id TEXT PRIMARY KEY,
+    key_hash TEXT NOT NULL UNIQUE,
+    prefix TEXT NOT NULL,
+    name TEXT NOT NULL,
+    plan TEXT NOT NULL REFERENCES plans (name),
+    locations TEXT,
+    admin INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    revoked_at REAL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    key_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    PRIMARY KEY (key_id, day, endpoint)
+) WITHOUT ROWID;
+"""
+
+_LOOKUP = """
+SELECT k.id, k.name, k.plan, p.rate, p.formats, COALESCE(k.locations, p.locations), k.admin
+FROM api_keys k JOIN plans p ON p.name = k.plan
+WHERE k.key_hash = ? AND k.revoked_at IS NULL
+"""
+
+
+def hash_key(api_key: str) -> str:
+    # Keys are long random tokens, a fast hash is enough
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def _split(value: Optional[str], separator: str) -> Optional[List[str]]:
+    if value is None:
+        return None
+    return [part.strip() for part in value.split(separator) if part.strip()]
+
+
+@dataclass(frozen=True)
+class ApiKey:
+    """A valid key with its plan resolved"""
+    id: str
+    name: str
+    plan: str
+    rate: Optional[str] = None                        # None: the service default
+    formats: Optional[FrozenSet[str]] = None          # None: every format
+    location_ids: Optional[FrozenSet[str]] = None     # None: every location
+    cells: Tuple[dict, ...] = ()
+    admin: bool = False
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "ApiKey":
+        key_id, name, plan, rate, formats, locations, admin = row
+        formats = _split(formats, ",")
+        entries = _split(locations, ";")
+        cells = tuple(
+            {"latitude": float(lat), "longitude": float(lon)}
+            for lat, lon in (entry.split(",") for entry in entries or () if "," in entry)
+        )
+        return cls(
+            key_id, name, plan, rate,
+            frozenset(formats) if formats is not None else None,
+            frozenset(e for e in entries if "," not in e) if entries is not None else None,
+            cells,
+            bool(admin),
+        )
+
+    def allows_format(self, output_format: str) -> bool:
+        return self.formats is None or output_format in self.formats
+
+    def allows_location(self, location: dict, resolution: float) -> bool:
+        """Field id listed, or the location falls in the grid cell of a listed coordinate"""
+        if self.location_ids is None:
+            return True
+        if location.get("id") in self.location_ids:
+            return True
+        cell = snap_location(location, resolution)
+        return any(snap_location(allowed, resolution) == cell for allowed in self.cells)
+
+
+class ApiKeyStore:
+    """Hashed API keys and plans with a cached lookup and batched usage counters"""
+
+    def __init__(self, path: str, cache_size: int = 10000, cache_ttl: float = 60,
+                 flush_interval: float = 10, seed_keys: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.flush_interval = flush_interval
+        # Fixed keys (raw key -> name) created on the default plan when missing
+        self.seed_keys = seed_keys or {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._db: Optional[sqlite3.Connection] = None
+        # key hash -> (expires at, key or None for unknown/revoked keys)
+        self._cache: "OrderedDict[str, Tuple[float, Optional[ApiKey]]]" = OrderedDict()
+        # (key id, day, endpoint) -> requests not yet on disk
+        self._usage: Dict[Tuple[str, str, str], int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # The management commands write to the same file
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(_SCHEMA)
+        # Databases created before admin keys existed
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(api_keys)")}
+        if "admin" not in columns:
+            self._db.execute("ALTER TABLE api_keys ADD COLUMN admin INTEGER NOT NULL DEFAULT 0")
+        self._db.execute("INSERT OR IGNORE INTO plans (name) VALUES (?)", (DEFAULT_PLAN,))
+        for api_key, name in self.seed_keys.items():
+            self._insert(api_key, name, DEFAULT_PLAN, None, ignore=True)
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-keys")
+        await self._run(self._open)
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        """Stop the flush loop and write the remaining usage"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._cache.clear()
+
+    # Request path
+
+    def _select(self, digest: str) -> Optional[tuple]:
+        return self._db.execute(_LOOKUP, (digest,)).fetchone()
+
+    async def lookup_row(self, digest: str) -> Optional[tuple]:
+        """Uncached lookup row of a key hash (see ApiKey.from_row), None when unknown or revoked"""
+        return await self._run(self._select, digest)
+
+    async def _fetch(self, digest: str) -> Optional[ApiKey]:
+        row = await self.lookup_row(digest)
+        return ApiKey.from_row(row) if row else None
+
+    async def lookup(self, api_key: str) -> Optional[ApiKey]:
+        """The key with its plan, None when unknown or revoked"""
+        digest = hash_key(api_key)
+        now = time.monotonic()
+        cached = self._cache.get(digest)
+        if cached is not None and cached[0] > now:
+            self._cache.move_to_end(digest)
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        try:
+            key = await self._fetch(digest)
+        except Exception as e:
+            if cached is None:
+                raise
+            # Keep answering with the expired entry until the source is back
+            logger.warning(f"API key lookup failed, using the cached entry: {str(e)}")
+            key = cached[1]
+        self._cache[digest] = (now + self.cache_ttl, key)
+        self._cache.move_to_end(digest)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return key
+
+    def record(self, key: ApiKey, endpoint: str):
+        """Count one request - in memory only, written by the next flush"""
+        counter = (key.id, time.strftime("%Y-%m-%d", time.gmtime()), endpoint)
+        self._usage[counter] = self._usage.get(counter, 0) + 1
+
+    def merge_usage(self, rows: list):
+        """Add counters flushed by an API replica, rows of (key id, day, endpoint, requests)"""
+        for key_id, day, endpoint, count in rows:
+            counter = (key_id, day, endpoint)
+            self._usage[counter] = self._usage.get(counter, 0) + int(count)
+
+    # Usage flushing
+
+    def _write_usage(self, rows: list):
+        self._db.execute("BEGIN")
+        try:
+            self._db.executemany(
+                "INSERT INTO usage (key_id, day, endpoint, requests) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key_id, day, endpoint) DO UPDATE SET requests = requests + excluded.requests",
+                rows
+            )
+            self._db.execute("COMMIT")
+        except Exception:
+            self._db.execute("ROLLBACK")
+            raise
+
+    async def _store_usage(self, rows: list):
+        await self._run(self._write_usage, rows)
+
+    async def flush(self) -> int:
+        """Write the collected counters in one transaction, returns the number of rows"""
+        if not self._usage:
+            return 0
+        usage, self._usage = self._usage, {}
+        try:
+            await self._store_usage([(*counter, count) for counter, count in usage.items()])
+        except Exception as e:
+            # Keep the counts for the next flush
+            for counter, count in usage.items():
+                self._usage[counter] = self._usage.get(counter, 0) + count
+            logger.error(f"Usage flush failed: {str(e)}")
+            return 0
+        self.flushed += len(usage)
+        return len(usage)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # Management - synchronous, used by the commands below on their own connection
+
+    def _insert(self, api_key: str, name: str, plan: str, locations: Optional[str], ignore: bool = False,
+                admin: bool = False) -> str:
+        key_id = uuid.uuid4().hex[:12]
+        self._db.execute(
+            f"INSERT {'OR IGNORE ' if ignore else ''}INTO api_keys "
+            "(id, key_hash, prefix, name, plan, locations, admin, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key_id, hash_key(api_key), api_key[:6], name, plan, locations, int(admin), time.time())
+        )
+        return key_id
+
+    def create(self, name: str, plan: str = DEFAULT_PLAN, locations: Optional[str] = None,
+               admin: bool = False) -> Tuple[str, str]:
+        """New key on plan, returns (id, key) - the key itself is not stored"""
+        if not self._db.execute("SELECT 1 FROM plans WHERE name = ?", (plan,)).fetchone():
+            raise ValueError(f"Unknown plan '{plan}'")
+        api_key = "tm_" + secrets.token_urlsafe(24)
+        return self._insert(api_key, name, plan, locations, admin=admin), api_key
+
+    def revoke(self, key_id: str) -> bool:
+        cursor = self._db.execute(
+            "UPDATE api_keys SET revoked_at = ? WHERE id = ? AND revoked_at IS NULL", (time.time(), key_id)
+        )
+        return cursor.rowcount > 0
+
+    def set_plan(self, key_id: str, plan: str) -> bool:
+        if not self._db.execute("SELECT 1 FROM plans WHERE name = ?", (plan,)).fetchone():
+            raise ValueError(f"Unknown plan '{plan}'")
+        return self._db.execute("UPDATE api_keys SET plan = ? WHERE id = ?", (plan, key_id)).rowcount > 0
+
+    def set_admin(self, key_id: str, admin: bool) -> bool:
+        return self._db.execute("UPDATE api_keys SET admin = ? WHERE id = ?", (int(admin), key_id)).rowcount > 0
+
+    def define_plan(self, name: str, rate: Optional[str] = None, formats: Optional[str] = None,
+                    locations: Optional[str] = None):
+        """Create or replace a plan, raises ValueError for an invalid rate"""
+        if rate is not None:
+            parse_rate(rate)
+        self._db.execute(
+            "INSERT INTO plans (name, rate, formats, locations) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET rate = excluded.rate, formats = excluded.formats, "
+            "locations = excluded.locations",
+            (name, rate, formats, locations)
+        )
+
+    def keys(self) -> list:
+        return self._db.execute(
+            "SELECT id, prefix, name, plan, locations, admin, created_at, revoked_at FROM api_keys "
+            "ORDER BY created_at"
+        ).fetchall()
+
+    def plans(self) -> list:
+        return self._db.execute("SELECT name, rate, formats, locations FROM plans ORDER BY name").fetchall()
+
+    def export_usage(self, since: str, until: str) -> list:
+        """Usage rows per key, day and endpoint for days in [since, until]"""
+        return self._db.execute(
+            "SELECT u.key_id, k.name, k.plan, u.day, u.endpoint, u.requests "
+            "FROM usage u LEFT JOIN api_keys k ON k.id = u.key_id "
+            "WHERE u.day BETWEEN ? AND ? ORDER BY u.day, u.key_id, u.endpoint",
+            (since, until)
+        ).fetchall()
+
+    def stats(self) -> dict:
+        return {
+            "cached_keys": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "usage_pending": len(self._usage),
+            "usage_rows_flushed": self.flushed,
+        }
+
+
+class RemoteApiKeyStore(ApiKeyStore):
+    """Key lookups and usage counters of an API replica, backed by the state service
+
+    The state service owns the database and serves /internal/api-keys; requests carry
+    the shared token in STATE_TOKEN_HEADER. Management commands run on the state service.
+    """
+
+    def __init__(self, base_url: str, token: str, cache_size: int = 10000, cache_ttl: float = 60,
+                 flush_interval: float = 10, timeout: float = 5):
+        super().__init__("", cache_size=cache_size, cache_ttl=cache_ttl, flush_interval=flush_interval)
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def open(self):
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url, timeout=self.timeout, headers={STATE_TOKEN_HEADER: self.token}
+        )
+        self._task = asyncio.ensure_future(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self.flush()
+            await self._client.aclose()
+            self._client = None
+        self._cache.clear()
+
+    async def _fetch(self, digest: str) -> Optional[ApiKey]:
+        response = await self._client.get(f"/internal/api-keys/{digest}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return ApiKey.from_row(tuple(response.json()["row"]))
+
+    async def _store_usage(self, rows: list):
+        response = await self._client.post("/internal/api-keys/usage", json={"rows": rows})
+        response.raise_for_status()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Manage TropoMetrics API keys")
+    parser.add_argument("--db", default=os.getenv("API_KEYS_PATH", "api_keys.db"), help="key database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="create a key (printed once)")
+    create.add_argument("--name", required=True)
+    create.add_argument("--plan", default=DEFAULT_PLAN)
+    create.add_argument("--locations", help='field ids / "lat,lon", separated by ";"')
+    create.add_argument("--admin", action="store_true", help="allow operational features (profiling)")
+    commands.add_parser("list", help="list keys")
+    revoke = commands.add_parser("revoke", help="revoke a key")
+    revoke.add_argument("id")
+    set_plan = commands.add_parser("set-plan", help="move a key to another plan")
+    set_plan.add_argument("id")
+    set_plan.add_argument("plan")
+    set_admin = commands.add_parser("set-admin", help="grant or withdraw admin rights")
+    set_admin.add_argument("id")
+    set_admin.add_argument("state", choices=("on", "off"))
+    plan = commands.add_parser("plan", help="create or update a plan")
+    plan.add_argument("name")
+    plan.add_argument("--rate", help="e.g. 600/minute (default: API_KEY_RATE_LIMIT)")
+    plan.add_argument("--formats", help="e.g. json,html (default: all)")
+    plan.add_argument("--locations", help='field ids / "lat,lon", separated by ";" (default: all)')
+    commands.add_parser("plans", help="list plans")
+    export = commands.add_parser("export", help="usage per key, day and endpoint as CSV")
+    export.add_argument("--since", required=True, help="YYYY-MM-DD")
+    export.add_argument("--until", default="9999-12-31", help="YYYY-MM-DD (inclusive)")
+    args = parser.parse_args(argv)
+
+    store = ApiKeyStore(args.db)
+    store._open()
+    try:
+        if args.command == "create":
+            key_id, api_key = store.create(args.name, args.plan, args.locations, args.admin)
+            print(f"id:  {key_id}\nkey: {api_key}\nStore the key now, it cannot be shown again.")
+        elif args.command == "list":
+            for key_id, prefix, name, plan_name, locations, admin, created_at, revoked_at in store.keys():
+                state = "revoked" if revoked_at else "admin" if admin else "active"
+                print(f"{key_id}  {prefix}…  {plan_name:<10} {state:<8} {name}  {locations or ''}")
+        elif args.command == "revoke":
+            if not store.revoke(args.id):
+                print(f"No active key {args.id}", file=sys.stderr)
+                return 1
+        elif args.command == "set-plan":
+            if not store.set_plan(args.id, args.plan):
+                print(f"No key {args.id}", file=sys.stderr)
+                return 1
+        elif args.command == "set-admin":
+            if not store.set_admin(args.id, args.state == "on"):
+                print(f"No key {args.id}", file=sys.stderr)
+                return 1
+        elif args.command == "plan":
+            store.define_plan(args.name, args.rate, args.formats, args.locations)
+        elif args.command == "plans":
+            for name, rate, formats, locations in store.plans():
+                print(f"{name:<10} rate={rate or 'default'} formats={formats or 'all'} locations={locations or 'all'}")
+        elif args.command == "export":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(["key_id", "name", "plan", "day", "endpoint", "requests"])
+            writer.writerows(store.export_usage(args.since, args.until))
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    finally:
+        store._db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+"""
+Incremental change detection between successive forecasts
+- Keeps a compact snapshot (hourly arrays and the advice level) of the last
+  forecast versions per cache key
+- /api/changes?since=<version> diffs successive snapshots with the caller's
+  options: hourly cells that moved by more than a tolerance within the
+  requested days, deltas of the requested window aggregations and
+  irrigation advice flips
+- Bounded by keys and by the bytes of the retained arrays, least recently
+  updated keys go first
+"""
+
+import logging
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from resample import resample_hourly, window_start
+from weather_cache import CacheEntry
+from weather_report import irrigation_section, soil_moisture_level
+
+logger = logging.getLogger(__name__)
+
+# Smallest hourly change that counts, per variable (units as served by Open-Meteo)
+HOURLY_TOLERANCES = {
+    "precipitation": 0.05,
+    "rain": 0.05,
+    "relative_humidity_2m": 1.0,
+    "temperature_2m": 0.1,
+    "wind_speed_10m": 0.5,
+    "soil_moisture_0_to_1cm": 0.001,
+    "soil_moisture_27_to_81cm": 0.001,
+}
+# Smallest change of a window's precipitation sum (mm) that counts; other
+# aggregations use the tolerance of their hourly variable
+BUCKET_TOLERANCE = 0.1
+# Bookkeeping per snapshot on top of its arrays, for the byte budget
+_SNAPSHOT_OVERHEAD = 512
+
+
+def _value(x: float) -> Optional[float]:
+    return None if x != x else x
+
+
+def diff_hourly(previous: dict, current: dict, tolerances: Dict[str, float],
+                start: Optional[datetime] = None, hours: Optional[int] = None) -> Dict[str, list]:
+    """
+    Hourly cells (matched by timestamp) whose value changed by more than the tolerance,
+    limited to hours from start when given
+    """
+    previous_times = np.asarray(previous["time"], dtype="datetime64[h]")
+    current_times = np.asarray(current["time"], dtype="datetime64[h]")
+    times, previous_index, current_index = np.intersect1d(
+        previous_times, current_times, assume_unique=True, return_indices=True
+    )
+    if start is not None:
+        first = np.datetime64(start, "h")
+        within = times >= first
+        if hours is not None:
+            within &= times < first + np.timedelta64(hours, "h")
+        times, previous_index, current_index = times[within], previous_index[within], current_index[within]
+    labels = np.datetime_as_string(times, unit="m")
+    changes = {}
+    for variable, values in current.items():
+        if variable == "time" or variable not in previous:
+            continue
+        old = np.array(previous[variable], dtype=float)[previous_index]
+        new = np.array(values, dtype=float)[current_index]
+        with np.errstate(invalid="ignore"):
+            changed = np.abs(new - old) > tolerances.get(variable, 0)
+        # A value appearing or disappearing (null upstream) is a change too
+        changed |= np.isnan(old) != np.isnan(new)
+        cells = np.flatnonzero(changed)
+        if cells.size:
+            changes[variable] = [
+                {"time": time, "previous": _value(a), "current": _value(b)}
+                for time, a, b in zip(labels[cells].tolist(), old[cells].tolist(), new[cells].tolist())
+            ]
+    return changes
+
+
+def diff_periods(previous: List[dict], current: List[dict], name: str, tolerance: float) -> List[dict]:
+    """Windows (matched by start) whose aggregated value changed by more than the tolerance"""
+    before = {period["start"]: period.get(name) for period in previous}
+    changes = []
+    for period in current:
+        old, new = before.get(period["start"]), period.get(name)
+        if old is None and new is None:
+            continue
+        if old is None or new is None or abs(new - old) > tolerance:
+            changes.append({
+                "start": period["start"],
+                "period_hours": period["period_hours"],
+                "previous": old,
+                "current": new,
+                "delta": round(new - old, 2) if old is not None and new is not None else None,
+            })
+    return changes
+
+
+@dataclass
+class ChangeSet:
+    """Differences between two successive forecast versions"""
+    version: str
+    previous_version: str
+    detected_at: str
+    hourly: Dict[str, list] = field(default_factory=dict)
+    periods: Dict[str, list] = field(default_factory=dict)
+    advice: Optional[dict] = None
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.hourly and not self.periods and self.advice is None
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "previous_version": self.previous_version,
+            "detected_at": self.detected_at,
+            "advice": self.advice,
+            "periods": self.periods,
+            "hourly": self.hourly,
+        }
+
+
+@dataclass
+class _Snapshot:
+    """What one forecast version is diffed on - its hourly arrays, not the whole response"""
+    version: str
+    detected_at: str
+    utc_offset: int
+    hourly: Dict[str, np.ndarray]
+    level: Optional[float]
+
+    @property
+    def nbytes(self) -> int:
+        return _SNAPSHOT_OVERHEAD + sum(values.nbytes for values in self.hourly.values())
+
+
+def take_snapshot(entry: CacheEntry) -> _Snapshot:
+    """Snapshot of a cached forecast, raises KeyError/TypeError/ValueError on malformed data"""
+    hourly = {"time": np.asarray(entry.value["hourly"]["time"], dtype="datetime64[h]")}
+    for variable, values in entry.value["hourly"].items():
+        if variable != "time":
+            hourly[variable] = np.array(values, dtype=float)
+    level = soil_moisture_level(entry.value)
+    return _Snapshot(
+        version=entry.version,
+        detected_at=datetime.utcnow().isoformat() + "Z",
+        utc_offset=entry.value.get("utc_offset_seconds", 0),
+        hourly=hourly,
+        level=None if level is None else float(level),
+    )
+
+
+def diff_advice(previous: _Snapshot, current: _Snapshot) -> Optional[dict]:
+    """Irrigation advice before and after, None when it did not flip"""
+    if previous.level is None or current.level is None:
+        return None
+    before, after = irrigation_section(previous.level), irrigation_section(current.level)
+    if before["needs_water"] == after["needs_water"]:
+        return None
+    return {
+        "previous": {"needs_water": before["needs_water"], "advice": before["advice_english"],
+                     "level": before["current_level"]},
+        "current": {"needs_water": after["needs_water"], "advice": after["advice_english"],
+                    "level": after["current_level"]},
+    }
+
+
+class ChangeTracker:
+    """Cache listener that keeps recent forecast versions per key and diffs them on request"""
+
+    def __init__(self, history: int = 24, max_keys: int = 500, max_bytes: int = 16 * 2**20,
+                 tolerances: Dict[str, float] = HOURLY_TOLERANCES, bucket_tolerance: float = BUCKET_TOLERANCE):
+        # Change sets per key, i.e. history + 1 snapshots
+        self.history = history
+        self.max_keys = max_keys
+        self.max_bytes = max_bytes
+        self.tolerances = tolerances
+        self.bucket_tolerance = bucket_tolerance
+        self._tracks: "OrderedDict[Hashable, Deque[_Snapshot]]" = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+        self.diffs = 0
+        self.meaningful = 0
+
+    def on_forecast(self, key: Hashable, entry: CacheEntry):
+        """Record entry for key as its newest version"""
+        snapshots = self._tracks.get(key)
+        if snapshots is not None:
+            self._tracks.move_to_end(key)
+            if snapshots[-1].version == entry.version:
+                return
+        try:
+            current = take_snapshot(entry)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logger.warning(f"Change tracking skipped: {str(e)}")
+            return
+        if snapshots is None:
+            snapshots = self._tracks[key] = deque()
+        else:
+            previous = snapshots[-1]
+            self.diffs += 1
+            if diff_advice(previous, current) or diff_hourly(previous.hourly, current.hourly, self.tolerances):
+                self.meaningful += 1
+        snapshots.append(current)
+        self.bytes += current.nbytes
+        while len(snapshots) > self.history + 1:
+            self.bytes -= snapshots.popleft().nbytes
+        self._evict()
+
+    def _evict(self):
+        # Least recently updated keys go first; the newest one always stays
+        while len(self._tracks) > 1 and (len(self._tracks) > self.max_keys or self.bytes > self.max_bytes):
+            _, snapshots = self._tracks.popitem(last=False)
+            self.bytes -= sum(snapshot.nbytes for snapshot in snapshots)
+            self.evicted += 1
+
+    def current_version(self, key: Hashable) -> Optional[str]:
+        snapshots = self._tracks.get(key)
+        return snapshots[-1].version if snapshots else None
+
+    def changes_since(self, key: Hashable, since: Optional[str], window_hours: int, days: int,
+                      aggregations: Sequence[Tuple[str, str]],
+                      now: Optional[datetime] = None) -> Optional[Tuple[str, List[ChangeSet]]]:
+        """
+        (current version, meaningful change sets after since) for key, diffed with
+        the caller's window, days and aggregations as /api would serve them.
+        Without since all retained change sets are returned. None when since
+        is unknown or older than the retained history.
+        """
+        snapshots = self._tracks.get(key)
+        if snapshots is None:
+            return None
+        versions = [snapshot.version for snapshot in snapshots]
+        if since is None:
+            first = 0
+        elif since in versions:
+            first = versions.index(since)
+        else:
+            return None
+        compared = list(snapshots)[first:]
+        current = compared[-1]
+        # Windows follow the location's local clock, the same start for every version
+        start = window_start((now or datetime.utcnow()) + timedelta(seconds=current.utc_offset), window_hours)
+        hours = days * 24
+        periods = [resample_hourly(snapshot.hourly, aggregations, start, window_hours, hours)
+                   for snapshot in compared]
+        changes = []
+        for i in range(1, len(compared)):
+            before, after = compared[i - 1], compared[i]
+            change = ChangeSet(
+                version=after.version,
+                previous_version=before.version,
+                detected_at=after.detected_at,
+                hourly=diff_hourly(before.hourly, after.hourly, self.tolerances, start, hours),
+                advice=diff_advice(before, after),
+            )
+            for variable, how in aggregations:
+                name = f"{variable}_{how}"
+                tolerance = (self.bucket_tolerance if (variable, how) == ("precipitation", "sum")
+                             else self.tolerances.get(variable, 0))
+                deltas = diff_periods(periods[i - 1], periods[i], name, tolerance)
+                if deltas:
+                    change.periods[name] = deltas
+            if not change.is_empty:
+                changes.append(change)
+        return current.version, changes
+
+    def stats(self) -> dict:
+        return {
+            "tracked_keys": len(self._tracks),
+            "bytes": self.bytes,
+            "evicted_keys": self.evicted,
+            "diffs": self.diffs,
+            "meaningful_diffs": self.meaningful,
+        }
@@ -0,0 +1,375 @@
+"""
+Durable email outbox (SQLite, WAL mode)
+- Every accepted email is committed before the API answers 202
+- Writes are group-committed: submissions and status updates that arrive
+  together share one transaction, keeping fsyncs low at high submission rates
+- Idempotency keys are scoped per client and make resubmissions return the
+  original message; reusing a key for a different email is refused
+- Failed deliveries are retried with exponential backoff; messages that were
+  being sent when the process died are picked up again on the next start
+- Sent and failed messages are swept after the retention period; message
+  counts per status are kept in memory for /metrics
+All SQLite access runs on one dedicated thread, never on the event loop.
+"""
+
+import asyncio
+import hashlib
+import logging
+import random
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+from email_queue import EmailJob, IdempotencyConflictError
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id TEXT PRIMARY KEY,
+    client TEXT NOT NULL DEFAULT '',
+    idempotency_key TEXT NOT NULL,
+    payload_hash TEXT,
+    recipient TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    html INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL,
+    UNIQUE (client, idempotency_key)
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_done ON outbox (status, created_at);
+"""
+
+# Outboxes from before per-client keys had a table-wide UNIQUE on
+# idempotency_key, which SQLite can only drop by rebuilding the table
+_MIGRATE_CLIENT_SCOPE = """
+BEGIN;
+ALTER TABLE outbox RENAME TO outbox_unscoped;
+DROP INDEX IF EXISTS outbox_due;
+""" + _SCHEMA + """
+INSERT INTO outbox (id, idempotency_key, recipient, subject, body, html, status, attempts,
+                    next_attempt_at, error, created_at, sent_at)
+SELECT id, idempotency_key, recipient, subject, body, html, status, attempts,
+       next_attempt_at, error, created_at, sent_at FROM outbox_unscoped;
+DROP TABLE outbox_unscoped;
+COMMIT;
+"""
+
+STATUSES = ("queued", "sending", "sent", "failed")
+# Rows deleted per statement by the retention sweep, so commits can run in between
+_SWEEP_CHUNK = 5000
+
+_COLUMNS = "id, recipient, subject, body, html, status, attempts, error, created_at, sent_at"
+
+
+def _row_to_job(row) -> EmailJob:
+    job_id, recipient, subject, body, html, status, attempts, error, created_at, sent_at = row
+    return EmailJob(
+        to=recipient, subject=subject, body=body, html=bool(html), id=job_id,
+        status=status, attempts=attempts, error=error, created_at=created_at, sent_at=sent_at
+    )
+
+
+def payload_hash(job: EmailJob) -> str:
+    """Fingerprint of what an idempotency key was first used for"""
+    content = "\0".join((job.to, job.subject, job.body, str(int(job.html))))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class EmailOutbox:
+    """SQLite-backed outbox with group commits"""
+
+    def __init__(self, path: str, batch_size: int = 200, commit_interval: float = 0.02,
+                 max_attempts: int = 5, backoff_base: float = 5, backoff_max: float = 600,
+                 retention: float = 7 * 86400, sweep_interval: float = 3600):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Sent and failed messages older than this are deleted (0 keeps them forever)
+        self.retention = retention
+        self.sweep_interval = sweep_interval
+        # Set whenever new deliverable work was committed
+        self.has_work = asyncio.Event()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._inserts: List[Tuple[EmailJob, str, str, asyncio.Future]] = []
+        self._updates: List[tuple] = []
+        self._wakeup = asyncio.Event()
+        self._committer: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Future] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        # Messages per status, counted once on open and then kept up to date
+        self._by_status: Counter = Counter()
+        self.commits = 0
+        self.rows_written = 0
+        self.swept = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    # --- lifecycle -------------------------------------------------------
+
+    def _open(self) -> Tuple[int, dict]:
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outbox)")}
+        if columns and "client" not in columns:
+            try:
+                self._db.executescript(_MIGRATE_CLIENT_SCOPE)
+            except Exception:
+                if self._db.in_transaction:
+                    self._db.execute("ROLLBACK")
+                raise
+            logger.info("Email outbox migrated to per-client idempotency keys")
+        self._db.executescript(_SCHEMA)
+        # Messages interrupted mid-send by a crash or kill are delivered again
+        recovered = self._db.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'").rowcount
+        return recovered, dict(self._db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="email-outbox")
+        recovered, counts = await self._run(self._open)
+        if recovered:
+            logger.warning(f"Email outbox recovered {recovered} interrupted message(s)")
+        self._by_status = Counter(counts)
+        self._committer = asyncio.ensure_future(self._commit_loop())
+        if self.retention > 0:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+        self.has_work.set()
+
+    async def close(self):
+        for task in (self._sweeper, self._committer):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._sweeper = self._committer = None
+        # A commit interrupted by the cancel still finishes and answers its callers
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+            self._flushing = None
+        await self._flush()
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+    # --- group commit ----------------------------------------------------
+
+    async def _commit_loop(self):
+        while True:
+            await self._wakeup.wait()
+            # Give concurrent submissions a moment to join this transaction
+            if len(self._inserts) + len(self._updates) < self.batch_size:
+                await asyncio.sleep(self.commit_interval)
+            self._wakeup.clear()
+            self._flushing = asyncio.ensure_future(self._flush())
+            try:
+                await asyncio.shield(self._flushing)
+            except Exception as e:
+                logger.error(f"Email outbox commit failed: {str(e)}")
+
+    async def _flush(self):
+        inserts, self._inserts = self._inserts, []
+        updates, self._updates = self._updates, []
+        if not inserts and not updates:
+            return
+        try:
+            results = await self._run(
+                self._write_batch, [(job, client, key) for job, client, key, _ in inserts], updates
+            )
+        except Exception as e:
+            # Nothing was committed: the submitters get the error, status
+            # updates are kept for the next commit
+            self._updates[:0] = updates
+            for *_, future in inserts:
+                if not future.done():
+                    future.set_exception(e)
+            self._wakeup.set()
+            raise
+        for (*_, future), result in zip(inserts, results):
+            if isinstance(result, Exception):
+                if not future.done():
+                    future.set_exception(result)
+                continue
+            if not result[1]:
+                self._by_status["queued"] += 1
+            if not future.done():
+                future.set_result(result)
+        self.has_work.set()
+
+    def _write_batch(self, inserts: list, updates: list) -> List[Union[Tuple[str, bool], Exception]]:
+        """
+        One transaction for a whole batch; returns (message id, duplicate) per insert,
+        or an IdempotencyConflictError when the key was used for a different email
+        """
+        results = []
+        db = self._db
+        db.execute("BEGIN")
+        try:
+            for job, client, key in inserts:
+                fingerprint = payload_hash(job)
+                cursor = db.execute(
+                    "INSERT INTO outbox (id, client, idempotency_key, payload_hash, recipient, subject, body, "
+                    "html, status, attempts, next_attempt_at, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', 0, ?, ?) "
+                    "ON CONFLICT(client, idempotency_key) DO NOTHING",
+                    (job.id, client, key, fingerprint, job.to, job.subject, job.body, int(job.html),
+                     job.created_at, job.created_at)
+                )
+                if cursor.rowcount:
+                    results.append((job.id, False))
+                    continue
+                existing_id, existing_hash = db.execute(
+                    "SELECT id, payload_hash FROM outbox WHERE client = ? AND idempotency_key = ?", (client, key)
+                ).fetchone()
+                # Messages from before payload hashes can't be compared and count as the same
+                if existing_hash is not None and existing_hash != fingerprint:
+                    results.append(IdempotencyConflictError(
+                        f"Idempotency key {key} was already used for a different email"
+                    ))
+                else:
+                    results.append((existing_id, True))
+            db.executemany(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, error = ?, sent_at = ? "
+                "WHERE id = ?",
+                updates
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self.commits += 1
+        self.rows_written += len(inserts) + len(updates)
+        return results
+
+    # --- API ---------------------------------------------------------------
+
+    @property
+    def uncommitted(self) -> int:
+        return len(self._inserts)
+
+    async def add(self, job: EmailJob, idempotency_key: Optional[str] = None, client: str = "") -> Tuple[str, bool]:
+        """
+        Durably store job; returns (message id, duplicate) once committed.
+        Idempotency keys are unique per client ("" is the backend itself);
+        raises IdempotencyConflictError when client used the key for a different email.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._inserts.append((job, client, idempotency_key or job.id, future))
+        self._wakeup.set()
+        return await future
+
+    def _claim(self, limit: int) -> List[EmailJob]:
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                f"SELECT {_COLUMNS} FROM outbox WHERE status = 'queued' AND next_attempt_at <= ? "
+                "ORDER BY next_attempt_at LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+            db.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(row[0],) for row in rows])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return [_row_to_job(row) for row in rows]
+
+    async def claim(self, limit: int) -> List[EmailJob]:
+        """Mark up to limit due messages as sending and return them"""
+        jobs = await self._run(self._claim, limit)
+        for job in jobs:
+            job.status = "sending"
+        self._by_status["queued"] -= len(jobs)
+        self._by_status["sending"] += len(jobs)
+        return jobs
+
+    def record_sent(self, job: EmailJob):
+        """Queue a 'sent' update for the next group commit"""
+        self._updates.append(("sent", job.attempts, 0, None, job.sent_at, job.id))
+        self._moved("sent")
+        self._wakeup.set()
+
+    def record_failure(self, job: EmailJob, error: str, retry: bool = True) -> bool:
+        """Schedule a retry with exponential backoff; returns False when the message is given up"""
+        if not retry or job.attempts >= self.max_attempts:
+            job.status = "failed"
+            self._updates.append(("failed", job.attempts, 0, error, None, job.id))
+            self._moved("failed")
+            self._wakeup.set()
+            return False
+        delay = min(self.backoff_base * 2 ** (job.attempts - 1), self.backoff_max)
+        # Jitter so a burst of failures doesn't retry in lockstep
+        next_attempt = time.time() + delay * random.uniform(0.5, 1.0)
+        job.status = "queued"
+        self._updates.append(("queued", job.attempts, next_attempt, error, None, job.id))
+        self._moved("queued")
+        self._wakeup.set()
+        return True
+
+    def _moved(self, status: str):
+        """A claimed message left 'sending'"""
+        self._by_status["sending"] -= 1
+        self._by_status[status] += 1
+
+    def _get(self, message_id: str) -> Optional[EmailJob]:
+        row = self._db.execute(f"SELECT {_COLUMNS} FROM outbox WHERE id = ?", (message_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    async def get(self, message_id: str) -> Optional[EmailJob]:
+        return await self._run(self._get, message_id)
+
+    # --- retention ---------------------------------------------------------
+
+    def _delete_done(self, status: str, before: float) -> int:
+        return self._db.execute(
+            "DELETE FROM outbox WHERE rowid IN "
+            "(SELECT rowid FROM outbox WHERE status = ? AND created_at < ? LIMIT ?)",
+            (status, before, _SWEEP_CHUNK)
+        ).rowcount
+
+    async def sweep(self, now: Optional[float] = None) -> int:
+        """Delete sent and failed messages older than the retention period; returns the number deleted"""
+        before = (time.time() if now is None else now) - self.retention
+        removed = 0
+        for status in ("sent", "failed"):
+            while True:
+                count = await self._run(self._delete_done, status, before)
+                self._by_status[status] -= count
+                removed += count
+                if count < _SWEEP_CHUNK:
+                    break
+        self.swept += removed
+        if removed:
+            logger.info(f"Email outbox swept {removed} message(s) older than {self.retention / 86400:g} day(s)")
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Email outbox sweep failed: {str(e)}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def stats(self) -> dict:
+        return {
+            "by_status": {status: self._by_status[status] for status in STATUSES},
+            "commits": self.commits,
+            "rows_written": self.rows_written,
+            "uncommitted": self.uncommitted,
+            "swept": self.swept,
+        }
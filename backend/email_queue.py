@@ -0,0 +1,252 @@
+"""
+Background email delivery
+- Requests are stored in a durable outbox (see email_outbox.py) and delivered
+  by a small pool of workers
+- Each worker keeps one authenticated SMTP connection open and reuses it
+  across messages; blocking smtplib calls run in a thread, never on the event loop
+- Failed deliveries are retried with backoff; delivery status is read from the outbox
+"""
+
+import asyncio
+import logging
+import smtplib
+import time
+import uuid
+from dataclasses import dataclass, field
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """The delivery queue is at capacity"""
+
+
+class IdempotencyConflictError(Exception):
+    """The idempotency key was already used for a different email"""
+
+
+@dataclass
+class EmailJob:
+    """One queued email and its delivery status"""
+    to: str
+    subject: str
+    body: str
+    html: bool = False
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = "queued"          # queued -> sending -> sent | failed (retries go back to queued)
+    error: Optional[str] = None
+    attempts: int = 0
+    created_at: float = field(default_factory=time.time)
+    sent_at: Optional[float] = None
+
+    def to_dict(self) -> dict:
+        """Public status - without the recipient, the message id is all a caller needs"""
+        return {
+            "message_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "attempts": self.attempts,
+            "created_at": self.created_at,
+            "sent_at": self.sent_at,
+        }
+
+
+def build_message(job: EmailJob, sender: str) -> MIMEMultipart:
+    msg = MIMEMultipart("alternative")
+    msg["From"] = sender
+    msg["To"] = job.to
+    msg["Subject"] = job.subject
+    # Stable per message, so a redelivery after a crash can be recognised as a duplicate
+    msg["Message-ID"] = f"<{job.id}@{(sender or 'tropometrics.local').rpartition('@')[2]}>"
+    msg.attach(MIMEText(job.body, "html" if job.html else "plain"))
+    return msg
+
+
+class SmtpSender:
+    """
+    One persistent authenticated SMTP connection.
+    Not thread-safe: each worker owns its own sender and uses it sequentially.
+    """
+
+    def __init__(self, host: str, port: int, username: Optional[str], password: Optional[str],
+                 starttls: bool = True, timeout: float = 30, idle_timeout: float = 60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._connection: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self.connects = 0
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            connection.starttls()
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        self._connection = connection
+        self.connects += 1
+
+    def send(self, msg):
+        """Send msg, reconnecting once if the server dropped the idle connection"""
+        if self._connection is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            self.close()
+        if self._connection is None:
+            self._connect()
+        try:
+            self._connection.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self.close()
+            self._connect()
+            self._connection.send_message(msg)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._connection = None
+
+
+class EmailQueue:
+    """Outbox-backed delivery with a fixed pool of SMTP workers"""
+
+    def __init__(self, outbox, sender_factory: Callable[[], SmtpSender], from_address: Optional[str],
+                 workers: int = 2, max_queue: int = 1000, poll_interval: float = 1.0,
+                 on_send: Optional[Callable[[float, str], None]] = None):
+        self.outbox = outbox
+        self.sender_factory = sender_factory
+        self.from_address = from_address
+        self.workers = workers
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        # on_send(seconds, outcome) after every SMTP attempt - outcome "sent" or "error"
+        self.on_send = on_send
+        # Claimed from the outbox, waiting for a worker
+        self._work: "asyncio.Queue[EmailJob]" = asyncio.Queue()
+        self._tasks = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def submit(self, to: str, subject: str, body: str, html: bool = False,
+                     idempotency_key: Optional[str] = None, client: str = "") -> Tuple[str, bool]:
+        """
+        Durably queue an email; returns (message id, duplicate).
+        idempotency_key is unique per client ("" for the backend's own emails).
+        Raises QueueFullError when too many submissions are waiting for their commit,
+        IdempotencyConflictError when the key was used for a different email.
+        """
+        if self.outbox.uncommitted >= self.max_queue:
+            raise QueueFullError("Email queue is full")
+        job = EmailJob(to=to, subject=subject, body=body, html=html)
+        return await self.outbox.add(job, idempotency_key, client)
+
+    async def status(self, message_id: str) -> Optional[EmailJob]:
+        return await self.outbox.get(message_id)
+
+    async def _dispatcher(self):
+        """Hand due outbox messages to the workers, keeping only a short local backlog"""
+        while True:
+            self.outbox.has_work.clear()
+            room = self.workers * 2 - self._work.qsize()
+            if room > 0:
+                for job in await self.outbox.claim(room):
+                    self._work.put_nowait(job)
+            # Woken by every outbox commit; the timeout picks up scheduled retries
+            try:
+                await asyncio.wait_for(self.outbox.has_work.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self, number: int):
+        sender = self.sender_factory()
+        try:
+            while True:
+                job = await self._work.get()
+                try:
+                    await self._deliver(sender, job)
+                finally:
+                    self._work.task_done()
+        finally:
+            await asyncio.to_thread(sender.close)
+
+    async def _deliver(self, sender: SmtpSender, job: EmailJob):
+        job.attempts += 1
+        retry = True
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(sender.send, build_message(job, self.from_address))
+        except smtplib.SMTPAuthenticationError:
+            logger.error("SMTP authentication failed")
+            sender.close()
+            error = "Email authentication failed. Check credentials."
+        except smtplib.SMTPRecipientsRefused as e:
+            # Permanent - retrying will not change the server's answer
+            logger.error(f"SMTP recipient refused: {str(e)}")
+            error, retry = "Recipient refused", False
+        except (smtplib.SMTPException, OSError) as e:
+            logger.error(f"SMTP error: {str(e)}")
+            sender.close()
+            error = f"Failed to send email: {str(e)}"
+        else:
+            outcome = "sent"
+            job.status, job.sent_at = "sent", time.time()
+            self.outbox.record_sent(job)
+            self.sent += 1
+            logger.info(f"Email {job.id} sent successfully to {job.to}")
+            return
+        finally:
+            if self.on_send is not None:
+                self.on_send(time.perf_counter() - start, outcome)
+
+        if self.outbox.record_failure(job, error, retry):
+            self.retried += 1
+            logger.warning(f"Email {job.id} will be retried (attempt {job.attempts})")
+        else:
+            self.failed += 1
+
+    async def start(self):
+        if not self._tasks:
+            await self.outbox.open()
+            self._tasks = [asyncio.ensure_future(self._worker(i)) for i in range(self.workers)]
+            self._tasks.append(asyncio.ensure_future(self._dispatcher()))
+
+    async def stop(self, drain_timeout: float = 10):
+        """
+        Finish the messages already handed to workers (up to drain_timeout), then stop.
+        Anything left stays in the outbox and is delivered after the next start.
+        """
+        if not self._tasks:
+            return
+        dispatcher = self._tasks.pop()
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self._work.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Email delivery stopped with {self._work.qsize()} message(s) left in the outbox")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._work = asyncio.Queue()
+        await self.outbox.close()
+
+    async def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "outbox": await self.outbox.stats(),
+        }
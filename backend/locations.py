@@ -0,0 +1,55 @@
+"""
+Location handling for the weather API
+- Named locations (field ids) from configuration
+- Coordinate validation and snapping to the forecast model grid, so nearby
+  fields share one cache entry and one upstream lookup
+"""
+
+from typing import Dict, Optional
+
+
+def snap(value: float, resolution: float) -> float:
+    """Snap a coordinate to the nearest grid point"""
+    if resolution <= 0:
+        return round(value, 4)
+    return round(round(value / resolution) * resolution, 4)
+
+
+def snap_location(location: dict, resolution: float) -> dict:
+    """Grid cell for a location"""
+    return {
+        "latitude": snap(location["latitude"], resolution),
+        "longitude": snap(location["longitude"], resolution),
+    }
+
+
+def parse_locations(value: str) -> Dict[str, dict]:
+    """Parse 'field-1=52.01,4.36;field-2=51.99,4.35' into {id: location}"""
+    locations = {}
+    for item in (value or "").split(";"):
+        if not item.strip():
+            continue
+        location_id, _, coordinates = item.partition("=")
+        latitude, longitude = coordinates.split(",")
+        locations[location_id.strip()] = {"latitude": float(latitude), "longitude": float(longitude)}
+    return locations
+
+
+def resolve_location(known: Dict[str, dict], default: dict,
+                     latitude: Optional[float] = None, longitude: Optional[float] = None,
+                     location_id: Optional[str] = None) -> dict:
+    """
+    Resolve request parameters to a location.
+    Raises ValueError for unknown ids, half-specified or out-of-range coordinates.
+    """
+    if location_id is not None:
+        if location_id not in known:
+            raise ValueError(f"Unknown location '{location_id}'")
+        return {"id": location_id, **known[location_id]}
+    if latitude is None and longitude is None:
+        return {"id": "default", **default}
+    if latitude is None or longitude is None:
+        raise ValueError("Both latitude and longitude are required")
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError("Coordinates out of range")
+    return {"id": None, "latitude": latitude, "longitude": longitude}
@@ -0,0 +1,105 @@
+"""
+Event-loop lag monitoring
+- A sampler task sleeps for a fixed interval and records how late it wakes up:
+  that delay is the time every other request waited for the loop as well
+- Debug mode adds a watchdog thread that notices a loop that stopped waking up
+  and logs the loop thread's stack while the blocking call is still running,
+  so the offending code shows up by file and line (asyncio's own debug mode
+  only names the callback afterwards, and slows every call down)
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """Samples loop lag every interval seconds; stalls beyond threshold are counted (and traced in debug)"""
+
+    def __init__(self, observe: Callable[[float], None], interval: float = 0.1,
+                 threshold: float = 0.1, debug: bool = False):
+        # observe(lag seconds) - e.g. a histogram
+        self.observe = observe
+        self.interval = interval
+        self.threshold = threshold
+        self.debug = debug
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        # Monotonic time the sampler last ran - the watchdog's view of the loop
+        self._heartbeat = 0.0
+        self.samples = 0
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.stacks_logged = 0
+
+    async def _sample(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(now - expected, 0.0)
+            self.samples += 1
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self.stalls += 1
+            self.observe(lag)
+
+    def _watch(self):
+        """Watchdog thread: log the loop thread's stack once per stall"""
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or heartbeat == reported:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            reported = heartbeat
+            self.stacks_logged += 1
+            stack = "".join(traceback.format_stack(frame))
+            logger.warning(
+                f"Event loop blocked for {blocked * 1000:.0f}ms so far, loop thread stack:\n{stack}"
+            )
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.ensure_future(self._sample())
+        if self.debug:
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+    def stats(self) -> dict:
+        return {
+            "samples": self.samples,
+            "stalls": self.stalls,
+            "max_lag_seconds": round(self.max_lag, 4),
+            "stacks_logged": self.stacks_logged,
+        }
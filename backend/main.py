@@ -6,51 +6,267 @@ TropoMetrics API Backend
 Credentials stored as Kubernetes secrets, never exposed to client.
 """
 
-from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi import APIRouter, FastAPI, HTTPException, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
-from pydantic import BaseModel, EmailStr
-from typing import Optional
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, EmailStr, Field, HttpUrl
+from typing import List, Optional, Tuple
+from contextlib import asynccontextmanager, contextmanager
+import importlib.util
+import asyncio
+import orjson
 import os
+import secrets
 import logging
 import httpx
-from datetime import datetime
-import random
-from slowapi import Limiter
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from datetime import datetime, timedelta
+import time
+from rendering import cache_control, etag_matches, json_response, make_etag, negotiate_format, not_modified, render
+from alerts import AlertEngine
+from api_keys import STATE_TOKEN_HEADER, ApiKey, ApiKeyStore, RemoteApiKeyStore
+from changes import ChangeTracker
+from email_outbox import EmailOutbox
+from email_queue import EmailQueue, IdempotencyConflictError, QueueFullError, SmtpSender
+from locations import parse_locations, resolve_location, snap_location
+from loop_monitor import LoopLagMonitor
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Family, MetricsMiddleware, Registry, RequestMetrics
+from profiling import ProfilingMiddleware, ReportRing, RequestProfiler, StackSampler
+from projection import FieldProjection
+from rate_limit import (
+    MemoryBackend, RateLimiter, RateLimitExceeded, RedisBackend, client_address, parse_networks, parse_rate
+)
+from resample import MAX_FORECAST_DAYS, parse_aggregations, parse_window, window_start
+from subscriptions import Subscription, SubscriptionRegistry
+from tracing import SpanExporter, Tracer, TracingMiddleware, span
+from upstream_batch import UpstreamBatcher
+from weather_cache import CacheEntry, ForecastCache, ForecastRefresher
+from webhooks import (
+    EVENTS as WEBHOOK_EVENTS, Webhook, WebhookDispatcher, WebhookRegistry, WebhookUrlError, new_secret, resolve_target
+)
+from users import LANGUAGES, UNITS, Profile, RemoteUserStore, UserStore
+from weather_report import (
+    IRRIGATION_THRESHOLD, SECTIONS, ReportOptions, build_sections, build_test_sections, personalize
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="TropoMetrics Email API", version="1.0.0")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application lifespan - pooled upstream HTTP client, forecast refresher, email workers, alerts and webhooks"""
+    app.state.http_client = create_http_client()
+    logger.info(
+        f"Upstream HTTP client ready (max_connections={UPSTREAM_MAX_CONNECTIONS}, "
+        f"http2={UPSTREAM_HTTP2})"
+    )
+
+    # Keep the default and configured hot locations warm in memory
+    for location in [WEATHER_LOCATION, *FORECAST_HOT_LOCATIONS, *WEATHER_LOCATIONS.values()]:
+        key = forecast_key(location, WEATHER_VARIABLES)
+        forecast_cache.pin(key, forecast_fetcher(key))
+    await api_key_store.open()
+    await user_store.open()
+    if OWNS_STATE:
+        # Every subscribed cell is refreshed (and evaluated) even without /api traffic
+        await subscription_registry.open()
+        await webhook_registry.open()
+        for key in subscription_registry.keys() + webhook_registry.keys():
+            forecast_cache.pin(key, forecast_fetcher(key))
+        webhook_dispatcher.start()
+    else:
+        logger.info(f"Email, subscriptions, webhooks, API keys and users are kept by the state service at "
+                    f"{STATE_SERVICE_URL}")
+    try:
+        await forecast_refresher.run_once()
+    except Exception as e:
+        logger.error(f"Initial forecast warm-up failed: {str(e)}")
+    forecast_refresher.start()
+    if OWNS_STATE:
+        await email_queue.start()
+        alert_engine.start()
+    if tracer.exporter is not None:
+        tracer.exporter.start()
+    loop_monitor.start()
+    if stack_sampler is not None:
+        stack_sampler.start()
+
+    try:
+        yield
+    finally:
+        if stack_sampler is not None:
+            await asyncio.to_thread(stack_sampler.stop)
+        await loop_monitor.stop()
+        await forecast_refresher.stop()
+        if tracer.exporter is not None:
+            await tracer.exporter.stop()
+        if OWNS_STATE:
+            await webhook_dispatcher.stop()
+            await alert_engine.stop()
+            await email_queue.stop()
+            await subscription_registry.close()
+            await webhook_registry.close()
+        await api_key_store.close()
+        await user_store.close()
+        if isinstance(limiter.backend, RedisBackend):
+            await limiter.backend.close()
+        await app.state.http_client.aclose()
+
+
+app = FastAPI(title="TropoMetrics Email API", version="1.0.0", lifespan=lifespan)
+
+# State service - the one process that owns the SQLite stores and their background
+# work (email outbox and delivery, alert subscriptions, webhooks, API keys, users). SQLite
+# can't be shared between pods, so the scaled API replicas set STATE_SERVICE_URL and don't
+# serve these endpoints; nginx routes them to the state service and API keys and profiles
+# are looked up there.
+# Empty: this process owns the state (docker-compose, tests and the state service itself)
+STATE_SERVICE_URL = os.getenv("STATE_SERVICE_URL", "").rstrip("/")
+OWNS_STATE = not STATE_SERVICE_URL
+# Shared secret for the /internal endpoints the API replicas call (Kubernetes secret);
+# the state service refuses them while it is empty
+STATE_SERVICE_TOKEN = os.getenv("STATE_SERVICE_TOKEN", "")
+# Endpoints that read or write state, included at the end of this module when OWNS_STATE
+state_router = APIRouter()
 
 # Rate limiter configuration
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
+# Reverse proxies in front of the backend (nginx) - their forwarding headers are trusted
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+TRUSTED_PROXIES = parse_networks(
+    os.getenv("TRUSTED_PROXIES", "10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,127.0.0.0/8,::1/128")
+)
+# Quota per API key across all endpoints, on top of the per-client route limits
+API_KEY_RATE_LIMIT = os.getenv("API_KEY_RATE_LIMIT", "120/minute")
+# "memory" (per replica) or a redis:// URL shared by all replicas
+RATE_LIMIT_STORAGE = os.getenv("RATE_LIMIT_STORAGE", "memory")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+def create_rate_limit_backend():
+    """Shared Redis buckets when configured and the redis package is installed"""
+    if RATE_LIMIT_STORAGE.startswith(("redis://", "rediss://", "unix://")):
+        if importlib.util.find_spec("redis") is not None:
+            return RedisBackend.from_url(RATE_LIMIT_STORAGE)
+        logger.error("RATE_LIMIT_STORAGE is a Redis URL but the redis package is not installed, using memory")
+    return MemoryBackend(max_keys=RATE_LIMIT_MAX_KEYS)
+
+
+limiter = RateLimiter(
+    create_rate_limit_backend(),
+    client_key=lambda request: client_address(request, TRUSTED_PROXY_HOPS, TRUSTED_PROXIES),
+    key_quota=lambda api_key: api_key_quota(api_key),
+)
+# Off only for load tests against a development deployment (tests/test_API.py)
+limiter.enabled = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
 app.add_exception_handler(RateLimitExceeded, lambda request, exc: JSONResponse(
     status_code=429,
     content={
         "error": True,
         "status": 429,
         "message": "Rate limit exceeded. Please try again later.",
-        "detail": str(exc.detail)
-    }
+        "detail": exc.detail
+    },
+    headers={"Retry-After": str(max(1, round(exc.retry_after)))}
 ))
 
+# Profiling - admin keys can run a single request under the profiler (?profile=1 or inline)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))                   # reports kept on disk
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))    # pyinstrument sampling
+# Continuous sampler of the event loop's stack, written as folded stacks
+PROFILE_SAMPLER = os.getenv("PROFILE_SAMPLER", "false").lower() == "true"
+PROFILE_SAMPLER_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLER_INTERVAL_MS", "10"))
+PROFILE_SAMPLER_DUMP_SECONDS = float(os.getenv("PROFILE_SAMPLER_DUMP_SECONDS", "60"))
+
+profile_ring = ReportRing(PROFILE_DIR, keep=PROFILE_KEEP)
+request_profiler = RequestProfiler(interval=PROFILE_INTERVAL_MS / 1000)
+stack_sampler = StackSampler(
+    profile_ring,
+    interval=PROFILE_SAMPLER_INTERVAL_MS / 1000,
+    dump_interval=PROFILE_SAMPLER_DUMP_SECONDS,
+) if PROFILE_SAMPLER else None
+
+
+async def is_admin(api_key: Optional[str]) -> bool:
+    client = await api_key_store.lookup(api_key) if api_key else None
+    return client is not None and client.admin
+
+
+# Added first so it sits closest to the endpoints
+app.add_middleware(ProfilingMiddleware, profiler=request_profiler, ring=profile_ring, authorize=is_admin)
+
 # CORS configuration - allow requests from frontend
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # In production, specify exact origins
     allow_credentials=True,
-    allow_methods=["GET", "POST"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
 )
 
+# Prometheus metrics - request latency per route, /api stage timings, component counters
+metrics_registry = Registry()
+request_metrics = RequestMetrics(metrics_registry, "tropometrics")
+app.add_middleware(MetricsMiddleware, metrics=request_metrics)
+api_stage_seconds = metrics_registry.histogram(
+    "tropometrics_api_stage_seconds",
+    "Time spent per stage of /api: upstream (forecast lookup, cached or fetched), derivation, serialization, html",
+    ("stage",),
+)
+upstream_request_seconds = metrics_registry.histogram(
+    "tropometrics_upstream_request_seconds", "Open-Meteo requests by outcome (ok, HTTP status or error type)",
+    ("outcome",),
+)
+smtp_send_seconds = metrics_registry.histogram(
+    "tropometrics_smtp_send_seconds", "SMTP send attempts by outcome (sent, error)",
+    ("outcome",), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+# Tracing - Server-Timing header on every response, optional OpenTelemetry export
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+# OTLP/HTTP traces URL (http://otel-collector:4318/v1/traces) or a file for OTLP JSON lines
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "tropometrics-backend")
+
+tracer = Tracer(
+    SpanExporter(TRACE_EXPORT, TRACE_SERVICE_NAME) if TRACE_EXPORT else None,
+    sample_ratio=TRACE_SAMPLE_RATIO,
+    server_timing=SERVER_TIMING,
+)
+app.add_middleware(TracingMiddleware, tracer=tracer)
+
+# Event-loop lag - how long ready callbacks (i.e. every request) wait for the loop
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "100"))
+# Log the loop thread's stack for every stall (watchdog thread)
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "false").lower() == "true"
+
+loop_lag_seconds = metrics_registry.histogram(
+    "tropometrics_event_loop_lag_seconds", f"Event-loop wake-up delay, sampled every {LOOP_LAG_INTERVAL}s",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+)
+loop_monitor = LoopLagMonitor(
+    loop_lag_seconds.observe,
+    interval=LOOP_LAG_INTERVAL,
+    threshold=LOOP_STALL_THRESHOLD_MS / 1000,
+    debug=LOOP_DEBUG,
+)
+
+
+@contextmanager
+def api_stage(name: str):
+    """A stage of /api - a trace span plus the stage histogram"""
+    with span(name), api_stage_seconds.time(name):
+        yield
+
+
+def record_smtp_send(seconds: float, outcome: str):
+    smtp_send_seconds.observe(seconds, outcome)
+    tracer.record("smtp.send", seconds, outcome=outcome)
+
 # Email configuration from environment variables (injected from K8s secrets)
 EMAIL_USERNAME = os.getenv("EMAIL_USERNAME")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
@@ -64,23 +280,303 @@ except ValueError:
     SMTP_HOST = EMAIL_SERVER
     SMTP_PORT = 587
 
-# Validate configuration
-if not EMAIL_USERNAME or not EMAIL_PASSWORD:
+# Background delivery - worker count, queue capacity and SMTP connection reuse
+EMAIL_WORKERS = int(os.getenv("EMAIL_WORKERS", "2"))
+EMAIL_QUEUE_SIZE = int(os.getenv("EMAIL_QUEUE_SIZE", "1000"))
+EMAIL_STARTTLS = os.getenv("EMAIL_STARTTLS", "true").lower() == "true"
+EMAIL_IDLE_TIMEOUT = float(os.getenv("EMAIL_IDLE_TIMEOUT", "60"))
+
+# Durable outbox - accepted emails survive restarts; mount a volume at this path
+EMAIL_OUTBOX_PATH = os.getenv("EMAIL_OUTBOX_PATH", "email_outbox.db")
+EMAIL_OUTBOX_BATCH = int(os.getenv("EMAIL_OUTBOX_BATCH", "200"))
+EMAIL_OUTBOX_COMMIT_MS = float(os.getenv("EMAIL_OUTBOX_COMMIT_MS", "20"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_RETRY_BASE = float(os.getenv("EMAIL_RETRY_BASE", "5"))
+EMAIL_RETRY_MAX = float(os.getenv("EMAIL_RETRY_MAX", "600"))
+EMAIL_OUTBOX_RETENTION_DAYS = float(os.getenv("EMAIL_OUTBOX_RETENTION_DAYS", "7"))
+# Emails per recipient address, whoever asks: /api/send-email and subscription confirmations
+EMAIL_RECIPIENT_RATE = parse_rate(os.getenv("EMAIL_RECIPIENT_RATE_LIMIT", "5/hour"))
+
+email_outbox = EmailOutbox(
+    EMAIL_OUTBOX_PATH,
+    batch_size=EMAIL_OUTBOX_BATCH,
+    commit_interval=EMAIL_OUTBOX_COMMIT_MS / 1000,
+    max_attempts=EMAIL_MAX_ATTEMPTS,
+    backoff_base=EMAIL_RETRY_BASE,
+    backoff_max=EMAIL_RETRY_MAX,
+    retention=EMAIL_OUTBOX_RETENTION_DAYS * 86400,
+)
+email_queue = EmailQueue(
+    email_outbox,
+    lambda: SmtpSender(
+        SMTP_HOST, SMTP_PORT, EMAIL_USERNAME, EMAIL_PASSWORD,
+        starttls=EMAIL_STARTTLS, idle_timeout=EMAIL_IDLE_TIMEOUT
+    ),
+    from_address=EMAIL_USERNAME,
+    workers=EMAIL_WORKERS,
+    max_queue=EMAIL_QUEUE_SIZE,
+    on_send=record_smtp_send,
+)
+
+# Validate configuration - only the process that owns the state sends email
+if OWNS_STATE and (not EMAIL_USERNAME or not EMAIL_PASSWORD):
     logger.error("Email credentials not configured! Check Kubernetes secrets.")
-else:
+elif OWNS_STATE:
     logger.info(f"Email API configured with {EMAIL_USERNAME} via {SMTP_HOST}:{SMTP_PORT}")
 
-# Valid API keys for weather data endpoint
-VALID_API_KEYS = [
-    "demo",                         # Demo key - uses real Open-Meteo API
-    "test",                         # Test key - returns random data
-]
+# API keys - hashed in SQLite, managed with `python api_keys.py` (see README)
+API_KEYS_PATH = os.getenv("API_KEYS_PATH", "api_keys.db")
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "10000"))
+# Revocations and plan changes apply within this many seconds
+API_KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "60"))
+API_KEY_USAGE_FLUSH_SECONDS = float(os.getenv("API_KEY_USAGE_FLUSH_SECONDS", "10"))
+
+if OWNS_STATE:
+    api_key_store = ApiKeyStore(
+        API_KEYS_PATH,
+        cache_size=API_KEY_CACHE_SIZE,
+        cache_ttl=API_KEY_CACHE_TTL,
+        flush_interval=API_KEY_USAGE_FLUSH_SECONDS,
+        seed_keys={
+            "demo": "Demo key - uses real Open-Meteo API",
+            "test": "Test key - returns random data",
+        },
+    )
+else:
+    # Every replica sees the same keys: lookups and usage go to the state service
+    if not STATE_SERVICE_TOKEN:
+        logger.error("STATE_SERVICE_TOKEN not configured! API keys can't be looked up.")
+    api_key_store = RemoteApiKeyStore(
+        STATE_SERVICE_URL,
+        STATE_SERVICE_TOKEN,
+        cache_size=API_KEY_CACHE_SIZE,
+        cache_ttl=API_KEY_CACHE_TTL,
+        flush_interval=API_KEY_USAGE_FLUSH_SECONDS,
+    )
+
+# Users, farms, fields and preferences - one profile per API key, see /api/me
+USERS_PATH = os.getenv("USERS_PATH", "users.db")
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+# How often writes by other processes are looked for (seconds)
+USER_CACHE_CHECK_SECONDS = float(os.getenv("USER_CACHE_CHECK_SECONDS", "5"))
+
+if OWNS_STATE:
+    user_store = UserStore(USERS_PATH, cache_size=USER_CACHE_SIZE, check_interval=USER_CACHE_CHECK_SECONDS)
+else:
+    # /api/me is served by the state service, the replicas read profiles from it
+    user_store = RemoteUserStore(
+        STATE_SERVICE_URL, STATE_SERVICE_TOKEN, cache_size=USER_CACHE_SIZE, check_interval=USER_CACHE_CHECK_SECONDS
+    )
 
 # Weather data configuration
 WEATHER_LOCATION = {
     "latitude": -5.013,
     "longitude": -58.381
 }
+WEATHER_TIMEZONE = "Europe/Amsterdam"
+# Named locations (field ids) usable as /api?location=<id>: "id=lat,lon;id=lat,lon"
+WEATHER_LOCATIONS = parse_locations(os.getenv("WEATHER_LOCATIONS", ""))
+# Coordinates are snapped to this grid (degrees) so nearby fields share one forecast
+WEATHER_GRID_RESOLUTION = float(os.getenv("WEATHER_GRID_RESOLUTION", "0.1"))
+WEATHER_VARIABLES = {
+    "daily": ("temperature_2m_max", "temperature_2m_min", "daylight_duration"),
+    "hourly": ("precipitation", "relative_humidity_2m", "soil_moisture_27_to_81cm"),
+    "current": ("temperature_2m",),
+}
+# Open-Meteo returns 7 days unless forecast_days is requested
+DEFAULT_FORECAST_DAYS = 7
+
+# Forecast resampling defaults (?window=, ?days=, ?agg=)
+FORECAST_DEFAULT_WINDOW = "6h"
+FORECAST_DEFAULT_DAYS = 5
+FORECAST_DEFAULT_AGGREGATION = "precipitation:sum"
+
+# Batch endpoint limits
+BATCH_MAX_LOCATIONS = int(os.getenv("BATCH_MAX_LOCATIONS", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "20"))
+
+# Open-Meteo endpoint - point it at a mirror, the commercial API or tests/open_meteo_standin.py
+OPEN_METEO_BASE_URL = os.getenv("OPEN_METEO_BASE_URL", "https://api.open-meteo.com").rstrip("/")
+
+# Upstream HTTP client configuration (shared connection pool for Open-Meteo)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "20"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "10"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+# HTTP/2 only when the h2 package is installed (httpx[http2])
+UPSTREAM_HTTP2 = (
+    os.getenv("UPSTREAM_HTTP2", "true").lower() == "true"
+    and importlib.util.find_spec("h2") is not None
+)
+
+# Upstream batching - lookups within the window are sent as one multi-coordinate request
+UPSTREAM_BATCH_SIZE = int(os.getenv("UPSTREAM_BATCH_SIZE", "50"))
+UPSTREAM_BATCH_WINDOW_MS = float(os.getenv("UPSTREAM_BATCH_WINDOW_MS", "10"))
+
+# Forecast cache - Open-Meteo models update roughly once an hour
+FORECAST_CACHE_TTL = int(os.getenv("FORECAST_CACHE_TTL", "900"))
+# How long an expired forecast may still be served while it is refreshed
+FORECAST_STALE_TTL = int(os.getenv("FORECAST_STALE_TTL", "3600"))
+# Most forecasts kept in memory (grid cell x variables x horizon), least recently used go first
+FORECAST_CACHE_MAX_ENTRIES = int(os.getenv("FORECAST_CACHE_MAX_ENTRIES", "5000"))
+# Background refresh ticks: every interval, offset past the wall-clock boundary
+# so the refresh lands after Open-Meteo publishes its hourly update
+FORECAST_REFRESH_INTERVAL = int(os.getenv("FORECAST_REFRESH_INTERVAL", str(FORECAST_CACHE_TTL)))
+FORECAST_REFRESH_OFFSET = int(os.getenv("FORECAST_REFRESH_OFFSET", "120"))
+# Locations requested within this window are kept warm by the refresher
+FORECAST_HOT_WINDOW = int(os.getenv("FORECAST_HOT_WINDOW", "3600"))
+# Extra always-warm locations: "lat,lon;lat,lon"
+FORECAST_HOT_LOCATIONS = [
+    {"latitude": float(lat), "longitude": float(lon)}
+    for lat, lon in (
+        pair.split(",") for pair in os.getenv("FORECAST_HOT_LOCATIONS", "").split(";") if pair.strip()
+    )
+]
+
+forecast_cache = ForecastCache(
+    ttl_seconds=FORECAST_CACHE_TTL,
+    stale_seconds=FORECAST_STALE_TTL,
+    max_entries=FORECAST_CACHE_MAX_ENTRIES,
+)
+upstream_batcher = UpstreamBatcher(
+    lambda group, locations: fetch_open_meteo(locations, dict(group[0]), group[1]),
+    max_batch=UPSTREAM_BATCH_SIZE,
+    window_seconds=UPSTREAM_BATCH_WINDOW_MS / 1000,
+)
+forecast_refresher = ForecastRefresher(
+    forecast_cache,
+    interval_seconds=FORECAST_REFRESH_INTERVAL,
+    offset_seconds=FORECAST_REFRESH_OFFSET,
+    hot_window=FORECAST_HOT_WINDOW,
+)
+
+# Irrigation alert subscriptions - evaluated on every forecast fetch/refresh
+SUBSCRIPTIONS_PATH = os.getenv("SUBSCRIPTIONS_PATH", "subscriptions.db")
+# At most one alert email per recipient per interval (seconds)
+ALERT_MIN_INTERVAL = int(os.getenv("ALERT_MIN_INTERVAL", "3600"))
+ALERT_FLUSH_SECONDS = float(os.getenv("ALERT_FLUSH_SECONDS", "5"))
+# Base of the confirmation and unsubscribe links; the URL of the last subscription request when unset
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+# Unconfirmed subscriptions are deleted after this many hours (0 keeps them)
+SUBSCRIPTION_CONFIRM_HOURS = float(os.getenv("SUBSCRIPTION_CONFIRM_HOURS", "48"))
+
+subscription_registry = SubscriptionRegistry(
+    SUBSCRIPTIONS_PATH,
+    key_for=lambda s: forecast_key({"latitude": s.latitude, "longitude": s.longitude}, WEATHER_VARIABLES),
+    confirm_ttl=SUBSCRIPTION_CONFIRM_HOURS * 3600,
+)
+alert_engine = AlertEngine(
+    subscription_registry,
+    lambda recipient, subject, body, key: email_queue.submit(recipient, subject, body, False, key),
+    base_url=PUBLIC_BASE_URL,
+    min_interval=ALERT_MIN_INTERVAL,
+    flush_seconds=ALERT_FLUSH_SECONDS,
+)
+if OWNS_STATE:
+    forecast_cache.add_listener(alert_engine.on_forecast)
+
+# Webhooks - signed change events for advice and forecast totals
+WEBHOOKS_PATH = os.getenv("WEBHOOKS_PATH", "webhooks.db")
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "2"))      # per endpoint
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+WEBHOOK_BATCH_WINDOW_MS = float(os.getenv("WEBHOOK_BATCH_WINDOW_MS", "500"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "6"))
+WEBHOOK_RETRY_BASE = float(os.getenv("WEBHOOK_RETRY_BASE", "1"))
+WEBHOOK_RETRY_MAX = float(os.getenv("WEBHOOK_RETRY_MAX", "300"))
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "50"))
+# Accept http and private/loopback targets - tests and local development only
+WEBHOOK_ALLOW_LOCAL = os.getenv("WEBHOOK_ALLOW_LOCAL", "false").lower() == "true"
+
+webhook_registry = WebhookRegistry(
+    WEBHOOKS_PATH,
+    key_for=lambda w: forecast_key({"latitude": w.latitude, "longitude": w.longitude}, WEATHER_VARIABLES),
+)
+webhook_dispatcher = WebhookDispatcher(
+    webhook_registry,
+    lambda weather_data: forecast_summary(weather_data),
+    concurrency=WEBHOOK_CONCURRENCY,
+    max_batch=WEBHOOK_BATCH_SIZE,
+    batch_window=WEBHOOK_BATCH_WINDOW_MS / 1000,
+    max_attempts=WEBHOOK_MAX_ATTEMPTS,
+    backoff_base=WEBHOOK_RETRY_BASE,
+    backoff_max=WEBHOOK_RETRY_MAX,
+    timeout=WEBHOOK_TIMEOUT,
+    max_connections=WEBHOOK_MAX_CONNECTIONS,
+    allow_local=WEBHOOK_ALLOW_LOCAL,
+)
+if OWNS_STATE:
+    forecast_cache.add_listener(webhook_dispatcher.on_forecast)
+
+# Change feed - recent forecast versions per key, diffed with the caller's options
+CHANGES_HISTORY = int(os.getenv("CHANGES_HISTORY", "24"))            # change sets kept per key
+CHANGES_MAX_KEYS = int(os.getenv("CHANGES_MAX_KEYS", "500"))
+CHANGES_MAX_MB = float(os.getenv("CHANGES_MAX_MB", "16"))            # retained hourly arrays, all keys
+
+change_tracker = ChangeTracker(
+    history=CHANGES_HISTORY,
+    max_keys=CHANGES_MAX_KEYS,
+    max_bytes=int(CHANGES_MAX_MB * 2**20),
+)
+forecast_cache.add_listener(change_tracker.on_forecast)
+
+
+class BatchLocation(BaseModel):
+    """One location in a batch request - coordinates or a field id"""
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    location: Optional[str] = None
+
+
+class BatchRequest(BaseModel):
+    """Batch weather request schema"""
+    locations: List[BatchLocation] = Field(..., min_length=1, max_length=BATCH_MAX_LOCATIONS)
+    sections: List[str] = ["current", "moisture", "irrigation", "forecast"]
+    window: str = FORECAST_DEFAULT_WINDOW
+    days: int = FORECAST_DEFAULT_DAYS
+    agg: str = FORECAST_DEFAULT_AGGREGATION
+
+
+class SubscriptionRequest(BaseModel):
+    """Irrigation alert subscription schema - a field id or coordinates"""
+    email: EmailStr
+    location: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    threshold: float = Field(IRRIGATION_THRESHOLD, gt=0, lt=1)
+
+
+class WebhookRequest(BaseModel):
+    """Webhook registration schema - a field id or coordinates"""
+    url: HttpUrl
+    location: Optional[str] = None
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    events: List[str] = list(WEBHOOK_EVENTS)
+    secret: Optional[str] = Field(None, min_length=16, max_length=200)
+
+
+class UserRequest(BaseModel):
+    """User profile schema - preferences personalize /api for the API key"""
+    email: EmailStr
+    name: Optional[str] = Field(None, max_length=200)
+    units: str = UNITS[0]
+    language: str = LANGUAGES[0]
+    default_location: Optional[str] = Field(None, max_length=200)
+
+
+class FarmRequest(BaseModel):
+    """Farm schema"""
+    name: str = Field(..., min_length=1, max_length=200)
+
+
+class FieldRequest(BaseModel):
+    """Field schema - usable as /api?location=<field id> once created"""
+    name: str = Field(..., min_length=1, max_length=200)
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
 
 
 class EmailRequest(BaseModel):
@@ -91,6 +587,11 @@ class EmailRequest(BaseModel):
     html: bool = False
 
 
+class UsageRows(BaseModel):
+    """API key usage flushed by an API replica: (key id, day, endpoint, requests)"""
+    rows: List[Tuple[str, str, str, int]] = Field(..., max_length=100000)
+
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
@@ -104,297 +605,473 @@ async def root():
 @app.get("/health")
 async def health():
     """Kubernetes health check"""
-    if not EMAIL_USERNAME or not EMAIL_PASSWORD:
+    if OWNS_STATE and (not EMAIL_USERNAME or not EMAIL_PASSWORD):
         raise HTTPException(status_code=503, detail="Email credentials not configured")
     return {"status": "ok","Backend": "Online"}
 
 
+def create_http_client() -> httpx.AsyncClient:
+    """Build the application-scoped upstream client"""
+    return httpx.AsyncClient(
+        http2=UPSTREAM_HTTP2,
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            read=UPSTREAM_READ_TIMEOUT,
+            write=UPSTREAM_READ_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    )
+
+
+async def fetch_open_meteo(locations: list, variables: dict,
+                           forecast_days: int = DEFAULT_FORECAST_DAYS) -> list:
+    """Fetch forecasts for one or more locations in one Open-Meteo request (uncached)"""
+    logger.info(f"🌍 Calling Open-Meteo API for {len(locations)} location(s)")
+    params = {
+        "latitude": ",".join(str(location['latitude']) for location in locations),
+        "longitude": ",".join(str(location['longitude']) for location in locations),
+        **{section: ",".join(names) for section, names in variables.items()},
+        "timezone": WEATHER_TIMEZONE,
+    }
+    if forecast_days != DEFAULT_FORECAST_DAYS:
+        params["forecast_days"] = forecast_days
+    outcome = "ok"
+    start = time.perf_counter()
+    try:
+        response = await app.state.http_client.get(f"{OPEN_METEO_BASE_URL}/v1/forecast", params=params)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        outcome = str(e.response.status_code)
+        raise
+    except httpx.HTTPError as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        upstream_request_seconds.observe(time.perf_counter() - start, outcome)
+    # A 50-location batch is ~300 KB of JSON, parsed on the loop - orjson is the faster parser
+    data = orjson.loads(response.content)
+    # Open-Meteo returns a list for multiple coordinates and an object for one
+    return data if isinstance(data, list) else [data]
+
+
+def forecast_key(location: dict, variables: dict, forecast_days: int = DEFAULT_FORECAST_DAYS) -> tuple:
+    """Cache key for a (grid cell, requested variables, horizon) combination"""
+    cell = snap_location(location, WEATHER_GRID_RESOLUTION)
+    return (
+        cell['latitude'],
+        cell['longitude'],
+        tuple((section, tuple(names)) for section, names in sorted(variables.items())),
+        forecast_days,
+    )
+
+
+def forecast_fetcher(key: tuple):
+    """Fetch function for a cache key - goes through the upstream batcher"""
+    latitude, longitude, variables, forecast_days = key
+    return lambda: upstream_batcher.fetch(
+        (variables, forecast_days),
+        {"latitude": latitude, "longitude": longitude}
+    )
+
+
+async def get_forecast(location: dict, variables: dict = WEATHER_VARIABLES,
+                       forecast_days: int = DEFAULT_FORECAST_DAYS) -> Tuple[CacheEntry, bool]:
+    """Get a forecast through the shared cache, returns (entry, served_stale)"""
+    key = forecast_key(location, variables, forecast_days)
+    return await forecast_cache.get_or_fetch(key, forecast_fetcher(key))
+
+
+def forecast_variables(aggregations: list) -> dict:
+    """Upstream variables needed for the base response plus the requested aggregations"""
+    hourly = WEATHER_VARIABLES["hourly"]
+    extra = tuple(v for v, _ in aggregations if v not in hourly)
+    if not extra:
+        return WEATHER_VARIABLES
+    return {**WEATHER_VARIABLES, "hourly": hourly + tuple(dict.fromkeys(extra))}
+
+
+def location_metadata(location: dict) -> dict:
+    """Location block of the API response - requested point and the grid cell it was served from"""
+    cell = snap_location(location, WEATHER_GRID_RESOLUTION)
+    return {
+        "id": location.get("id"),
+        "latitude": location['latitude'],
+        "longitude": location['longitude'],
+        "grid_latitude": cell['latitude'],
+        "grid_longitude": cell['longitude'],
+        "timezone": WEATHER_TIMEZONE
+    }
+
+
+def error_payload(status: int, message: str) -> dict:
+    """Error body shared by the weather endpoints"""
+    return {
+        "error": True,
+        "status": status,
+        "message": message,
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "service": "TropoMetrics Weather API"
+    }
+
+
+async def authenticate(api_key: Optional[str], endpoint: str) -> Tuple[Optional[ApiKey], Optional[str]]:
+    """Resolve api_key and count the request, returns (key, None) or (None, error message)"""
+    if not api_key:
+        return None, "Missing API key. Use: /api?api_key=YOUR_API_KEY"
+    client = await api_key_store.lookup(api_key)
+    if client is None:
+        return None, "Invalid API key"
+    api_key_store.record(client, endpoint)
+    return client, None
+
+
+def plan_error(client: ApiKey, location: Optional[dict] = None, output_format: Optional[str] = None) -> Optional[str]:
+    """Return an error message when the key's plan does not cover location or output_format"""
+    if location is not None and not client.allows_location(location, WEATHER_GRID_RESOLUTION):
+        return "Location not included in your API plan"
+    if output_format is not None and not client.allows_format(output_format):
+        return f"Format '{output_format}' not included in your API plan"
+    return None
+
+
+def owns(client: ApiKey, owner: Optional[str]) -> bool:
+    """Whether client may see or change a resource registered by owner (admin keys see all)"""
+    return client.admin or owner == client.id
+
+
+def parse_default_location(value: str, known: dict) -> Optional[dict]:
+    """A field id or "lat,lon" as a location, None when it is neither"""
+    if value in known:
+        return known[value]
+    latitude, _, longitude = value.partition(",")
+    try:
+        location = {"latitude": float(latitude), "longitude": float(longitude)}
+    except ValueError:
+        return None
+    if not -90 <= location["latitude"] <= 90 or not -180 <= location["longitude"] <= 180:
+        return None
+    return location
+
+
+def profile_locations(profile: Optional[Profile]) -> Tuple[dict, dict]:
+    """(known locations, default location) for a request - the user's fields and default when set"""
+    if profile is None:
+        return WEATHER_LOCATIONS, WEATHER_LOCATION
+    known = {**WEATHER_LOCATIONS, **profile.locations}
+    default = None
+    if profile.default_location:
+        default = parse_default_location(profile.default_location, known)
+    return known, default or WEATHER_LOCATION
+
+
+async def api_key_quota(api_key: str) -> Optional[str]:
+    """Rate limit shared by all requests with api_key, None for unknown keys"""
+    client = await api_key_store.lookup(api_key)
+    if client is None:
+        return None
+    return client.rate or API_KEY_RATE_LIMIT
+
+
+def render_timed(request: Request, payload: dict, output_format: str, variant: str = "live") -> Response:
+    """render() observed as the serialization or html stage of /api"""
+    with api_stage("html" if output_format == "html" else "serialization"):
+        return render(request, payload, variant=variant, requested=output_format)
+
+
+def parse_forecast_options(window: str, days: int, agg: str) -> Tuple[int, list]:
+    """Validate resampling options, raises ValueError"""
+    window_hours = parse_window(window)
+    aggregations = parse_aggregations(agg)
+    if not 1 <= days <= MAX_FORECAST_DAYS:
+        raise ValueError(f"days must be between 1 and {MAX_FORECAST_DAYS}")
+    return window_hours, aggregations
+
+
+def upstream_forecast_days(days: int) -> int:
+    """Horizon to request upstream - one extra day since windows start today"""
+    return min(max(days + 1, DEFAULT_FORECAST_DAYS), MAX_FORECAST_DAYS)
+
+
+def local_time(weather_data: dict) -> datetime:
+    """Current time at the location (Open-Meteo hourly times are local)"""
+    return datetime.utcnow() + timedelta(seconds=weather_data.get('utc_offset_seconds', 0))
+
+
+def default_sections(weather_data: dict) -> dict:
+    """Irrigation and forecast sections as /api builds them with default options"""
+    window_hours, aggregations = parse_forecast_options(
+        FORECAST_DEFAULT_WINDOW, FORECAST_DEFAULT_DAYS, FORECAST_DEFAULT_AGGREGATION
+    )
+    options = ReportOptions(
+        window_start(local_time(weather_data), window_hours), window_hours, FORECAST_DEFAULT_DAYS, aggregations
+    )
+    return build_sections(weather_data, options, ("irrigation", "forecast"))
+
+
+def forecast_summary(weather_data: dict) -> dict:
+    """Advice and forecast totals as /api serves them with default options (webhook change detection)"""
+    sections = default_sections(weather_data)
+    irrigation, forecast = sections["irrigation"], sections["forecast"]
+    return {
+        "needs_water": irrigation["needs_water"],
+        "advice": irrigation["advice_english"],
+        "soil_moisture": irrigation["current_level"],
+        "threshold": irrigation["threshold"],
+        "total_precipitation_mm": forecast.get("total_precipitation_mm"),
+        "window_hours": forecast["window_hours"],
+        "days": forecast["days"],
+    }
+
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Forecast cache hit/miss counters, upstream batching, change tracking and API key lookups"""
+    return {
+        **forecast_cache.stats(),
+        "upstream": upstream_batcher.stats(),
+        "changes": change_tracker.stats(),
+        "api_keys": api_key_store.stats(),
+        "users": user_store.stats(),
+    }
+
+
+async def component_metrics() -> List[Family]:
+    """Counters and gauges read from the components' stats() at scrape time"""
+    cache = forecast_cache.stats()
+    upstream = upstream_batcher.stats()
+    limits = limiter.stats()
+    email = await email_queue.stats()
+    keys = api_key_store.stats()
+    users = user_store.stats()
+    alerts = alert_engine.stats()
+    webhooks = webhook_dispatcher.stats()
+    changes = change_tracker.stats()
+    loop = loop_monitor.stats()
+    spans = tracer.exporter.stats() if tracer.exporter is not None else {"exported": 0, "dropped": 0}
+    return [
+        Family("tropometrics_forecast_cache_lookups_total", "counter", "Forecast cache lookups by result",
+               [({"result": result}, cache[result]) for result in ("hits", "stale_hits", "coalesced", "misses")]),
+        Family("tropometrics_forecast_cache_hit_ratio", "gauge",
+               "Share of lookups served without waiting for a fetch, since start", [({}, cache["hit_ratio"])]),
+        Family("tropometrics_forecast_cache_entries", "gauge", "Cached forecasts", [({}, cache["entries"])]),
+        Family("tropometrics_forecast_fetch_errors_total", "counter", "Failed forecast fetches and refreshes",
+               [({}, cache["refresh_errors"])]),
+        Family("tropometrics_upstream_batches_total", "counter", "Batched Open-Meteo requests",
+               [({}, upstream["batches"])]),
+        Family("tropometrics_upstream_lookups_total", "counter", "Locations looked up through batches",
+               [({}, upstream["lookups"])]),
+        Family("tropometrics_rate_limit_allowed_total", "counter", "Requests let through by the rate limiter",
+               [({}, limits["allowed"])]),
+        Family("tropometrics_rate_limit_rejections_total", "counter", "Requests rejected with 429, by limit scope",
+               [({"scope": scope}, count) for scope, count in limits["rejected"].items()]),
+        Family("tropometrics_emails_total", "counter", "Email deliveries by result",
+               [({"result": result}, email[result]) for result in ("sent", "retried", "failed")]),
+        Family("tropometrics_email_outbox_messages", "gauge", "Outbox messages by status",
+               [({"status": status}, count) for status, count in email["outbox"]["by_status"].items()]),
+        Family("tropometrics_api_key_cache_lookups_total", "counter", "API key lookups by cache result",
+               [({"result": "hit"}, keys["cache_hits"]), ({"result": "miss"}, keys["cache_misses"])]),
+        Family("tropometrics_profile_cache_lookups_total", "counter", "User profile lookups by cache result",
+               [({"result": "hit"}, users["cache_hits"]), ({"result": "miss"}, users["cache_misses"])]),
+        Family("tropometrics_alert_evaluations_total", "counter", "Subscription evaluations",
+               [({}, alerts["evaluations"])]),
+        Family("tropometrics_alerts_queued_total", "counter", "Alert emails queued", [({}, alerts["alerts_queued"])]),
+        Family("tropometrics_webhook_deliveries_total", "counter", "Webhook delivery attempts",
+               [({}, webhooks["deliveries"])]),
+        Family("tropometrics_webhook_events_total", "counter", "Webhook events by result",
+               [({"result": "delivered"}, webhooks["delivered_events"]),
+                ({"result": "failed"}, webhooks["failed_events"]),
+                ({"result": "dropped"}, webhooks["dropped_events"])]),
+        Family("tropometrics_webhook_pending_events", "gauge", "Webhook events waiting for delivery",
+               [({}, webhooks["pending_events"])]),
+        Family("tropometrics_forecast_diffs_total", "counter", "Forecast diffs by the change feed",
+               [({"meaningful": "false"}, changes["diffs"] - changes["meaningful_diffs"]),
+                ({"meaningful": "true"}, changes["meaningful_diffs"])]),
+        Family("tropometrics_change_feed_bytes", "gauge", "Bytes of forecast versions kept by the change feed",
+               [({}, changes["bytes"])]),
+        Family("tropometrics_event_loop_stalls_total", "counter",
+               f"Lag samples of at least {LOOP_STALL_THRESHOLD_MS:g}ms", [({}, loop["stalls"])]),
+        Family("tropometrics_event_loop_max_lag_seconds", "gauge", "Largest lag sampled since start",
+               [({}, loop["max_lag_seconds"])]),
+        Family("tropometrics_trace_spans_total", "counter", "Spans handed to the trace exporter by result",
+               [({"result": "exported"}, spans["exported"]), ({"result": "dropped"}, spans["dropped"])]),
+    ]
+
+
+metrics_registry.add_collector(component_metrics)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(content=await metrics_registry.render(), media_type=METRICS_CONTENT_TYPE)
+
+
+@app.get("/api/admin/profiles")
+@limiter.limit()
+async def list_profiles(request: Request, api_key: Optional[str] = None):
+    """Saved profile reports, newest first (admin keys)"""
+    client, key_error = await authenticate(api_key, "/api/admin/profiles")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    if not client.admin:
+        raise HTTPException(status_code=403, detail="Admin API key required")
+    return {
+        "backend": request_profiler.backend,
+        "profiles": request_profiler.profiles,
+        "keep": profile_ring.keep,
+        "sampler": stack_sampler.stats() if stack_sampler is not None else None,
+        "reports": await asyncio.to_thread(profile_ring.reports),
+    }
+
+
+@app.get("/api/admin/profiles/{report_id}")
+@limiter.limit()
+async def get_profile_report(request: Request, report_id: str, api_key: Optional[str] = None):
+    """One saved report: pyinstrument HTML, cProfile text or folded stacks (admin keys)"""
+    client, key_error = await authenticate(api_key, "/api/admin/profiles")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    if not client.admin:
+        raise HTTPException(status_code=403, detail="Admin API key required")
+    content = await asyncio.to_thread(profile_ring.read, report_id)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Unknown profile")
+    return Response(content=content, media_type=ReportRing.media_type(report_id),
+                    headers={"Cache-Control": "no-store"})
+
+
 @app.get("/api")
 @limiter.limit("30/minute")
-async def weather_data_api(request: Request, api_key: Optional[str] = None):
+async def weather_data_api(
+    request: Request,
+    api_key: Optional[str] = None,
+    response_format: Optional[str] = Query(None, alias="format"),
+    window: str = FORECAST_DEFAULT_WINDOW,
+    days: int = FORECAST_DEFAULT_DAYS,
+    agg: str = FORECAST_DEFAULT_AGGREGATION,
+    latitude: Optional[float] = None,
+    longitude: Optional[float] = None,
+    location_id: Optional[str] = Query(None, alias="location"),
+    fields: Optional[str] = None,
+    exclude: Optional[str] = None
+):
     """
     Weather Data API Endpoint
     Requires API key authentication via query parameter
     Usage: /api?api_key=YOUR_API_KEY
+    Format: compact JSON by default, HTML with ?format=html or Accept: text/html
+    Forecast: ?window=3h&days=7&agg=precipitation:sum,temperature_2m:max
+    Location: ?latitude=52.01&longitude=4.36 or ?location=<id> (default: the user's default, else WEATHER_LOCATION)
+    Projection: ?fields=irrigation.needs_water,forecast or ?exclude=raw_data
+    Keys with a user profile (/api/me) get its advice language, units, fields and default location
     """
-    # Check if api_key is provided
-    if not api_key:
-        return HTMLResponse(
-            content="""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <title>TropoMetrics Weather API</title>
-                <style>
-                    body { font-family: 'Monaco', monospace; background: #1e1e1e; color: #d4d4d4; padding: 20px; }
-                    pre { background: #252526; padding: 20px; border-radius: 8px; border: 1px solid #3e3e42; }
-                    .error { color: #f48771; }
-                </style>
-            </head>
-            <body>
-                <pre class="error">{
-  "error": true,
-  "status": 401,
-  "message": "Missing API key. Use: /api?api_key=YOUR_API_KEY",
-  "timestamp": "%s",
-  "service": "TropoMetrics Weather API"
-}</pre>
-            </body>
-            </html>
-            """ % datetime.utcnow().isoformat() + "Z",
-            status_code=401
-        )
-    
     # Validate API key
-    if api_key not in VALID_API_KEYS:
-        return HTMLResponse(
-            content="""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <title>TropoMetrics Weather API</title>
-                <style>
-                    body { font-family: 'Monaco', monospace; background: #1e1e1e; color: #d4d4d4; padding: 20px; }
-                    pre { background: #252526; padding: 20px; border-radius: 8px; border: 1px solid #3e3e42; }
-                    .error { color: #f48771; }
-                </style>
-            </head>
-            <body>
-                <pre class="error">{
-  "error": true,
-  "status": 401,
-  "message": "Invalid API key",
-  "timestamp": "%s",
-  "service": "TropoMetrics Weather API"
-}</pre>
-            </body>
-            </html>
-            """ % datetime.utcnow().isoformat() + "Z",
-            status_code=401
-        )
+    with span("auth"):
+        client, key_error = await authenticate(api_key, "/api")
+        profile = await user_store.profile(client.id) if client else None
+    if key_error:
+        return render(request, error_payload(401, key_error),
+                      status_code=401, variant="error", requested=response_format)
+    
+    # Validate location and forecast resampling options
+    try:
+        location = resolve_location(*profile_locations(profile), latitude, longitude, location_id)
+        window_hours, aggregations = parse_forecast_options(window, days, agg)
+        projection = FieldProjection(fields, exclude, ("metadata", *SECTIONS))
+    except ValueError as e:
+        return render(request, error_payload(400, str(e)),
+                      status_code=400, variant="error", requested=response_format)
+    access_error = plan_error(client, location, negotiate_format(request, response_format))
+    if access_error:
+        return render(request, error_payload(403, access_error),
+                      status_code=403, variant="error", requested=response_format)
     
     # Check if using test API key (return random data)
     if api_key == "test":
-        # Generate random weather data
-        current_temp = round(random.uniform(15.0, 30.0), 1)
-        soil_moisture = round(random.uniform(0.10, 0.20), 4)
-        needs_water = soil_moisture <= 0.14
-        
-        # Generate 5 random precipitation periods
-        precipitation_5days = []
-        for i in range(5):
-            precipitation_5days.append({
-                "period_hours": 6,
-                "precipitation_mm": round(random.uniform(0.0, 15.0), 2)
-            })
-        
-        api_response = {
-            "metadata": {
+        options = ReportOptions(window_start(datetime.utcnow(), window_hours), window_hours, days, aggregations)
+        api_response = {}
+        if projection.wants("metadata"):
+            api_response["metadata"] = {
                 "service": "TropoMetrics Weather API",
                 "version": "1.0.0",
                 "timestamp": datetime.utcnow().isoformat() + "Z",
-                "location": {
-                    "latitude": WEATHER_LOCATION['latitude'],
-                    "longitude": WEATHER_LOCATION['longitude'],
-                    "timezone": "Europe/Amsterdam"
-                },
+                "location": location_metadata(location),
                 "source": "Random Test Data (test API key)",
                 "endpoint": "/api"
-            },
-            "current": {
-                "temperature_celsius": current_temp,
-                "temperature_fahrenheit": round(current_temp * 9/5 + 32, 1),
-                "timestamp": datetime.utcnow().isoformat() + "Z"
-            },
-            "daily": {
-                "temperature_min_celsius": round(random.uniform(10.0, 18.0), 1),
-                "temperature_max_celsius": round(random.uniform(20.0, 35.0), 1),
-                "daylight_duration_seconds": random.randint(43200, 54000),
-                "daylight_hours": random.randint(12, 15),
-                "daylight_minutes": random.randint(0, 59),
-                "daylight_formatted": f"{random.randint(12, 15)}h {random.randint(0, 59)}m"
-            },
-            "moisture": {
-                "soil_moisture_27_to_81cm_percentage": round(soil_moisture * 100, 2),
-                "soil_moisture_raw": soil_moisture,
-                "relative_humidity_percentage": random.randint(40, 80),
-                "timestamp": datetime.utcnow().isoformat() + "Z"
-            },
-            "irrigation": {
-                "advice": "Geef water" if needs_water else "Water geven is nu niet nodig",
-                "advice_english": "Give water" if needs_water else "Watering not needed now",
-                "needs_water": needs_water,
-                "threshold": 0.14,
-                "current_level": soil_moisture
-            },
-            "forecast": {
-                "precipitation_5day": precipitation_5days,
-                "total_precipitation_mm": round(sum(p['precipitation_mm'] for p in precipitation_5days), 2),
-                "forecast_periods": len(precipitation_5days)
-            },
-            "raw_data": {
-                "note": "Random test data - not real measurements"
             }
-        }
-        
-        # Return as formatted HTML with JSON
-        import json
-        json_str = json.dumps(api_response, indent=2)
+        with api_stage("derivation"):
+            api_response.update(build_test_sections(options, projection.sections))
+            if profile is not None:
+                personalize(api_response, profile.language, profile.units)
+            api_response = projection.apply(api_response)
         
-        return HTMLResponse(
-            content=f"""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <title>TropoMetrics Weather API (Test Mode)</title>
-                <style>
-                    body {{ font-family: 'Monaco', monospace; background: #1e1e1e; color: #d4d4d4; padding: 20px; }}
-                    pre {{ background: #252526; padding: 20px; border-radius: 8px; border: 1px solid #3e3e42; overflow-x: auto; }}
-                    .header {{ color: #ce9178; margin-bottom: 20px; padding: 10px; background: #252526; border-radius: 8px; border-left: 4px solid #ce9178; }}
-                    .test-mode {{ color: #ce9178; font-weight: bold; }}
-                </style>
-            </head>
-            <body>
-                <div class="header">
-                    <h2>🌾 TropoMetrics Weather Data API</h2>
-                    <p class="test-mode">⚠️ TEST MODE - Random Generated Data</p>
-                </div>
-                <pre>{json_str}</pre>
-            </body>
-            </html>
-            """,
-            status_code=200
-        )
+        response = render_timed(request, api_response, negotiate_format(request, response_format), "test")
+        # Random data - nothing may cache it
+        response.headers["Cache-Control"] = "no-store"
+        return response
     
     # Fetch weather data from Open-Meteo API (for "demo" key)
     try:
-        logger.info("🌍 Calling Open-Meteo API")
-        
-        async with httpx.AsyncClient() as client:
-            api_request = (
-                f"https://api.open-meteo.com/v1/forecast"
-                f"?latitude={WEATHER_LOCATION['latitude']}"
-                f"&longitude={WEATHER_LOCATION['longitude']}"
-                f"&daily=temperature_2m_max,temperature_2m_min,daylight_duration"
-                f"&hourly=precipitation,relative_humidity_2m,soil_moisture_27_to_81cm"
-                f"&current=temperature_2m"
-                f"&timezone=Europe%2FAmsterdam"
+        with api_stage("upstream"):
+            forecast, served_stale = await get_forecast(
+                location, forecast_variables(aggregations), upstream_forecast_days(days)
             )
-            
-            response = await client.get(api_request)
-            response.raise_for_status()
-            weather_data = response.json()
-        
-        # Calculate derived values
-        now = datetime.utcnow()
-        time_hour = now.hour
-        if time_hour > 0:
-            time_hour -= time_hour % 6
+        weather_data = forecast.value
         
-        time_line_graph = 24 * 5 + time_hour
-        precipitation_5days = []
-        amount = 0.0
+        # Windows follow the location's local clock
+        local_now = local_time(weather_data)
+        start = window_start(local_now, window_hours)
         
-        for i in range(time_hour, min(time_line_graph, len(weather_data['hourly']['precipitation']))):
-            amount += weather_data['hourly']['precipitation'][i]
-            if (i % 6) == 0 and i != 0:
-                precipitation_5days.append({
-                    "period_hours": 6,
-                    "precipitation_mm": round(amount, 2)
-                })
-                amount = 0.0
-        
-        # Calculate irrigation advice
-        soil_moisture = weather_data['hourly']['soil_moisture_27_to_81cm'][0]
-        irrigation_advice = "Geef water" if soil_moisture <= 0.14 else "Water geven is nu niet nodig"
+        # Conditional request - the body only changes with the forecast version,
+        # the output format, the resampling options, the window the periods start from
+        # and the user's preferences
+        output_format = negotiate_format(request, response_format)
+        etag = make_etag(
+            forecast.version, output_format, window_hours, days,
+            ",".join(f"{v}.{h}" for v, h in aggregations), projection.key, f"{start:%Y%m%d%H}",
+            f"{profile.language}.{profile.units}" if profile else "default"
+        )
+        seconds_to_next_window = (start + timedelta(hours=window_hours) - local_now).total_seconds()
+        cache_headers = {
+            "ETag": etag,
+            "Cache-Control": cache_control(
+                0 if served_stale else min(forecast.fresh_until - time.monotonic(), seconds_to_next_window),
+                FORECAST_STALE_TTL
+            ),
+        }
+        if etag_matches(request, etag):
+            return not_modified(cache_headers)
         
-        # Build response
-        api_response = {
-            "metadata": {
+        # Build response - only the sections selected by ?fields= / ?exclude=
+        api_response = {}
+        if projection.wants("metadata"):
+            api_response["metadata"] = {
                 "service": "TropoMetrics Weather API",
                 "version": "1.0.0",
                 "timestamp": datetime.utcnow().isoformat() + "Z",
-                "location": {
-                    "latitude": WEATHER_LOCATION['latitude'],
-                    "longitude": WEATHER_LOCATION['longitude'],
-                    "timezone": "Europe/Amsterdam"
-                },
+                "location": location_metadata(location),
                 "source": "Open-Meteo API",
-                "endpoint": "/api"
-            },
-            "current": {
-                "temperature_celsius": weather_data['current']['temperature_2m'],
-                "temperature_fahrenheit": round(weather_data['current']['temperature_2m'] * 9/5 + 32, 1),
-                "timestamp": weather_data['current']['time']
-            },
-            "daily": {
-                "temperature_min_celsius": min(weather_data['daily']['temperature_2m_min']),
-                "temperature_max_celsius": max(weather_data['daily']['temperature_2m_max']),
-                "daylight_duration_seconds": weather_data['daily']['daylight_duration'][0],
-                "daylight_hours": round(weather_data['daily']['daylight_duration'][0] / 3600),
-                "daylight_minutes": round((weather_data['daily']['daylight_duration'][0] % 3600) / 60),
-                "daylight_formatted": f"{round(weather_data['daily']['daylight_duration'][0] / 3600)}h {round((weather_data['daily']['daylight_duration'][0] % 3600) / 60)}m"
-            },
-            "moisture": {
-                "soil_moisture_27_to_81cm_percentage": round(soil_moisture * 100, 2),
-                "soil_moisture_raw": soil_moisture,
-                "relative_humidity_percentage": weather_data['hourly']['relative_humidity_2m'][0],
-                "timestamp": datetime.utcnow().isoformat() + "Z"
-            },
-            "irrigation": {
-                "advice": irrigation_advice,
-                "advice_english": "Give water" if soil_moisture <= 0.14 else "Watering not needed now",
-                "needs_water": soil_moisture <= 0.14,
-                "threshold": 0.14,
-                "current_level": soil_moisture
-            },
-            "forecast": {
-                "precipitation_5day": precipitation_5days,
-                "total_precipitation_mm": round(sum(p['precipitation_mm'] for p in precipitation_5days), 2),
-                "forecast_periods": len(precipitation_5days)
-            },
-            "raw_data": {
-                "note": "Full hourly and daily data from Open-Meteo API",
-                "daily": weather_data['daily'],
-                "hourly_sample": {
-                    "precipitation_first_24h": weather_data['hourly']['precipitation'][:24],
-                    "relative_humidity_first_24h": weather_data['hourly']['relative_humidity_2m'][:24],
-                    "soil_moisture_first_24h": weather_data['hourly']['soil_moisture_27_to_81cm'][:24]
-                }
+                "endpoint": "/api",
+                "data_fetched_at": datetime.utcfromtimestamp(forecast.fetched_at).isoformat() + "Z",
+                "data_version": forecast.version,
+                "served_stale": served_stale
             }
-        }
-        
-        # Return as formatted HTML with JSON
-        import json
-        json_str = json.dumps(api_response, indent=2)
+        with api_stage("derivation"):
+            api_response.update(build_sections(
+                weather_data, ReportOptions(start, window_hours, days, aggregations), projection.sections
+            ))
+            if profile is not None:
+                personalize(api_response, profile.language, profile.units)
+            api_response = projection.apply(api_response)
         
-        return HTMLResponse(
-            content=f"""
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <title>TropoMetrics Weather API</title>
-                <style>
-                    body {{ font-family: 'Monaco', monospace; background: #1e1e1e; color: #d4d4d4; padding: 20px; }}
-                    pre {{ background: #252526; padding: 20px; border-radius: 8px; border: 1px solid #3e3e42; overflow-x: auto; }}
-                    .header {{ color: #4ec9b0; margin-bottom: 20px; padding: 10px; background: #252526; border-radius: 8px; border-left: 4px solid #4ec9b0; }}
-                </style>
-            </head>
-            <body>
-                <div class="header">
-                    <h2>🌾 TropoMetrics Weather Data API</h2>
-                    <p>Real-time weather data for agricultural sector</p>
-                </div>
-                <pre>{json_str}</pre>
-            </body>
-            </html>
-            """,
-            status_code=200
-        )
+        response = render_timed(request, api_response, output_format)
+        response.headers.update(cache_headers)
+        return response
         
     except httpx.HTTPError as e:
         logger.error(f"Failed to fetch weather data: {str(e)}")
@@ -420,11 +1097,555 @@ async def weather_data_api(request: Request, api_key: Optional[str] = None):
         )
 
 
-@app.post("/api/send-email")
+@app.get("/api/changes")
+@limiter.limit("30/minute")
+async def weather_changes_api(
+    request: Request,
+    api_key: Optional[str] = None,
+    since: Optional[str] = None,
+    response_format: Optional[str] = Query(None, alias="format"),
+    window: str = FORECAST_DEFAULT_WINDOW,
+    days: int = FORECAST_DEFAULT_DAYS,
+    agg: str = FORECAST_DEFAULT_AGGREGATION,
+    latitude: Optional[float] = None,
+    longitude: Optional[float] = None,
+    location_id: Optional[str] = Query(None, alias="location")
+):
+    """
+    Forecast Change Feed
+    Changes since a forecast version, so clients refresh without reloading /api
+    Usage: /api/changes?api_key=YOUR_API_KEY&since=<metadata.data_version>
+    Location, window, days and agg select the same forecast as on /api (including
+    the user's fields and default location)
+    Each change set lists changed hourly cells within the requested days, deltas
+    of the requested window aggregations and an irrigation advice flip.
+    An unknown or expired version returns 410 - reload /api.
+    """
+    client, key_error = await authenticate(api_key, "/api/changes")
+    profile = await user_store.profile(client.id) if client else None
+    if key_error:
+        return render(request, error_payload(401, key_error),
+                      status_code=401, variant="error", requested=response_format)
+    if api_key == "test":
+        return render(request, error_payload(400, "The change feed needs live data, use the demo key"),
+                      status_code=400, variant="error", requested=response_format)
+
+    try:
+        location = resolve_location(*profile_locations(profile), latitude, longitude, location_id)
+        window_hours, aggregations = parse_forecast_options(window, days, agg)
+    except ValueError as e:
+        return render(request, error_payload(400, str(e)),
+                      status_code=400, variant="error", requested=response_format)
+    access_error = plan_error(client, location, negotiate_format(request, response_format))
+    if access_error:
+        return render(request, error_payload(403, access_error),
+                      status_code=403, variant="error", requested=response_format)
+
+    variables, forecast_days = forecast_variables(aggregations), upstream_forecast_days(days)
+    try:
+        # Keeps the key warm, so the refresher keeps diffing it
+        forecast, served_stale = await get_forecast(location, variables, forecast_days)
+    except httpx.HTTPError as e:
+        logger.error(f"Failed to fetch weather data: {str(e)}")
+        return render(request, error_payload(503, f"Failed to fetch weather data: {str(e)}"),
+                      status_code=503, variant="error", requested=response_format)
+
+    key = forecast_key(location, variables, forecast_days)
+    # No-op when tracked already; seeds the baseline for keys the tracker dropped
+    change_tracker.on_forecast(key, forecast)
+    result = change_tracker.changes_since(key, since, window_hours, days, aggregations)
+    if result is None:
+        return render(request, error_payload(410, "Unknown or expired version, reload /api for a new data_version"),
+                      status_code=410, variant="error", requested=response_format)
+    version, change_sets = result
+
+    output_format = negotiate_format(request, response_format)
+    # Built from server-side versions only - since is client input
+    first = change_sets[0].previous_version if change_sets else "none"
+    etag = make_etag(
+        version, first, len(change_sets), output_format, window_hours, days,
+        ",".join(f"{v}.{h}" for v, h in aggregations), f"{datetime.utcnow():%Y%m%d%H}"
+    )
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control(
+            0 if served_stale else forecast.fresh_until - time.monotonic(), FORECAST_STALE_TTL
+        ),
+    }
+    if etag_matches(request, etag):
+        return not_modified(cache_headers)
+
+    payload = {
+        "metadata": {
+            "service": "TropoMetrics Weather API",
+            "version": "1.0.0",
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "location": location_metadata(location),
+            "endpoint": "/api/changes",
+            "since": since,
+            "data_version": version,
+            "data_fetched_at": datetime.utcfromtimestamp(forecast.fetched_at).isoformat() + "Z",
+            "served_stale": served_stale
+        },
+        "changes": [change.to_dict() for change in change_sets],
+    }
+    response = render(request, payload, requested=output_format)
+    response.headers.update(cache_headers)
+    return response
+
+
+@app.post("/api/batch")
+@limiter.limit("10/minute")
+async def weather_batch_api(request: Request, batch: BatchRequest, api_key: Optional[str] = None):
+    """
+    Batch Weather Data Endpoint
+    Evaluates many locations in one round trip, streamed as NDJSON (one line per
+    location, in completion order, each tagged with its index in the request).
+    A location that fails gets an error line with its status instead of a report.
+    
+    Request body:
+    {
+        "locations": [{"latitude": 52.01, "longitude": 4.36}, {"location": "field-1"}],
+        "sections": ["current", "moisture", "irrigation", "forecast"],
+        "window": "6h", "days": 5, "agg": "precipitation:sum"
+    }
+    """
+    client, key_error = await authenticate(api_key, "/api/batch")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    # The user's fields resolve as location ids, as on /api
+    locations = profile_locations(await user_store.profile(client.id) if client else None)
+    
+    try:
+        window_hours, aggregations = parse_forecast_options(batch.window, batch.days, batch.agg)
+        unknown = [name for name in batch.sections if name not in SECTIONS]
+        if unknown:
+            raise ValueError(f"Unknown section(s): {', '.join(unknown)}")
+    except ValueError as e:
+        return json_response(error_payload(400, str(e)), status_code=400)
+    
+    variables = forecast_variables(aggregations)
+    forecast_days = upstream_forecast_days(batch.days)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    # One lookup task per grid cell - identical upstream lookups are only awaited once
+    lookups = {}
+    
+    async def lookup(location: dict):
+        async with semaphore:
+            return await get_forecast(location, variables, forecast_days)
+    
+    async def evaluate(index: int, item: BatchLocation) -> dict:
+        try:
+            location = resolve_location(*locations, item.latitude, item.longitude, item.location)
+        except ValueError as e:
+            return {"index": index, **error_payload(400, str(e))}
+        access_error = plan_error(client, location)
+        if access_error:
+            return {"index": index, **error_payload(403, access_error)}
+        
+        result = {"index": index, "status": 200, "location": location_metadata(location)}
+        if api_key == "test":
+            options = ReportOptions(window_start(datetime.utcnow(), window_hours), window_hours, batch.days, aggregations)
+            return {**result, **build_test_sections(options, batch.sections)}
+        
+        key = forecast_key(location, variables, forecast_days)
+        if key not in lookups:
+            lookups[key] = asyncio.ensure_future(lookup(location))
+        try:
+            forecast, served_stale = await lookups[key]
+        except httpx.HTTPError as e:
+            return {"index": index, **error_payload(503, f"Failed to fetch weather data: {str(e)}")}
+        
+        weather_data = forecast.value
+        options = ReportOptions(window_start(local_time(weather_data), window_hours), window_hours, batch.days, aggregations)
+        result["served_stale"] = served_stale
+        return {**result, **build_sections(weather_data, options, batch.sections)}
+    
+    async def evaluate_or_error(index: int, item: BatchLocation) -> dict:
+        # Every location gets its line - an unexpected failure becomes an error line
+        try:
+            return await evaluate(index, item)
+        except Exception as e:
+            logger.error(f"Batch item {index} failed: {str(e)}")
+            return {"index": index, **error_payload(500, "Failed to evaluate location")}
+    
+    async def stream():
+        tasks = [asyncio.ensure_future(evaluate_or_error(i, item)) for i, item in enumerate(batch.locations)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield orjson.dumps(await next_done) + b"\n"
+        finally:
+            # Client went away - stop work nobody will read
+            for task in [*tasks, *lookups.values()]:
+                task.cancel()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def subscription_payload(subscription: Subscription) -> dict:
+    """Subscription with the advice it currently gets (None until a forecast is known)"""
+    group = subscription_registry.group(subscription_registry.key_for(subscription))
+    return {
+        **subscription.to_dict(),
+        "needs_water": group.needs_water(subscription) if group else None,
+        "url": f"/api/subscriptions/{subscription.id}",
+    }
+
+
+@state_router.post("/api/subscriptions", status_code=201)
+@limiter.limit("10/minute")
+async def create_subscription(request: Request, subscription: SubscriptionRequest, api_key: Optional[str] = None):
+    """
+    Subscribe to irrigation alerts for a location
+    An email is sent whenever the advice (soil moisture <= threshold) changes,
+    once the recipient opened the link in the confirmation email (double opt-in).
+    
+    Request body:
+    {
+        "email": "farmer@example.com",
+        "location": "field-1",          (or "latitude"/"longitude")
+        "threshold": 0.14
+    }
+    """
+    client, key_error = await authenticate(api_key, "/api/subscriptions")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    try:
+        # The caller's own field ids resolve like they do on /api
+        location = resolve_location(
+            *profile_locations(await user_store.profile(client.id)),
+            subscription.latitude, subscription.longitude, subscription.location
+        )
+    except ValueError as e:
+        return json_response(error_payload(400, str(e)), status_code=400)
+    access_error = plan_error(client, location)
+    if access_error:
+        return json_response(error_payload(403, access_error), status_code=403)
+    
+    entry = Subscription(
+        recipient=subscription.email,
+        latitude=location['latitude'],
+        longitude=location['longitude'],
+        threshold=subscription.threshold,
+        location_id=location.get('id'),
+        owner=client.id,
+    )
+    # The confirmation goes to an unverified address - same budget as /api/send-email
+    await limiter.consume(entry.recipient.lower(), EMAIL_RECIPIENT_RATE, "recipient")
+    token = entry.issue_token()
+    await subscription_registry.add(entry)
+    base_url = PUBLIC_BASE_URL or str(request.base_url).rstrip("/")
+    if not PUBLIC_BASE_URL:
+        alert_engine.base_url = base_url
+    try:
+        await email_queue.submit(
+            entry.recipient,
+            f"Confirm your TropoMetrics irrigation alerts for {entry.label}",
+            "Someone subscribed this address to irrigation alerts for "
+            f"{entry.label}.\n\nOpen this link to start receiving them:\n"
+            f"{base_url}/api/subscriptions/{entry.id}/confirm?token={token}\n\n"
+            "No alerts are sent until then. If this wasn't you, ignore this email.\n\nTropoMetrics",
+            False, f"confirm:{entry.id}"
+        )
+    except QueueFullError:
+        await subscription_registry.remove(entry.id)
+        raise HTTPException(status_code=503, detail="Email service busy. Please try again later.")
+    
+    logger.info(f"Subscription {entry.id} created for {entry.recipient} at {entry.label}")
+    return json_response(subscription_payload(entry), status_code=201)
+
+
+@state_router.get("/api/subscriptions/{subscription_id}")
+@limiter.limit()
+async def get_subscription(request: Request, subscription_id: str, api_key: Optional[str] = None):
+    """Subscription details and current advice"""
+    client, key_error = await authenticate(api_key, "/api/subscriptions")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    entry = subscription_registry.get(subscription_id)
+    if entry is None or not owns(client, entry.owner):
+        raise HTTPException(status_code=404, detail="Unknown subscription")
+    return json_response(subscription_payload(entry))
+
+
+@state_router.get("/api/subscriptions/{subscription_id}/confirm")
+@limiter.limit("10/minute")
+async def confirm_subscription(request: Request, subscription_id: str, token: str = ""):
+    """
+    Opt-in link from the confirmation email - no API key, the token proves the mailbox
+    Only now is the forecast kept refreshed; links older than SUBSCRIPTION_CONFIRM_HOURS are void.
+    """
+    entry = subscription_registry.get(subscription_id)
+    if entry is None or not entry.check_token(token) or not subscription_registry.confirmable(entry):
+        raise HTTPException(status_code=404, detail="Unknown confirmation link")
+    if not entry.confirmed:
+        await subscription_registry.confirm(entry)
+        key = subscription_registry.key_for(entry)
+        forecast_cache.pin(key, forecast_fetcher(key))
+        try:
+            # Establish the current advice so the first alert is a real change
+            cached, _ = await forecast_cache.get_or_fetch(key, forecast_fetcher(key))
+            alert_engine.on_forecast(key, cached)
+        except Exception as e:
+            logger.warning(f"No forecast yet for subscription {entry.id}: {str(e)}")
+        logger.info(f"Subscription {entry.id} confirmed")
+    return json_response({"id": entry.id, "location": entry.label, "confirmed": True})
+
+
+async def remove_subscription(subscription_id: str) -> bool:
+    """Delete a subscription and its pending alerts; its forecast goes cold when nothing else watches it"""
+    removed = await subscription_registry.remove(subscription_id)
+    if removed is None:
+        return False
+    entry, key, last = removed
+    alert_engine.forget(entry)
+    if last and not webhook_registry.group(key):
+        forecast_cache.unpin(key)
+    logger.info(f"Subscription {subscription_id} deleted")
+    return True
+
+
+@state_router.get("/api/subscriptions/{subscription_id}/unsubscribe")
+@limiter.limit("10/minute")
+async def unsubscribe(request: Request, subscription_id: str, token: str = ""):
+    """Unsubscribe link from every alert email - no API key, the token comes with the email"""
+    entry = subscription_registry.get(subscription_id)
+    if entry is None or not entry.check_unsubscribe_token(token):
+        raise HTTPException(status_code=404, detail="Unknown unsubscribe link")
+    if not await remove_subscription(subscription_id):
+        raise HTTPException(status_code=404, detail="Unknown unsubscribe link")
+    return json_response({"id": entry.id, "location": entry.label, "unsubscribed": True})
+
+
+@state_router.delete("/api/subscriptions/{subscription_id}", status_code=204)
+@limiter.limit()
+async def delete_subscription(request: Request, subscription_id: str, api_key: Optional[str] = None):
+    """Unsubscribe from irrigation alerts"""
+    client, key_error = await authenticate(api_key, "/api/subscriptions")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    entry = subscription_registry.get(subscription_id)
+    if entry is None or not owns(client, entry.owner):
+        raise HTTPException(status_code=404, detail="Unknown subscription")
+    if not await remove_subscription(subscription_id):
+        raise HTTPException(status_code=404, detail="Unknown subscription")
+    return Response(status_code=204)
+
+
+@state_router.post("/api/webhooks", status_code=201)
+@limiter.limit("10/minute")
+async def create_webhook(request: Request, registration: WebhookRequest, api_key: Optional[str] = None):
+    """
+    Register a webhook for advice and forecast changes at a location
+    Events are POSTed as signed JSON batches, see README (Webhooks).
+    The URL must use https and resolve to public addresses only.
+    The secret is only returned in this response.
+    
+    Request body:
+    {
+        "url": "https://farm.example.com/hooks/tropometrics",
+        "location": "field-1",          (or "latitude"/"longitude")
+        "events": ["advice", "forecast"]
+    }
+    """
+    client, key_error = await authenticate(api_key, "/api/webhooks")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    try:
+        # The caller's own field ids resolve like they do on /api
+        location = resolve_location(
+            *profile_locations(await user_store.profile(client.id)),
+            registration.latitude, registration.longitude, registration.location
+        )
+        unknown = [name for name in registration.events if name not in WEBHOOK_EVENTS]
+        if unknown or not registration.events:
+            raise ValueError(f"events must be a non-empty subset of: {', '.join(WEBHOOK_EVENTS)}")
+    except ValueError as e:
+        return json_response(error_payload(400, str(e)), status_code=400)
+    access_error = plan_error(client, location)
+    if access_error:
+        return json_response(error_payload(403, access_error), status_code=403)
+    try:
+        await resolve_target(str(registration.url), webhook_dispatcher.allow_local)
+    except WebhookUrlError as e:
+        return json_response(error_payload(400, str(e)), status_code=400)
+    except OSError:
+        return json_response(error_payload(400, "Webhook host does not resolve"), status_code=400)
+    
+    webhook = Webhook(
+        url=str(registration.url),
+        secret=registration.secret or new_secret(),
+        events=",".join(dict.fromkeys(registration.events)),
+        latitude=location['latitude'],
+        longitude=location['longitude'],
+        location_id=location.get('id'),
+        owner=client.id,
+    )
+    key = await webhook_registry.add(webhook)
+    forecast_cache.pin(key, forecast_fetcher(key))
+    try:
+        # Baseline for change detection, so the first event is a real change
+        cached, _ = await forecast_cache.get_or_fetch(key, forecast_fetcher(key))
+        webhook_dispatcher.prime(key, cached)
+    except Exception as e:
+        logger.warning(f"No forecast yet for webhook {webhook.id}: {str(e)}")
+    
+    logger.info(f"Webhook {webhook.id} registered for {webhook.url}")
+    return json_response(
+        {**webhook.to_dict(include_secret=True), "status_url": f"/api/webhooks/{webhook.id}"},
+        status_code=201
+    )
+
+
+@state_router.get("/api/webhooks/{webhook_id}")
+@limiter.limit()
+async def get_webhook(request: Request, webhook_id: str, api_key: Optional[str] = None):
+    """Webhook registration and its last delivery result"""
+    client, key_error = await authenticate(api_key, "/api/webhooks")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    webhook = webhook_registry.get(webhook_id)
+    if webhook is None or not owns(client, webhook.owner):
+        raise HTTPException(status_code=404, detail="Unknown webhook")
+    return json_response({**webhook.to_dict(), "delivery": webhook_dispatcher.status(webhook)})
+
+
+@state_router.delete("/api/webhooks/{webhook_id}", status_code=204)
+@limiter.limit()
+async def delete_webhook(request: Request, webhook_id: str, api_key: Optional[str] = None):
+    """Remove a webhook, pending events are dropped"""
+    client, key_error = await authenticate(api_key, "/api/webhooks")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    webhook = webhook_registry.get(webhook_id)
+    if webhook is None or not owns(client, webhook.owner):
+        raise HTTPException(status_code=404, detail="Unknown webhook")
+    removed = await webhook_registry.remove(webhook_id)
+    if removed is None:
+        raise HTTPException(status_code=404, detail="Unknown webhook")
+    webhook, key, last = removed
+    webhook_dispatcher.forget(webhook, key, last)
+    if last and not subscription_registry.watched(key):
+        forecast_cache.unpin(key)
+    logger.info(f"Webhook {webhook_id} deleted")
+    return Response(status_code=204)
+
+
+@state_router.get("/api/me")
+@limiter.limit()
+async def get_profile(request: Request, api_key: Optional[str] = None):
+    """User profile of the API key: preferences, farms and fields"""
+    client, key_error = await authenticate(api_key, "/api/me")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    profile = await user_store.profile(client.id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="No user for this API key, create one with PUT /api/me")
+    return json_response(profile.to_dict())
+
+
+@state_router.put("/api/me")
+@limiter.limit("10/minute")
+async def save_profile(request: Request, user: UserRequest, api_key: Optional[str] = None):
+    """
+    Create or update the user of the API key
+    
+    Request body:
+    {
+        "email": "farmer@example.com",
+        "name": "Farm 1",
+        "units": "metric",              (or "imperial")
+        "language": "nl",               (or "en" - language of irrigation.advice)
+        "default_location": "field-1"   (a field id or "lat,lon")
+    }
+    """
+    client, key_error = await authenticate(api_key, "/api/me")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    if user.default_location is not None:
+        known, _ = profile_locations(await user_store.profile(client.id))
+        if parse_default_location(user.default_location, known) is None:
+            return json_response(
+                error_payload(400, f"Unknown default_location '{user.default_location}'"), status_code=400
+            )
+    try:
+        profile = await user_store.save_user(
+            client.id, user.email, user.name, user.units, user.language, user.default_location
+        )
+    except ValueError as e:
+        return json_response(error_payload(400, str(e)), status_code=400)
+    return json_response(profile.to_dict())
+
+
+@state_router.delete("/api/me", status_code=204)
+@limiter.limit()
+async def delete_profile(request: Request, api_key: Optional[str] = None):
+    """Remove the user of the API key with its farms and fields (the key stays valid)"""
+    client, key_error = await authenticate(api_key, "/api/me")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    if not await user_store.delete_user(client.id):
+        raise HTTPException(status_code=404, detail="No user for this API key")
+    return Response(status_code=204)
+
+
+@state_router.post("/api/me/farms", status_code=201)
+@limiter.limit("10/minute")
+async def create_farm(request: Request, farm: FarmRequest, api_key: Optional[str] = None):
+    """Add a farm to the user of the API key"""
+    client, key_error = await authenticate(api_key, "/api/me")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    farm_id = await user_store.add_farm(client.id, farm.name)
+    if farm_id is None:
+        raise HTTPException(status_code=404, detail="No user for this API key, create one with PUT /api/me")
+    return json_response({"id": farm_id, "name": farm.name, "fields": []}, status_code=201)
+
+
+@state_router.post("/api/me/farms/{farm_id}/fields", status_code=201)
+@limiter.limit("10/minute")
+async def create_field(request: Request, farm_id: str, field: FieldRequest, api_key: Optional[str] = None):
+    """Add a field to one of the user's farms"""
+    client, key_error = await authenticate(api_key, "/api/me")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    field_id = await user_store.add_field(client.id, farm_id, field.name, field.latitude, field.longitude)
+    if field_id is None:
+        raise HTTPException(status_code=404, detail="Unknown farm")
+    return json_response({"id": field_id, "farm_id": farm_id, **field.model_dump()}, status_code=201)
+
+
+@state_router.delete("/api/me/fields/{field_id}", status_code=204)
+@limiter.limit()
+async def delete_field(request: Request, field_id: str, api_key: Optional[str] = None):
+    """Remove one of the user's fields"""
+    client, key_error = await authenticate(api_key, "/api/me")
+    if key_error:
+        return json_response(error_payload(401, key_error), status_code=401)
+    if not await user_store.remove_field(client.id, field_id):
+        raise HTTPException(status_code=404, detail="Unknown field")
+    return Response(status_code=204)
+
+
+@state_router.post("/api/send-email", status_code=202)
 @limiter.limit("5/minute")
-async def send_email(request: Request, email: EmailRequest):
+async def send_email(
+    request: Request,
+    email: EmailRequest,
+    api_key: Optional[str] = None,
+    idempotency_key: Optional[str] = Header(None, max_length=200)
+):
     """
-    Send an email via SMTP
+    Queue an email for delivery via SMTP
+    Returns 202 with a message id once the email is stored in the outbox,
+    delivery happens in the background.
+    Status: GET /api/send-email/{message_id}
+    Idempotency-Key header: resubmissions with the same key return the
+    original message id instead of sending again. Keys are scoped to the
+    api_key when one is given, else to the client address; reusing a key
+    for a different email returns 422.
+    Each recipient address gets at most EMAIL_RECIPIENT_RATE_LIMIT emails
+    (shared with subscription confirmations), else 429.
     
     Request body:
     {
@@ -443,52 +1664,103 @@ async def send_email(request: Request, email: EmailRequest):
             detail="Email service not configured. Contact administrator."
         )
     
-    try:
-        # Create message
-        msg = MIMEMultipart("alternative")
-        msg["From"] = EMAIL_USERNAME
-        msg["To"] = email.to
-        msg["Subject"] = email.subject
-        
-        # Add body
-        if email.html:
-            msg.attach(MIMEText(email.body, "html"))
-        else:
-            msg.attach(MIMEText(email.body, "plain"))
-        
-        # Connect to SMTP server
-        logger.info(f"Connecting to {SMTP_HOST}:{SMTP_PORT}")
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-            server.send_message(msg)
-        
-        logger.info(f"Email sent successfully to {email.to}")
-        return {
-            "status": "success",
-            "message": f"Email sent to {email.to}"
-        }
-    
-    except smtplib.SMTPAuthenticationError:
-        logger.error("SMTP authentication failed")
-        raise HTTPException(
-            status_code=401,
-            detail="Email authentication failed. Check credentials."
-        )
+    # Idempotency keys of one sender never match another sender's
+    scope = f"ip:{client_address(request, TRUSTED_PROXY_HOPS, TRUSTED_PROXIES)}"
+    if api_key:
+        client, key_error = await authenticate(api_key, "/api/send-email")
+        if key_error:
+            return json_response(error_payload(401, key_error), status_code=401)
+        scope = f"key:{client.id}"
+    await limiter.consume(email.to.lower(), EMAIL_RECIPIENT_RATE, "recipient")
     
-    except smtplib.SMTPException as e:
-        logger.error(f"SMTP error: {str(e)}")
+    try:
+        with span("outbox"):
+            message_id, duplicate = await email_queue.submit(
+                email.to, email.subject, email.body, email.html, idempotency_key, scope
+            )
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except QueueFullError:
+        logger.error("Email queue is full")
         raise HTTPException(
-            status_code=500,
-            detail=f"Failed to send email: {str(e)}"
+            status_code=503,
+            detail="Email service busy. Please try again later."
         )
     
-    except Exception as e:
-        logger.error(f"Unexpected error: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail="Internal server error"
-        )
+    if duplicate:
+        logger.info(f"Email {message_id} already queued for idempotency key {idempotency_key}")
+    else:
+        logger.info(f"Email {message_id} queued for {email.to}")
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "queued",
+            "message": f"Email queued for {email.to}",
+            "message_id": message_id,
+            "duplicate": duplicate,
+            "status_url": f"/api/send-email/{message_id}"
+        }
+    )
+
+
+@state_router.get("/api/send-email/{message_id}")
+async def email_status(message_id: str):
+    """
+    Delivery status of a queued email
+    The random message id is the only handle on a message; the status leaves out the recipient.
+    """
+    job = await email_queue.status(message_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown message id")
+    return job.to_dict()
+
+
+# Internal endpoints - called by the API replicas, not proxied by nginx
+
+def check_state_token(token: Optional[str]):
+    """Only callers with STATE_SERVICE_TOKEN may use the internal endpoints"""
+    if not STATE_SERVICE_TOKEN or not secrets.compare_digest(token or "", STATE_SERVICE_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid state service token")
+
+
+@state_router.get("/internal/api-keys/{digest}")
+async def internal_api_key(digest: str, token: Optional[str] = Header(None, alias=STATE_TOKEN_HEADER)):
+    """Lookup row of a key hash for RemoteApiKeyStore, 404 when unknown or revoked"""
+    check_state_token(token)
+    row = await api_key_store.lookup_row(digest)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Unknown API key")
+    return {"row": list(row)}
+
+
+@state_router.post("/internal/api-keys/usage", status_code=204)
+async def internal_api_key_usage(usage: UsageRows, token: Optional[str] = Header(None, alias=STATE_TOKEN_HEADER)):
+    """Usage counters flushed by an API replica, written with the next local flush"""
+    check_state_token(token)
+    api_key_store.merge_usage(usage.rows)
+    return Response(status_code=204)
+
+
+@state_router.get("/internal/users/version")
+async def internal_users_version(token: Optional[str] = Header(None, alias=STATE_TOKEN_HEADER)):
+    """Changes whenever cached profiles may be stale, polled by RemoteUserStore"""
+    check_state_token(token)
+    return {"version": user_store.version()}
+
+
+@state_router.get("/internal/users/{api_key_id}")
+async def internal_user(api_key_id: str, token: Optional[str] = Header(None, alias=STATE_TOKEN_HEADER)):
+    """Profile of an API key id for RemoteUserStore, 404 when the key has no user"""
+    check_state_token(token)
+    profile = await user_store.profile(api_key_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="No user for this API key")
+    return profile.to_dict()
+
+
+# Stateful endpoints are only served where the state lives
+if OWNS_STATE:
+    app.include_router(state_router)
 
 
 if __name__ == "__main__":
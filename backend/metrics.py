@@ -0,0 +1,234 @@
+"""
+Prometheus metrics
+- Counters and histograms on the request path are plain dict updates: everything
+  runs on the event loop, so no locks are needed
+- Component state (cache, limiter, queues, stores) is read from the components'
+  stats() when /metrics is scraped, costing nothing per request
+- Rendered in the Prometheus text exposition format 0.0.4, no client library needed
+"""
+
+import bisect
+import inspect
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple, Union
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds - from cached responses (sub-millisecond) to slow upstream calls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (labels, value)
+Sample = Tuple[Dict[str, str], float]
+
+
+@dataclass
+class Family:
+    """One metric family as collected at scrape time (gauge or counter)"""
+    name: str
+    kind: str
+    documentation: str
+    samples: List[Sample] = field(default_factory=list)
+
+    def lines(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {_escape_help(self.documentation)}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in self.samples:
+            yield f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+
+
+# collector() -> families, sync or async (e.g. stats() that reads a database)
+Collector = Callable[[], Union[Iterable[Family], Awaitable[Iterable[Family]]]]
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value != value:
+        return "NaN"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """Monotonic counter per label combination"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def lines(self) -> Iterable[str]:
+        return Family(self.name, self.kind, self.documentation, [
+            (dict(zip(self.labelnames, labels)), value) for labels, value in self._values.items()
+        ]).lines()
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label combination"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count per bucket (+Inf last), sum]
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        # Buckets are upper bounds (le), so a value equal to a bound falls in that bucket
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the duration of the with-block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def lines(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {_escape_help(self.documentation)}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self._series.items():
+            names = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = _format_labels({**names, "le": _format_value(bound)})
+                yield f"{self.name}_bucket{le} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(names)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(names)} {cumulative}"
+
+
+class Registry:
+    """Metrics updated in place plus collectors called on every scrape"""
+
+    def __init__(self):
+        self._metrics: List[Union[Counter, Histogram]] = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Collector):
+        self._collectors.append(collector)
+
+    async def render(self) -> bytes:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.lines())
+        for collector in self._collectors:
+            families = collector()
+            if inspect.isawaitable(families):
+                families = await families
+            for family in families:
+                lines.extend(family.lines())
+        return ("\n".join(lines) + "\n").encode()
+
+
+class RequestMetrics:
+    """Request count, latency and concurrency per route template, method and status"""
+
+    def __init__(self, registry: Registry, prefix: str,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.requests = registry.counter(
+            f"{prefix}_http_requests_total", "HTTP requests by route, method and status",
+            ("route", "method", "status"),
+        )
+        self.latency = registry.histogram(
+            f"{prefix}_http_request_duration_seconds",
+            "Time from receiving a request until its response body is sent",
+            ("route", "method", "status"), buckets,
+        )
+        self.in_flight = 0
+        registry.add_collector(lambda: [Family(
+            f"{prefix}_http_requests_in_flight", "gauge", "Requests currently being handled",
+            [({}, self.in_flight)],
+        )])
+
+    def observe(self, route: str, method: str, status: int, seconds: float):
+        labels = (route, method, str(status))
+        self.requests.inc(*labels)
+        self.latency.observe(seconds, *labels)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware feeding RequestMetrics. Requests are labelled with the
+    matched route template (/api/me/fields/{field_id}), never the raw path,
+    so the number of series stays bounded.
+    """
+
+    def __init__(self, app, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.metrics.in_flight -= 1
+            # The router stores the matched route in the (shared) scope
+            route = scope.get("route")
+            self.metrics.observe(
+                getattr(route, "path", "unmatched"), scope["method"], status, time.perf_counter() - start
+            )
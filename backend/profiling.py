@@ -0,0 +1,293 @@
+"""
+Profiling for production pods
+- A single request runs under a profiler when an admin API key asks for it
+  (?profile=1 or X-Profile: 1); the report is saved, or returned instead of
+  the response with ?profile=inline
+- pyinstrument (statistical, follows the request across awaits) when
+  installed, cProfile otherwise - cProfile sees everything the loop runs
+  while the request is in flight, not only the request itself
+- An optional sampler thread records the event loop thread's stack at a
+  fixed interval and periodically writes folded stacks (flamegraph.pl,
+  speedscope, inferno)
+- Reports go to a bounded directory ring: the oldest are deleted beyond keep
+"""
+
+import asyncio
+import cProfile
+import importlib.util
+import io
+import logging
+import os
+import pstats
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import parse_qs
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("1", "true", "save", "inline")
+_REPORT_ID = re.compile(r"^[0-9T]{15}-[0-9a-f]{8}\.(html|txt|folded)$")
+_MEDIA_TYPES = {
+    "html": "text/html; charset=utf-8",
+    "txt": "text/plain; charset=utf-8",
+    "folded": "text/plain; charset=utf-8",
+}
+
+
+class ReportRing:
+    """Profile reports in one directory, at most keep of them"""
+
+    def __init__(self, directory: str, keep: int = 50):
+        self.directory = directory
+        self.keep = keep
+        # Written from the loop's worker threads and the sampler thread
+        self._lock = threading.Lock()
+        self.saved = 0
+
+    @staticmethod
+    def new_id(extension: str) -> str:
+        return f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{secrets.token_hex(4)}.{extension}"
+
+    def save(self, report_id: str, content: bytes):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, report_id), "wb") as f:
+                f.write(content)
+            self.saved += 1
+            # Ids start with the UTC time, so name order is age order
+            reports = sorted(name for name in os.listdir(self.directory) if _REPORT_ID.match(name))
+            for name in reports[:max(len(reports) - self.keep, 0)]:
+                os.remove(os.path.join(self.directory, name))
+
+    def read(self, report_id: str) -> Optional[bytes]:
+        """A saved report, None for unknown (or deleted) and malformed ids"""
+        if not _REPORT_ID.match(report_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, report_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def reports(self) -> List[dict]:
+        if not os.path.isdir(self.directory):
+            return []
+        return [
+            {"id": name, "bytes": os.path.getsize(os.path.join(self.directory, name))}
+            for name in sorted(os.listdir(self.directory), reverse=True) if _REPORT_ID.match(name)
+        ]
+
+    @staticmethod
+    def media_type(report_id: str) -> str:
+        return _MEDIA_TYPES[report_id.rsplit(".", 1)[1]]
+
+
+class RequestProfiler:
+    """Profiles one request at a time"""
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.backend = "pyinstrument" if importlib.util.find_spec("pyinstrument") is not None else "cprofile"
+        self.busy = False
+        self.profiles = 0
+
+    @property
+    def extension(self) -> str:
+        return "html" if self.backend == "pyinstrument" else "txt"
+
+    def start(self):
+        self.busy = True
+        if self.backend == "pyinstrument":
+            from pyinstrument import Profiler  # optional dependency
+            profiler = Profiler(interval=self.interval, async_mode="enabled")
+            profiler.start()
+            return profiler
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop(self, profiler) -> bytes:
+        """Stop and render the report"""
+        try:
+            if self.backend == "pyinstrument":
+                profiler.stop()
+                return profiler.output_html().encode()
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).strip_dirs().sort_stats("cumulative").print_stats(60)
+            return output.getvalue().encode()
+        finally:
+            self.busy = False
+            self.profiles += 1
+
+
+def _requested_mode(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            mode = value.decode("latin-1").strip().lower()
+            return mode if mode in PROFILE_MODES else None
+    if b"profile=" not in scope["query_string"]:
+        return None
+    mode = parse_qs(scope["query_string"].decode("latin-1")).get("profile", [""])[0].lower()
+    return mode if mode in PROFILE_MODES else None
+
+
+async def _send_json(send, status: int, payload: dict):
+    await send({
+        "type": "http.response.start", "status": status,
+        "headers": [(b"content-type", b"application/json")],
+    })
+    await send({"type": "http.response.body", "body": orjson.dumps(payload)})
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware running flagged requests under the profiler.
+    authorize(api_key) decides whether the key may profile (admin keys).
+    """
+
+    def __init__(self, app, profiler: RequestProfiler, ring: ReportRing,
+                 authorize: Callable[[Optional[str]], Awaitable[bool]]):
+        self.app = app
+        self.profiler = profiler
+        self.ring = ring
+        self.authorize = authorize
+
+    async def __call__(self, scope, receive, send):
+        mode = _requested_mode(scope) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        api_key = parse_qs(scope["query_string"].decode("latin-1")).get("api_key", [None])[0]
+        if not await self.authorize(api_key):
+            await _send_json(send, 403, {"error": True, "status": 403,
+                                         "message": "Profiling needs an admin API key"})
+            return
+        if self.profiler.busy:
+            await _send_json(send, 409, {"error": True, "status": 409,
+                                         "message": "Another request is being profiled, try again"})
+            return
+
+        if mode == "inline":
+            await self._inline(scope, receive, send)
+        else:
+            await self._save(scope, receive, send)
+
+    async def _save(self, scope, receive, send):
+        report_id = self.ring.new_id(self.profiler.extension)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", report_id.encode())]
+            await send(message)
+
+        profiler = self.profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            report = self.profiler.stop(profiler)
+            try:
+                await asyncio.to_thread(self.ring.save, report_id, report)
+            except OSError as e:
+                logger.error(f"Saving profile {report_id} failed: {str(e)}")
+
+    async def _inline(self, scope, receive, send):
+        """The report replaces the response; the original status is kept in a header"""
+        status = 500
+
+        async def discard(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        profiler = self.profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            report = self.profiler.stop(profiler)
+        await send({
+            "type": "http.response.start", "status": 200,
+            "headers": [
+                (b"content-type", _MEDIA_TYPES[self.profiler.extension].encode()),
+                (b"x-profiled-status", str(status).encode()),
+                (b"cache-control", b"no-store"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": report})
+
+
+class StackSampler:
+    """
+    Samples the event loop thread's stack every interval seconds from a
+    separate thread and writes folded stacks ("frame;frame;frame count")
+    every dump_interval seconds. Costs one stack walk per sample.
+    """
+
+    def __init__(self, ring: ReportRing, interval: float = 0.01, dump_interval: float = 60):
+        self.ring = ring
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._target: Optional[int] = None
+        self._counts: Counter = Counter()
+        self.samples = 0
+        self.dumps = 0
+
+    @staticmethod
+    def _folded(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        next_dump = time.monotonic() + self.dump_interval
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self._counts[self._folded(frame)] += 1
+                self.samples += 1
+                del frame
+            if time.monotonic() >= next_dump:
+                next_dump = time.monotonic() + self.dump_interval
+                self.dump()
+        self.dump()
+
+    def dump(self):
+        counts, self._counts = self._counts, Counter()
+        if not counts:
+            return
+        folded = "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+        try:
+            self.ring.save(self.ring.new_id("folded"), folded.encode())
+            self.dumps += 1
+        except OSError as e:
+            logger.error(f"Saving folded stacks failed: {str(e)}")
+
+    def start(self):
+        """Start sampling the calling thread (the event loop's)"""
+        if self._thread is None:
+            self._target = threading.get_ident()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {"samples": self.samples, "dumps": self.dumps}
+
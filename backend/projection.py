@@ -0,0 +1,89 @@
+"""
+Field projection for API responses (?fields= / ?exclude=)
+Paths are dotted (irrigation.needs_water, forecast.periods.start). Sections that
+are not selected are never built; nested paths are applied after building.
+Lists are projected element-wise.
+"""
+
+import hashlib
+from typing import Iterable, Optional
+
+_WHOLE = True
+
+
+def _parse_paths(value: Optional[str]) -> list:
+    return [path.strip() for path in (value or "").split(",") if path.strip()]
+
+
+def _tree(paths: Iterable[str]) -> dict:
+    """Turn dotted paths into a nested dict, True marks a whole subtree"""
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            child = node.get(part)
+            if child is _WHOLE:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = _WHOLE
+    return tree
+
+
+def _include(data, tree: dict):
+    if isinstance(data, list):
+        return [_include(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    return {
+        key: data[key] if sub is _WHOLE else _include(data[key], sub)
+        for key, sub in tree.items() if key in data
+    }
+
+
+def _exclude(data, tree: dict):
+    if isinstance(data, list):
+        return [_exclude(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    return {
+        key: value if key not in tree else _exclude(value, tree[key])
+        for key, value in data.items() if tree.get(key) is not _WHOLE
+    }
+
+
+class FieldProjection:
+    """Parsed ?fields= / ?exclude= selection"""
+
+    def __init__(self, fields: Optional[str], exclude: Optional[str], top_level: Iterable[str]):
+        include_paths = _parse_paths(fields)
+        exclude_paths = _parse_paths(exclude)
+        top_level = tuple(top_level)
+        for path in include_paths + exclude_paths:
+            if path.split(".")[0] not in top_level:
+                raise ValueError(f"Unknown field '{path}', top-level fields are: {', '.join(top_level)}")
+
+        self._include = _tree(include_paths) if include_paths else None
+        self._exclude = _tree(exclude_paths)
+        selected = self._include.keys() if self._include is not None else top_level
+        # Top-level blocks that have to be built at all
+        self.sections = [name for name in top_level if name in selected and self._exclude.get(name) is not _WHOLE]
+        spec = ",".join(sorted(include_paths)) + "|" + ",".join(sorted(exclude_paths))
+        # Short stable id of the selection, used in ETags
+        self.key = hashlib.blake2b(spec.encode(), digest_size=4).hexdigest()
+
+    @property
+    def is_identity(self) -> bool:
+        return self._include is None and not self._exclude
+
+    def wants(self, name: str) -> bool:
+        return name in self.sections
+
+    def apply(self, report: dict) -> dict:
+        """Prune nested paths from a built report"""
+        if self._include is not None:
+            report = _include(report, self._include)
+        if self._exclude:
+            report = _exclude(report, self._exclude)
+        return report
@@ -0,0 +1,283 @@
+"""
+Rate limiting
+- Clients are identified by their real address: X-Forwarded-For / X-Real-IP
+  are only trusted from configured proxy networks, for a configured number of hops
+- Route limits apply per client address, an additional quota per API key
+  applies across all routes; endpoints can limit other identities (e.g. an
+  email recipient) through consume()
+- Token buckets use GCRA: one timestamp per key, O(1) per check. A request
+  takes a token from all of its buckets (route and API key) or from none
+- Counters live in a bounded in-memory LRU (per replica) or in Redis, shared by
+  all replicas with expiring keys
+"""
+
+import functools
+import hashlib
+import ipaddress
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable, List, Optional, Sequence, Tuple
+
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+_RATE = re.compile(r"^\s*(\d+)\s*(?:/|per)\s*(second|minute|hour|day)s?\s*$")
+
+# (allowed, retry after seconds, index of the bucket that refused, -1 when allowed)
+Decision = Tuple[bool, float, int]
+# (key, rate) - one token bucket
+Bucket = Tuple[str, "Rate"]
+
+
+@dataclass(frozen=True)
+class Rate:
+    """amount requests per period seconds, bursting up to amount"""
+    amount: int
+    period: int
+    text: str
+
+    @property
+    def interval(self) -> float:
+        return self.period / self.amount
+
+
+@functools.lru_cache(maxsize=None)
+def parse_rate(text: str) -> Rate:
+    """Parse "30/minute" (or "30 per minute"), raises ValueError"""
+    match = _RATE.match(text.lower())
+    if not match or int(match.group(1)) < 1:
+        raise ValueError(f"Invalid rate: {text}")
+    return Rate(int(match.group(1)), _PERIODS[match.group(2)], text)
+
+
+def parse_networks(text: str) -> List[ipaddress._BaseNetwork]:
+    """Comma-separated CIDRs or addresses, raises ValueError"""
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in text.split(",") if part.strip()]
+
+
+def client_address(request: Request, trusted_hops: int = 1,
+                   trusted_networks: Iterable[ipaddress._BaseNetwork] = ()) -> str:
+    """
+    Address of the client behind trusted_hops reverse proxies. Forwarding
+    headers are ignored unless the direct peer is in trusted_networks, so
+    clients reaching the backend directly cannot pick their own address.
+    """
+    peer = request.client.host if request.client else "unknown"
+    if trusted_hops < 1 or not _in_networks(peer, trusted_networks):
+        return peer
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        # Every proxy appends the address it received the request from;
+        # entries further left than our own proxies are client supplied
+        chain = [part.strip() for part in forwarded.split(",") if part.strip()] + [peer]
+        return chain[max(len(chain) - 1 - trusted_hops, 0)]
+    return request.headers.get("x-real-ip", peer).strip() or peer
+
+
+def _in_networks(address: str, networks: Iterable[ipaddress._BaseNetwork]) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in networks)
+
+
+class MemoryBackend:
+    """Per-process buckets, least recently used keys dropped beyond max_keys"""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> theoretical arrival time; a key at or before now is a full bucket
+        self._tat: "OrderedDict[str, float]" = OrderedDict()
+        self.evicted = 0
+
+    async def acquire(self, key: str, rate: Rate) -> Decision:
+        return await self.acquire_all([(key, rate)])
+
+    async def acquire_all(self, buckets: Sequence[Bucket]) -> Decision:
+        """One token from every bucket, or none when any of them is empty"""
+        now = time.monotonic()
+        new_tats = []
+        for index, (key, rate) in enumerate(buckets):
+            new_tat = max(self._tat.get(key, now), now) + rate.interval
+            allow_at = new_tat - rate.period
+            if now < allow_at:
+                return False, allow_at - now, index
+            new_tats.append((key, new_tat))
+        for key, new_tat in new_tats:
+            self._tat[key] = new_tat
+            self._tat.move_to_end(key)
+        # The oldest key is the one most likely refilled already
+        while len(self._tat) > self.max_keys:
+            self._tat.popitem(last=False)
+            self.evicted += 1
+        return True, 0.0, -1
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "keys": len(self._tat), "evicted": self.evicted}
+
+
+# GCRA for all buckets of a request in one round trip (ARGV: interval, period per
+# key); nothing is written unless every bucket has a token. Redis' own clock keeps
+# replicas consistent and a key expires as soon as its bucket is full again
+_GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local new_tats = {}
+for i, key in ipairs(KEYS) do
+    local interval = tonumber(ARGV[2 * i - 1])
+    local period = tonumber(ARGV[2 * i])
+    local tat = tonumber(redis.call('GET', key) or now)
+    if tat < now then tat = now end
+    local new_tat = tat + interval
+    local allow_at = new_tat - period
+    if now < allow_at then
+        return {0, tostring(allow_at - now), i - 1}
+    end
+    new_tats[i] = new_tat
+end
+for i, key in ipairs(KEYS) do
+    redis.call('SET', key, tostring(new_tats[i]), 'PX', math.ceil((new_tats[i] - now) * 1000))
+end
+return {1, '0', -1}
+"""
+
+
+class RedisBackend:
+    """Buckets shared by all replicas; requests are let through while Redis is unreachable"""
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        # client: redis.asyncio.Redis or a compatible stand-in (fakeredis)
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(_GCRA_SCRIPT)
+        self.errors = 0
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisBackend":
+        import redis.asyncio as redis  # optional dependency, only needed for shared counters
+        return cls(redis.from_url(url), **kwargs)
+
+    async def acquire(self, key: str, rate: Rate) -> Decision:
+        return await self.acquire_all([(key, rate)])
+
+    async def acquire_all(self, buckets: Sequence[Bucket]) -> Decision:
+        """One token from every bucket, or none when any of them is empty"""
+        try:
+            allowed, retry_after, refused = await self._script(
+                keys=[self.prefix + key for key, _ in buckets],
+                args=[value for _, rate in buckets for value in (rate.interval, rate.period)],
+            )
+        except Exception as e:
+            # Failing open - a limiter outage must not take the API down
+            self.errors += 1
+            logger.warning(f"Rate limit backend unavailable: {str(e)}")
+            return True, 0.0, -1
+        return bool(allowed), float(retry_after), int(refused)
+
+    async def close(self):
+        await self.client.aclose()
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "errors": self.errors}
+
+
+class RateLimitExceeded(Exception):
+    """Raised by limited endpoints, turned into a 429 by the app's exception handler"""
+
+    def __init__(self, rate: Rate, retry_after: float, scope: str):
+        super().__init__(f"{rate.amount} per {rate.period} seconds ({scope})")
+        self.rate = rate
+        self.retry_after = retry_after
+        self.scope = scope
+
+    @property
+    def detail(self) -> str:
+        return f"{self.rate.text} per {self.scope}"
+
+
+class RateLimiter:
+    """Route limits per client address plus an optional quota per API key"""
+
+    def __init__(self, backend, client_key: Callable[[Request], str],
+                 key_quota: Optional[Callable[[str], Awaitable[Optional[str]]]] = None):
+        self.backend = backend
+        self.client_key = client_key
+        # key_quota(api_key) -> rate string, or None for keys without a quota (e.g. invalid keys)
+        self.key_quota = key_quota
+        self.enabled = True
+        self.allowed = 0
+        self.rejected = {"client": 0, "api_key": 0, "recipient": 0}
+
+    async def check(self, request: Request, route: str, rate: Optional[Rate]):
+        """
+        Consume one request for the client (when the route has a rate) and its
+        API key, raises RateLimitExceeded. A refusal by one bucket leaves the other untouched.
+        """
+        buckets: List[Bucket] = []
+        scopes = []
+        if rate is not None:
+            buckets.append((f"ip:{route}:{self.client_key(request)}", rate))
+            scopes.append(("client", "client"))
+        api_key = request.query_params.get("api_key")
+        quota = await self.key_quota(api_key) if api_key and self.key_quota else None
+        if quota:
+            # Keys are hashed - the shared backend never sees them in clear
+            digest = hashlib.blake2b(api_key.encode(), digest_size=12).hexdigest()
+            buckets.append((f"key:{digest}", parse_rate(quota)))
+            scopes.append(("api_key", "API key"))
+        if buckets:
+            allowed, retry_after, refused = await self.backend.acquire_all(buckets)
+            if not allowed:
+                counter, scope = scopes[refused]
+                self.rejected[counter] += 1
+                raise RateLimitExceeded(buckets[refused][1], retry_after, scope)
+        self.allowed += 1
+
+    async def consume(self, identity: str, rate: Rate, scope: str):
+        """Consume one request for a named identity, raises RateLimitExceeded; a no-op while disabled"""
+        if not self.enabled:
+            return
+        # Hashed like API keys - identities are often personal data (addresses)
+        digest = hashlib.blake2b(identity.encode(), digest_size=12).hexdigest()
+        allowed, retry_after, _ = await self.backend.acquire(f"{scope}:{digest}", rate)
+        if not allowed:
+            self.rejected[scope] = self.rejected.get(scope, 0) + 1
+            raise RateLimitExceeded(rate, retry_after, scope)
+
+    def limit(self, rate_text: Optional[str] = None):
+        """
+        Endpoint decorator; the endpoint needs a `request: Request` parameter.
+        Without a rate only the API key quota applies.
+        """
+        rate = parse_rate(rate_text) if rate_text else None
+
+        def decorator(endpoint):
+            route = endpoint.__name__
+
+            @functools.wraps(endpoint)
+            async def wrapper(*args, **kwargs):
+                if self.enabled:
+                    request = kwargs.get("request")
+                    if not isinstance(request, Request):
+                        request = next(a for a in (*args, *kwargs.values()) if isinstance(a, Request))
+                    await self.check(request, route, rate)
+                return await endpoint(*args, **kwargs)
+
+            # Marks limited endpoints (tests check that every API key route has one)
+            wrapper.rate_limit = rate
+            return wrapper
+
+        return decorator
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "rejected": dict(self.rejected),
+            **self.backend.stats(),
+        }
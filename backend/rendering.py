@@ -0,0 +1,169 @@
+"""
+Response rendering for the weather API
+- Compact JSON through orjson for API clients (default)
+- MessagePack / CBOR for constrained device clients
+- HTML page with pretty-printed JSON for browsers (opt-in)
+"""
+
+import html
+from typing import Optional
+
+import cbor2
+import msgpack
+import orjson
+from fastapi import Request
+from fastapi.responses import HTMLResponse, Response
+
+RESPONSE_FORMATS = ("json", "html", "msgpack", "cbor")
+
+# Binary encodings: format -> (media type, encoder)
+BINARY_FORMATS = {
+    "msgpack": ("application/msgpack", msgpack.packb),
+    "cbor": ("application/cbor", cbor2.dumps),
+}
+# Accept header media types that select a binary encoding
+_BINARY_MEDIA_TYPES = (
+    ("application/msgpack", "msgpack"),
+    ("application/x-msgpack", "msgpack"),
+    ("application/vnd.msgpack", "msgpack"),
+    ("application/cbor", "cbor"),
+)
+
+_PAGE_HEAD = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>%(title)s</title>
+    <style>
+        body { font-family: 'Monaco', monospace; background: #1e1e1e; color: #d4d4d4; padding: 20px; }
+        pre { background: #252526; padding: 20px; border-radius: 8px; border: 1px solid #3e3e42; overflow-x: auto; }
+        .header { color: %(accent)s; margin-bottom: 20px; padding: 10px; background: #252526; border-radius: 8px; border-left: 4px solid %(accent)s; }
+        .test-mode { color: #ce9178; font-weight: bold; }
+        .error { color: #f48771; }
+    </style>
+</head>
+<body>
+%(header)s"""
+
+_HEADER = """    <div class="header">
+        <h2>🌾 TropoMetrics Weather Data API</h2>
+        %s
+    </div>
+"""
+
+# Page prefixes are built once at import, a response only concatenates strings
+_PAGE_PREFIX = {
+    "live": _PAGE_HEAD % {
+        "title": "TropoMetrics Weather API",
+        "accent": "#4ec9b0",
+        "header": _HEADER % "<p>Real-time weather data for agricultural sector</p>",
+    } + "    <pre>",
+    "test": _PAGE_HEAD % {
+        "title": "TropoMetrics Weather API (Test Mode)",
+        "accent": "#ce9178",
+        "header": _HEADER % '<p class="test-mode">⚠️ TEST MODE - Random Generated Data</p>',
+    } + "    <pre>",
+    "error": _PAGE_HEAD % {
+        "title": "TropoMetrics Weather API",
+        "accent": "#f48771",
+        "header": "",
+    } + '    <pre class="error">',
+}
+_PAGE_SUFFIX = """</pre>
+</body>
+</html>
+"""
+
+
+def negotiate_format(request: Request, requested: Optional[str] = None) -> str:
+    """
+    Pick the response format.
+    An explicit ?format= wins, then a binary media type in Accept, then HTML
+    only when the client asks for text/html (browsers), JSON for everything else.
+    """
+    if requested:
+        requested = requested.lower()
+        if requested in RESPONSE_FORMATS:
+            return requested
+    accept = request.headers.get("accept", "")
+    for media_type, name in _BINARY_MEDIA_TYPES:
+        if media_type in accept:
+            return name
+    if "text/html" in accept and "application/json" not in accept:
+        return "html"
+    return "json"
+
+
+def json_response(payload: dict, status_code: int = 200) -> Response:
+    """Compact JSON response"""
+    return Response(content=orjson.dumps(payload), status_code=status_code, media_type="application/json")
+
+
+def binary_response(payload: dict, output_format: str, status_code: int = 200) -> Response:
+    """MessagePack or CBOR response"""
+    media_type, encode = BINARY_FORMATS[output_format]
+    return Response(content=encode(payload), status_code=status_code, media_type=media_type)
+
+
+def html_response(payload: dict, status_code: int = 200, variant: str = "live") -> HTMLResponse:
+    """HTML page wrapping pretty-printed JSON (variant: live, test or error)"""
+    # Escaped: error messages echo request input (location ids, windows, field paths)
+    body = html.escape(orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode(), quote=False)
+    return HTMLResponse(content=_PAGE_PREFIX[variant] + body + _PAGE_SUFFIX, status_code=status_code)
+
+
+def make_etag(*parts) -> str:
+    """
+    Weak ETag from the forecast version and anything else that changes the body.
+    Weak because per-request timestamps differ while the data is the same.
+    """
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True when If-None-Match lists etag (weak comparison) or is *"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def cache_control(max_age: int, stale_while_revalidate: int = 0) -> str:
+    """Cache-Control value for a cacheable weather response
+
+    Always private: responses depend on the API key (plan, profile), so only
+    the client's own cache may keep them, shared caches must not
+    """
+    value = f"private, max-age={max(int(max_age), 0)}"
+    if stale_while_revalidate > 0:
+        value += f", stale-while-revalidate={int(stale_while_revalidate)}"
+    return value
+
+
+def not_modified(headers: dict) -> Response:
+    """304 response without a body"""
+    return Response(status_code=304, headers={**headers, "Vary": "Accept"})
+
+
+def render(request: Request, payload: dict, status_code: int = 200,
+           variant: str = "live", requested: Optional[str] = None) -> Response:
+    """Render payload in the negotiated format"""
+    output_format = negotiate_format(request, requested)
+    if output_format == "html":
+        response = html_response(payload, status_code, variant)
+    elif output_format in BINARY_FORMATS:
+        response = binary_response(payload, output_format, status_code)
+    else:
+        response = json_response(payload, status_code)
+    # Shared caches must key on Accept since the same URL has several representations
+    response.headers["Vary"] = "Accept"
+    return response
@@ -0,0 +1,122 @@
+"""
+Vectorized resampling of Open-Meteo hourly data
+- Aggregates any hourly variable (sum/mean/min/max) over fixed windows
+- Windows are aligned to the location's local clock (Open-Meteo returns
+  hourly times in the requested timezone)
+- All variables are aggregated in one NumPy pass
+"""
+
+import re
+import warnings
+from datetime import datetime, timedelta
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+AGGREGATIONS = {
+    "sum": np.nansum,
+    "mean": np.nanmean,
+    "min": np.nanmin,
+    "max": np.nanmax,
+}
+
+# Hourly variables that may be requested through ?agg=
+HOURLY_AGGREGATE_VARIABLES = (
+    "precipitation",
+    "rain",
+    "relative_humidity_2m",
+    "temperature_2m",
+    "soil_moisture_0_to_1cm",
+    "soil_moisture_27_to_81cm",
+    "evapotranspiration",
+    "et0_fao_evapotranspiration",
+    "wind_speed_10m",
+)
+
+MAX_FORECAST_DAYS = 16
+
+_WINDOW_PATTERN = re.compile(r"^\s*(\d+)\s*([hd]?)\s*$", re.IGNORECASE)
+
+
+def parse_window(value: str) -> int:
+    """Parse a window like '6', '3h' or '1d' into hours"""
+    match = _WINDOW_PATTERN.match(value or "")
+    if not match:
+        raise ValueError(f"Invalid window '{value}', use e.g. 3h, 6h or 1d")
+    hours = int(match.group(1)) * (24 if match.group(2).lower() == "d" else 1)
+    if not 1 <= hours <= 24 * MAX_FORECAST_DAYS:
+        raise ValueError(f"Window must be between 1h and {MAX_FORECAST_DAYS}d")
+    return hours
+
+
+def parse_aggregations(value: str) -> List[Tuple[str, str]]:
+    """Parse 'precipitation:sum,temperature_2m:max' into (variable, aggregation) pairs"""
+    pairs = []
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        variable, _, how = item.strip().partition(":")
+        how = how or "sum"
+        if variable not in HOURLY_AGGREGATE_VARIABLES:
+            raise ValueError(f"Unknown hourly variable '{variable}'")
+        if how not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{how}', use one of {', '.join(AGGREGATIONS)}")
+        if (variable, how) not in pairs:
+            pairs.append((variable, how))
+    if not pairs:
+        raise ValueError("At least one aggregation is required")
+    return pairs
+
+
+def window_start(local_now: datetime, window_hours: int) -> datetime:
+    """Start of the window containing local_now (aligned to local midnight of 1970-01-01)"""
+    hour = local_now.replace(minute=0, second=0, microsecond=0)
+    hours_since_epoch = int((hour - datetime(1970, 1, 1)).total_seconds() // 3600)
+    return hour - timedelta(hours=hours_since_epoch % window_hours)
+
+
+def resample_hourly(
+    hourly: Dict[str, Sequence],
+    aggregations: Sequence[Tuple[str, str]],
+    start: datetime,
+    window_hours: int,
+    horizon_hours: int,
+) -> List[dict]:
+    """
+    Aggregate hourly series into consecutive windows.
+    Windows are counted in array positions (one position = one real hour), so
+    DST changes inside the horizon don't shift the aggregation.
+    Returns one dict per window: start, period_hours and '<variable>_<aggregation>'.
+    """
+    times = np.asarray(hourly["time"], dtype="datetime64[h]")
+    first = int(np.searchsorted(times, np.datetime64(start, "h")))
+    n_windows = min(horizon_hours, len(times) - first) // window_hours
+    if n_windows <= 0:
+        return []
+    end = first + n_windows * window_hours
+
+    variables = list(dict.fromkeys(variable for variable, _ in aggregations))
+    # (variables, windows, hours per window) - None from the upstream becomes NaN
+    blocks = np.array(
+        [hourly[variable][first:end] for variable in variables], dtype=float
+    ).reshape(len(variables), n_windows, window_hours)
+
+    # Windows without a single value are reported as null for every aggregation
+    # (nansum alone would report 0.0 for them)
+    empty = np.isnan(blocks).all(axis=2)
+    columns = {}
+    with warnings.catch_warnings():
+        # nanmean/nanmin/nanmax warn on all-NaN windows
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for how in dict.fromkeys(how for _, how in aggregations):
+            rows = [variables.index(variable) for variable, agg in aggregations if agg == how]
+            values = np.where(empty[rows], np.nan, np.round(AGGREGATIONS[how](blocks[rows], axis=2), 2))
+            for row, variable in zip(values, (v for v, agg in aggregations if agg == how)):
+                columns[f"{variable}_{how}"] = [None if np.isnan(x) else x for x in row.tolist()]
+
+    starts = np.datetime_as_string(times[first:end:window_hours], unit="m").tolist()
+    names = [f"{variable}_{how}" for variable, how in aggregations]
+    return [
+        {"start": starts[i], "period_hours": window_hours, **{name: columns[name][i] for name in names}}
+        for i in range(n_windows)
+    ]
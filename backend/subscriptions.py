@@ -0,0 +1,317 @@
+"""
+Irrigation alert subscriptions
+- Stored in SQLite and loaded into memory at start
+- Grouped by forecast key (grid cell): every subscriber in a cell is
+  evaluated against the same cached forecast
+- Thresholds are kept sorted per group, so a change in soil moisture only
+  touches the subscribers whose advice actually flipped
+- Double opt-in: a subscription only gets alerts once the recipient opened the
+  confirmation link; only a hash of the link's token is stored. Unconfirmed
+  subscriptions are deleted after confirm_ttl
+- Every subscription has an unsubscribe token, included in each alert email
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import secrets
+import sqlite3
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id TEXT PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    location_id TEXT,
+    threshold REAL NOT NULL,
+    created_at REAL NOT NULL,
+    owner TEXT,
+    confirm_token TEXT,
+    confirmed_at REAL,
+    unsubscribe_token TEXT
+);
+"""
+
+_COLUMNS = ("recipient, latitude, longitude, threshold, location_id, id, created_at, owner, "
+            "confirm_token, confirmed_at, unsubscribe_token")
+# Added after the first release - (name, type) for ALTER TABLE on older databases
+_ADDED_COLUMNS = (("owner", "TEXT"), ("confirm_token", "TEXT"), ("confirmed_at", "REAL"),
+                  ("unsubscribe_token", "TEXT"))
+# Unconfirmed rows deleted per statement by the expiry sweep
+_SWEEP_BATCH = 500
+
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+@dataclass
+class Subscription:
+    """One recipient watching the irrigation advice for one location"""
+    recipient: str
+    latitude: float
+    longitude: float
+    threshold: float
+    location_id: Optional[str] = None
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    created_at: float = field(default_factory=time.time)
+    owner: Optional[str] = None             # API key id that created it
+    confirm_token: Optional[str] = None     # sha256 of the confirmation link token
+    confirmed_at: Optional[float] = None    # None: no alerts yet
+    # Kept in clear: every alert email carries the unsubscribe link again
+    unsubscribe_token: str = field(default_factory=lambda: secrets.token_urlsafe(24))
+
+    @property
+    def label(self) -> str:
+        return self.location_id or f"{self.latitude}, {self.longitude}"
+
+    @property
+    def confirmed(self) -> bool:
+        return self.confirmed_at is not None
+
+    def issue_token(self) -> str:
+        """New confirmation token for the link; only its hash is kept"""
+        token = secrets.token_urlsafe(24)
+        self.confirm_token = _token_hash(token)
+        return token
+
+    def check_token(self, token: str) -> bool:
+        return self.confirm_token is not None and hmac.compare_digest(self.confirm_token, _token_hash(token))
+
+    def check_unsubscribe_token(self, token: str) -> bool:
+        return hmac.compare_digest(self.unsubscribe_token.encode(), token.encode())
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        del data["owner"], data["confirm_token"], data["unsubscribe_token"]
+        return {**data, "confirmed": self.confirmed}
+
+
+class SubscriberGroup:
+    """Subscribers sharing one forecast, ordered by threshold"""
+
+    def __init__(self):
+        self._thresholds: List[float] = []
+        self._subscriptions: List[Subscription] = []
+        # Soil moisture of the last evaluated forecast
+        self.level: Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def add(self, subscription: Subscription):
+        index = bisect_right(self._thresholds, subscription.threshold)
+        self._thresholds.insert(index, subscription.threshold)
+        self._subscriptions.insert(index, subscription)
+
+    def remove(self, subscription: Subscription):
+        start = bisect_left(self._thresholds, subscription.threshold)
+        end = bisect_right(self._thresholds, subscription.threshold)
+        for index in range(start, end):
+            if self._subscriptions[index].id == subscription.id:
+                del self._thresholds[index]
+                del self._subscriptions[index]
+                return
+
+    def watched(self) -> bool:
+        """True while a confirmed subscription needs this forecast"""
+        return any(subscription.confirmed for subscription in self._subscriptions)
+
+    def needs_water(self, subscription: Subscription) -> Optional[bool]:
+        return None if self.level is None else self.level <= subscription.threshold
+
+    def update(self, level: float) -> List[Tuple[Subscription, bool]]:
+        """
+        Record a new soil moisture level; returns (subscription, needs_water)
+        for every subscriber whose advice changed. The first level only sets the baseline.
+        """
+        previous, self.level = self.level, level
+        if previous is None or level == previous:
+            return []
+        # needs_water is level <= threshold, so only thresholds between the
+        # old and the new level change their answer
+        low, high = sorted((previous, level))
+        start = bisect_left(self._thresholds, low)
+        end = bisect_left(self._thresholds, high)
+        drying = level < previous
+        return [(subscription, drying) for subscription in self._subscriptions[start:end]]
+
+
+class SubscriptionRegistry:
+    """Durable subscription store with an in-memory index per forecast key"""
+
+    def __init__(self, path: str, key_for: Callable[[Subscription], Hashable],
+                 confirm_ttl: float = 2 * 86400, sweep_interval: float = 3600):
+        self.path = path
+        self.key_for = key_for
+        # Unconfirmed subscriptions older than this are deleted (0 keeps them forever)
+        self.confirm_ttl = confirm_ttl
+        self.sweep_interval = sweep_interval
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        self._subscriptions: Dict[str, Subscription] = {}
+        self._groups: Dict[Hashable, SubscriberGroup] = {}
+        self.expired = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self) -> list:
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(subscriptions)")}
+        for name, kind in _ADDED_COLUMNS:
+            if name not in columns:
+                # Older subscriptions have no owner (admin keys only) and stay unconfirmed
+                self._db.execute(f"ALTER TABLE subscriptions ADD COLUMN {name} {kind}")
+        missing = [row[0] for row in self._db.execute("SELECT id FROM subscriptions WHERE unsubscribe_token IS NULL")]
+        if missing:
+            self._db.executemany(
+                "UPDATE subscriptions SET unsubscribe_token = ? WHERE id = ?",
+                [(secrets.token_urlsafe(24), subscription_id) for subscription_id in missing]
+            )
+        return self._db.execute(f"SELECT {_COLUMNS} FROM subscriptions").fetchall()
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="subscriptions")
+        for row in await self._run(self._open):
+            self._index(Subscription(*row))
+        logger.info(f"Loaded {len(self._subscriptions)} subscription(s) for {len(self._groups)} location(s)")
+        if self.confirm_ttl > 0:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._subscriptions.clear()
+        self._groups.clear()
+
+    def _index(self, subscription: Subscription) -> Hashable:
+        key = self.key_for(subscription)
+        self._subscriptions[subscription.id] = subscription
+        self._groups.setdefault(key, SubscriberGroup()).add(subscription)
+        return key
+
+    def _insert(self, subscription: Subscription):
+        self._db.execute(
+            f"INSERT INTO subscriptions ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (subscription.recipient, subscription.latitude, subscription.longitude,
+             subscription.threshold, subscription.location_id, subscription.id, subscription.created_at,
+             subscription.owner, subscription.confirm_token, subscription.confirmed_at,
+             subscription.unsubscribe_token)
+        )
+
+    async def add(self, subscription: Subscription) -> Hashable:
+        """Store and index subscription, returns its forecast key"""
+        await self._run(self._insert, subscription)
+        return self._index(subscription)
+
+    def _confirm(self, subscription_id: str, confirmed_at: float):
+        self._db.execute(
+            "UPDATE subscriptions SET confirmed_at = ? WHERE id = ?",
+            (confirmed_at, subscription_id)
+        )
+
+    async def confirm(self, subscription: Subscription):
+        """Record the opt-in (the link keeps working, a second click changes nothing)"""
+        confirmed_at = time.time()
+        await self._run(self._confirm, subscription.id, confirmed_at)
+        subscription.confirmed_at = confirmed_at
+
+    def confirmable(self, subscription: Subscription, now: Optional[float] = None) -> bool:
+        """False once an unconfirmed subscription outlived confirm_ttl (the sweep may not have run yet)"""
+        now = time.time() if now is None else now
+        return subscription.confirmed or self.confirm_ttl <= 0 or now - subscription.created_at < self.confirm_ttl
+
+    def _delete(self, subscription_id: str):
+        self._db.execute("DELETE FROM subscriptions WHERE id = ?", (subscription_id,))
+
+    def _unindex(self, subscription: Subscription) -> Hashable:
+        key = self.key_for(subscription)
+        group = self._groups[key]
+        group.remove(subscription)
+        if not group:
+            del self._groups[key]
+        return key
+
+    async def remove(self, subscription_id: str) -> Optional[Tuple[Subscription, Hashable, bool]]:
+        """
+        Delete a subscription; returns (subscription, key, no confirmed
+        subscription left for key) or None
+        """
+        subscription = self._subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return None
+        await self._run(self._delete, subscription_id)
+        key = self._unindex(subscription)
+        return subscription, key, not self.watched(key)
+
+    def _expire(self, ids: List[str]):
+        self._db.executemany(
+            "DELETE FROM subscriptions WHERE id = ? AND confirmed_at IS NULL", [(i,) for i in ids]
+        )
+
+    async def sweep(self, now: Optional[float] = None) -> int:
+        """Delete unconfirmed subscriptions older than confirm_ttl, returns the number deleted"""
+        now = time.time() if now is None else now
+        stale = [s for s in self._subscriptions.values() if not self.confirmable(s, now)]
+        for start in range(0, len(stale), _SWEEP_BATCH):
+            chunk = stale[start:start + _SWEEP_BATCH]
+            await self._run(self._expire, [subscription.id for subscription in chunk])
+            for subscription in chunk:
+                # Confirmed or removed while the batch was written: kept, or gone already
+                if not subscription.confirmed and self._subscriptions.pop(subscription.id, None) is not None:
+                    self._unindex(subscription)
+        if stale:
+            self.expired += len(stale)
+            logger.info(f"Deleted {len(stale)} unconfirmed subscription(s)")
+        return len(stale)
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Subscription sweep failed: {str(e)}")
+            await asyncio.sleep(self.sweep_interval)
+
+    def get(self, subscription_id: str) -> Optional[Subscription]:
+        return self._subscriptions.get(subscription_id)
+
+    def group(self, key: Hashable) -> Optional[SubscriberGroup]:
+        return self._groups.get(key)
+
+    def watched(self, key: Hashable) -> bool:
+        group = self._groups.get(key)
+        return group is not None and group.watched()
+
+    def keys(self) -> List[Hashable]:
+        """Forecast keys with a confirmed subscription - the ones to keep refreshed"""
+        return [key for key, group in self._groups.items() if group.watched()]
+
+    def stats(self) -> dict:
+        return {
+            "subscriptions": len(self._subscriptions),
+            "locations": len(self._groups),
+            "expired": self.expired,
+        }
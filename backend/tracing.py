@@ -0,0 +1,310 @@
+"""
+Per-request trace spans
+- span("upstream") times a stage of the current request; spans nest and work
+  across tasks started by the request (contextvars)
+- Every response gets a Server-Timing header with its spans, so browser devtools
+  and load tests can attribute latency without a profiler
+- Sampled traces are optionally exported as OpenTelemetry spans (OTLP/HTTP JSON)
+  to a collector, or appended to a file as OTLP JSON lines
+- A W3C traceparent header on the request continues the caller's trace
+"""
+
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import httpx
+import orjson
+from starlette.datastructures import MutableHeaders
+
+logger = logging.getLogger(__name__)
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# OTLP span kinds and status codes
+KIND_INTERNAL = 1
+KIND_SERVER = 2
+STATUS_ERROR = 2
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    start: int                      # perf_counter_ns
+    end: int = 0
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def milliseconds(self) -> float:
+        return (self.end - self.start) / 1e6
+
+
+class Trace:
+    """The spans of one request, below a root span covering the whole request"""
+
+    def __init__(self, trace_id: str, parent_id: Optional[str], sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        # Wall clock at the start, span timestamps are perf_counter offsets from it
+        self.epoch_ns = time.time_ns()
+        self.root = Span("request", _new_id(64), parent_id, time.perf_counter_ns())
+        self.spans: List[Span] = []
+        self.status = 0
+
+    def server_timing(self) -> str:
+        """Server-Timing value: finished spans plus the time until the response started"""
+        entries = [f"{span.name};dur={span.milliseconds:.2f}" for span in self.spans if span.end]
+        entries.append(f"total;dur={(time.perf_counter_ns() - self.root.start) / 1e6:.2f}")
+        return ", ".join(entries)
+
+    def to_otlp(self) -> List[dict]:
+        return [self._otlp_span(self.root, KIND_SERVER)] + [
+            self._otlp_span(span, KIND_INTERNAL) for span in self.spans
+        ]
+
+    def _otlp_span(self, span: Span, kind: int) -> dict:
+        otlp = {
+            "traceId": self.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": kind,
+            "startTimeUnixNano": str(self.epoch_ns + span.start - self.root.start),
+            "endTimeUnixNano": str(self.epoch_ns + (span.end or span.start) - self.root.start),
+            "attributes": [_attribute(key, value) for key, value in span.attributes.items()],
+        }
+        if span.parent_id:
+            otlp["parentSpanId"] = span.parent_id
+        if span is self.root and self.status >= 500:
+            otlp["status"] = {"code": STATUS_ERROR}
+        return otlp
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_parent: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time the with-block as a span of the current request (no-op outside a request)"""
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _parent.get() or trace.root
+    item = Span(name, _new_id(64), parent.span_id, time.perf_counter_ns(), attributes=attributes)
+    token = _parent.set(item)
+    try:
+        yield item
+    finally:
+        item.end = time.perf_counter_ns()
+        _parent.reset(token)
+        trace.spans.append(item)
+
+
+class SpanExporter:
+    """
+    Batches OTLP spans in a bounded buffer and ships them in the background.
+    target: an OTLP/HTTP traces URL (http://otel-collector:4318/v1/traces) or a
+    file path that receives one OTLP JSON document per line. Spans are dropped,
+    never queued without bound, when the target cannot keep up.
+    """
+
+    def __init__(self, target: str, service_name: str, batch_size: int = 512,
+                 interval: float = 5.0, max_spans: int = 20000, timeout: float = 5.0):
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self._resource = {"attributes": [_attribute("service.name", service_name)]}
+        self._spans: deque = deque(maxlen=max_spans)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @property
+    def is_http(self) -> bool:
+        return self.target.startswith(("http://", "https://"))
+
+    def submit(self, spans: List[dict]):
+        overflow = len(self._spans) + len(spans) - self._spans.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+        self._spans.extend(spans)
+        if len(self._spans) >= self.batch_size:
+            self._wakeup.set()
+
+    def _document(self, spans: List[dict]) -> bytes:
+        return orjson.dumps({"resourceSpans": [{
+            "resource": self._resource,
+            "scopeSpans": [{"scope": {"name": "tropometrics"}, "spans": spans}],
+        }]})
+
+    def _append(self, document: bytes):
+        with open(self.target, "ab") as f:
+            f.write(document + b"\n")
+
+    async def flush(self):
+        while self._spans:
+            batch = [self._spans.popleft() for _ in range(min(self.batch_size, len(self._spans)))]
+            document = self._document(batch)
+            try:
+                if self.is_http:
+                    response = await self._client.post(
+                        self.target, content=document, headers={"Content-Type": "application/json"}
+                    )
+                    response.raise_for_status()
+                else:
+                    await asyncio.get_running_loop().run_in_executor(self._executor, self._append, document)
+            except Exception as e:
+                # Tracing must never hold requests up - the batch is lost
+                self.errors += 1
+                self.dropped += len(batch)
+                logger.warning(f"Span export failed: {str(e)}")
+                return
+            self.exported += len(batch)
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            if self.is_http:
+                self._client = httpx.AsyncClient(timeout=self.timeout)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spans")
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "target": "http" if self.is_http else "file",
+            "buffered": len(self._spans),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+class Tracer:
+    """Starts a trace per request and hands sampled ones to the exporter"""
+
+    def __init__(self, exporter: Optional[SpanExporter] = None, sample_ratio: float = 1.0,
+                 server_timing: bool = True):
+        self.exporter = exporter
+        self.sample_ratio = sample_ratio
+        self.server_timing = server_timing
+
+    @property
+    def enabled(self) -> bool:
+        return self.server_timing or self.exporter is not None
+
+    def start_trace(self, traceparent: Optional[str] = None) -> Trace:
+        match = _TRACEPARENT.match(traceparent.strip().lower()) if traceparent else None
+        if match and match.group(1) != "0" * 32:
+            # The caller decided on sampling already
+            return Trace(match.group(1), match.group(2), bool(int(match.group(3), 16) & 1))
+        return Trace(_new_id(128), None, random.random() < self.sample_ratio)
+
+    def finish(self, trace: Trace, name: str, **attributes):
+        trace.root.end = time.perf_counter_ns()
+        trace.root.name = name
+        trace.root.attributes.update(attributes)
+        if trace.sampled and self.exporter is not None:
+            self.exporter.submit(trace.to_otlp())
+
+    def record(self, name: str, seconds: float, **attributes):
+        """Export a standalone span that just ended, e.g. a background SMTP send"""
+        if self.exporter is None or random.random() >= self.sample_ratio:
+            return
+        trace = Trace(_new_id(128), None, True)
+        trace.root.start -= int(seconds * 1e9)
+        trace.epoch_ns -= int(seconds * 1e9)
+        trace.root.attributes.update(attributes)
+        self.finish(trace, name)
+
+
+class TracingMiddleware:
+    """ASGI middleware: one trace per HTTP request, Server-Timing on the response"""
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.tracer.enabled:
+            await self.app(scope, receive, send)
+            return
+        traceparent = next((value.decode("latin-1") for name, value in scope["headers"]
+                            if name == b"traceparent"), None)
+        trace = self.tracer.start_trace(traceparent)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                if self.tracer.server_timing:
+                    MutableHeaders(scope=message).append("Server-Timing", trace.server_timing())
+            await send(message)
+
+        token = _trace.set(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _trace.reset(token)
+            trace.status = trace.status or 500
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.tracer.finish(
+                trace, f"{scope['method']} {route}",
+                **{"http.request.method": scope["method"], "http.route": route,
+                   "url.path": scope["path"], "http.response.status_code": trace.status},
+            )
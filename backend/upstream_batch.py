@@ -0,0 +1,76 @@
+"""
+Batching of upstream forecast lookups
+Lookups that arrive within a short window and share the same request shape
+(variables, horizon) are sent to Open-Meteo as one multi-coordinate request.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# fetch_many(group, items) -> one result per item, in order
+FetchMany = Callable[[Hashable, List[Any]], Awaitable[List[Any]]]
+
+
+class UpstreamBatcher:
+    """Collects pending lookups per group and flushes them as one request"""
+
+    def __init__(self, fetch_many: FetchMany, max_batch: int = 50, window_seconds: float = 0.01):
+        self.fetch_many = fetch_many
+        self.max_batch = max_batch
+        self.window_seconds = window_seconds
+        self._pending: Dict[Hashable, List[Tuple[Any, asyncio.Future]]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        # Running requests - the loop only keeps weak references to tasks
+        self._running: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def fetch(self, group: Hashable, item: Any) -> Any:
+        """Queue item in group and wait for its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(group, [])
+        pending.append((item, future))
+
+        if len(pending) >= self.max_batch:
+            self._flush(group)
+        elif group not in self._timers:
+            self._timers[group] = loop.call_later(self.window_seconds, self._flush, group)
+        return await future
+
+    def _flush(self, group: Hashable):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(group, [])
+        if batch:
+            task = asyncio.ensure_future(self._run(group, batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, group: Hashable, batch: List[Tuple[Any, asyncio.Future]]):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await self.fetch_many(group, [item for item, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError(f"Upstream returned {len(results)} results for {len(batch)} locations")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "running": len(self._running),
+            "lookups": self.items,
+            "average_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+        }
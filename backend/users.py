@@ -0,0 +1,401 @@
+"""
+User, farm, field and preference store (SQLite, WAL mode)
+- A user belongs to an API key; its preferences (units, language of the
+  advice text, default location) and fields personalize that key's /api responses
+- Every query is a fixed statement with parameters, prepared once per
+  connection and reused from the sqlite3 statement cache
+- Profiles are read through an in-process cache. Writes through this store
+  invalidate the entry; writes from other processes are picked up by polling
+  PRAGMA data_version, so the request path never touches the database on a hit
+- RemoteUserStore: the same cache on the scaled API replicas, loading profiles
+  from the state service that owns the database and polling its version()
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from api_keys import STATE_TOKEN_HEADER
+
+logger = logging.getLogger(__name__)
+
+UNITS = ("metric", "imperial")
+LANGUAGES = ("nl", "en")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    api_key_id TEXT NOT NULL UNIQUE,
+    email TEXT NOT NULL,
+    name TEXT,
+    units TEXT NOT NULL DEFAULT 'metric',
+    language TEXT NOT NULL DEFAULT 'nl',
+    default_location TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS farms (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS farms_user ON farms (user_id);
+CREATE TABLE IF NOT EXISTS fields (
+    id TEXT PRIMARY KEY,
+    farm_id TEXT NOT NULL REFERENCES farms (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fields_farm ON fields (farm_id);
+"""
+
+_SELECT_USER = """
+SELECT id, api_key_id, email, name, units, language, default_location
+FROM users WHERE api_key_id = ?
+"""
+_SELECT_FIELDS = """
+SELECT f.id, f.name, l.id, l.name, l.latitude, l.longitude
+FROM farms f LEFT JOIN fields l ON l.farm_id = f.id
+WHERE f.user_id = ? ORDER BY f.created_at, l.created_at
+"""
+_UPSERT_USER = """
+INSERT INTO users (id, api_key_id, email, name, units, language, default_location, created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (api_key_id) DO UPDATE SET
+    email = excluded.email, name = excluded.name, units = excluded.units,
+    language = excluded.language, default_location = excluded.default_location,
+    updated_at = excluded.updated_at
+"""
+_INSERT_FARM = """
+INSERT INTO farms (id, user_id, name, created_at)
+SELECT ?, id, ?, ? FROM users WHERE api_key_id = ?
+"""
+_INSERT_FIELD = """
+INSERT INTO fields (id, farm_id, name, latitude, longitude, created_at)
+SELECT ?, f.id, ?, ?, ?, ? FROM farms f JOIN users u ON u.id = f.user_id
+WHERE f.id = ? AND u.api_key_id = ?
+"""
+_DELETE_FIELD = """
+DELETE FROM fields WHERE id = ? AND farm_id IN (
+    SELECT f.id FROM farms f JOIN users u ON u.id = f.user_id WHERE u.api_key_id = ?
+)
+"""
+_DELETE_USER = "DELETE FROM users WHERE api_key_id = ?"
+
+
+@dataclass(frozen=True)
+class Field:
+    id: str
+    name: str
+    latitude: float
+    longitude: float
+
+
+@dataclass(frozen=True)
+class Farm:
+    id: str
+    name: str
+    fields: Tuple[Field, ...] = ()
+
+
+@dataclass(frozen=True)
+class Profile:
+    """A user with preferences and fields - immutable, shared by concurrent requests"""
+    id: str
+    api_key_id: str
+    email: str
+    name: Optional[str]
+    units: str
+    language: str
+    default_location: Optional[str]
+    farms: Tuple[Farm, ...] = ()
+    # field id -> {"latitude", "longitude"}, usable as /api?location=<field id>
+    locations: Dict[str, dict] = field(default_factory=dict, compare=False)
+
+    @classmethod
+    def build(cls, *user, farms: Tuple[Farm, ...] = ()) -> "Profile":
+        """Profile from the users row, with the locations of its fields"""
+        locations = {
+            f.id: {"latitude": f.latitude, "longitude": f.longitude}
+            for farm in farms for f in farm.fields
+        }
+        return cls(*user, farms=farms, locations=locations)
+
+    @classmethod
+    def from_dict(cls, api_key_id: str, data: dict) -> "Profile":
+        """Inverse of to_dict() for the key's profile"""
+        preferences = data["preferences"]
+        farms = tuple(
+            Farm(farm["id"], farm["name"], tuple(
+                Field(f["id"], f["name"], f["latitude"], f["longitude"]) for f in farm["fields"]
+            ))
+            for farm in data["farms"]
+        )
+        return cls.build(
+            data["id"], api_key_id, data["email"], data["name"], preferences["units"],
+            preferences["language"], preferences["default_location"], farms=farms,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "email": self.email,
+            "name": self.name,
+            "preferences": {
+                "units": self.units,
+                "language": self.language,
+                "default_location": self.default_location,
+            },
+            "farms": [
+                {
+                    "id": farm.id,
+                    "name": farm.name,
+                    "fields": [
+                        {"id": f.id, "name": f.name, "latitude": f.latitude, "longitude": f.longitude}
+                        for f in farm.fields
+                    ],
+                }
+                for farm in self.farms
+            ],
+        }
+
+
+class UserStore:
+    """Durable user profiles behind a read-through cache keyed by API key id"""
+
+    def __init__(self, path: str, cache_size: int = 10000, check_interval: float = 5):
+        self.path = path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._db: Optional[sqlite3.Connection] = None
+        # api key id -> profile, None for keys without a user
+        self._cache: "OrderedDict[str, Optional[Profile]]" = OrderedDict()
+        # Bumped on every invalidation, so a load that raced a write is not cached
+        self._generation = 0
+        # Tells a restarted store apart in version()
+        self._instance = uuid.uuid4().hex[:8]
+        self._data_version: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self):
+        self._db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, cached_statements=64
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(_SCHEMA)
+        self._data_version = self._read_data_version()
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="users")
+        await self._run(self._open)
+        self._task = asyncio.ensure_future(self._watch())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._cache.clear()
+
+    # Cache
+
+    def _invalidate(self, api_key_id: Optional[str] = None):
+        self._generation += 1
+        self.invalidations += 1
+        if api_key_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(api_key_id, None)
+
+    def version(self) -> str:
+        """Changes whenever cached profiles may be stale - polled by RemoteUserStore"""
+        return f"{self._instance}-{self._generation}"
+
+    def _read_data_version(self) -> int:
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    async def _watch(self):
+        """Drop the cache when another connection (e.g. another process) committed"""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                version = await self._run(self._read_data_version)
+            except Exception as e:
+                logger.warning(f"User store check failed: {str(e)}")
+                continue
+            if version != self._data_version:
+                self._data_version = version
+                self._invalidate()
+
+    def _load(self, api_key_id: str) -> Optional[Profile]:
+        user = self._db.execute(_SELECT_USER, (api_key_id,)).fetchone()
+        if user is None:
+            return None
+        farms: "OrderedDict[str, Tuple[str, list]]" = OrderedDict()
+        for farm_id, farm_name, field_id, field_name, latitude, longitude in self._db.execute(
+            _SELECT_FIELDS, (user[0],)
+        ):
+            _, fields = farms.setdefault(farm_id, (farm_name, []))
+            if field_id is not None:
+                fields.append(Field(field_id, field_name, latitude, longitude))
+        farm_list = tuple(Farm(farm_id, name, tuple(fields)) for farm_id, (name, fields) in farms.items())
+        return Profile.build(*user, farms=farm_list)
+
+    async def _fetch(self, api_key_id: str) -> Optional[Profile]:
+        return await self._run(self._load, api_key_id)
+
+    async def profile(self, api_key_id: str) -> Optional[Profile]:
+        """Profile of the user behind an API key, None when the key has no user"""
+        if api_key_id in self._cache:
+            self._cache.move_to_end(api_key_id)
+            self.hits += 1
+            return self._cache[api_key_id]
+        self.misses += 1
+        generation = self._generation
+        profile = await self._fetch(api_key_id)
+        if generation == self._generation and self.cache_size > 0:
+            self._cache[api_key_id] = profile
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return profile
+
+    # Writes - each one invalidates the key's cached profile
+
+    async def _write(self, api_key_id: str, statement: str, parameters: tuple) -> int:
+        try:
+            cursor = await self._run(self._db.execute, statement, parameters)
+        finally:
+            self._invalidate(api_key_id)
+        return cursor.rowcount
+
+    async def save_user(self, api_key_id: str, email: str, name: Optional[str] = None,
+                        units: str = "metric", language: str = "nl",
+                        default_location: Optional[str] = None) -> Profile:
+        """Create or update the user of an API key, raises ValueError for unknown units/languages"""
+        if units not in UNITS:
+            raise ValueError(f"units must be one of: {', '.join(UNITS)}")
+        if language not in LANGUAGES:
+            raise ValueError(f"language must be one of: {', '.join(LANGUAGES)}")
+        now = time.time()
+        await self._write(api_key_id, _UPSERT_USER, (
+            uuid.uuid4().hex[:12], api_key_id, email, name, units, language, default_location, now, now
+        ))
+        return await self.profile(api_key_id)
+
+    async def add_farm(self, api_key_id: str, name: str) -> Optional[str]:
+        """New farm for the key's user, None when the key has no user"""
+        farm_id = uuid.uuid4().hex[:12]
+        added = await self._write(api_key_id, _INSERT_FARM, (farm_id, name, time.time(), api_key_id))
+        return farm_id if added else None
+
+    async def add_field(self, api_key_id: str, farm_id: str, name: str,
+                        latitude: float, longitude: float) -> Optional[str]:
+        """New field on one of the user's farms, None when the farm is not theirs"""
+        field_id = uuid.uuid4().hex[:12]
+        added = await self._write(api_key_id, _INSERT_FIELD, (
+            field_id, name, latitude, longitude, time.time(), farm_id, api_key_id
+        ))
+        return field_id if added else None
+
+    async def remove_field(self, api_key_id: str, field_id: str) -> bool:
+        return await self._write(api_key_id, _DELETE_FIELD, (field_id, api_key_id)) > 0
+
+    async def delete_user(self, api_key_id: str) -> bool:
+        """Remove the user with its farms and fields"""
+        return await self._write(api_key_id, _DELETE_USER, (api_key_id,)) > 0
+
+    def stats(self) -> dict:
+        return {
+            "cached_profiles": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+class RemoteUserStore(UserStore):
+    """Profiles of an API replica, loaded from the state service and cached like UserStore
+
+    The state service owns the database and serves /internal/users; /api/me runs there too,
+    so this store only reads. Its version() is polled every check_interval and a change
+    drops the cache.
+    """
+
+    def __init__(self, base_url: str, token: str, cache_size: int = 10000, check_interval: float = 5,
+                 timeout: float = 5):
+        super().__init__("", cache_size=cache_size, check_interval=check_interval)
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._remote_version: Optional[str] = None
+
+    async def open(self):
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url, timeout=self.timeout, headers={STATE_TOKEN_HEADER: self.token}
+        )
+        self._task = asyncio.ensure_future(self._watch())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._cache.clear()
+
+    async def _fetch(self, api_key_id: str) -> Optional[Profile]:
+        response = await self._client.get(f"/internal/users/{api_key_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return Profile.from_dict(api_key_id, response.json())
+
+    async def _watch(self):
+        """Drop the cache when the state service's store changed"""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                response = await self._client.get("/internal/users/version")
+                response.raise_for_status()
+                version = response.json()["version"]
+            except Exception as e:
+                logger.warning(f"User store check failed: {str(e)}")
+                continue
+            if version != self._remote_version:
+                self._remote_version = version
+                self._invalidate()
@@ -0,0 +1,274 @@
+"""
+Forecast cache for Open-Meteo responses
+- In-process TTL cache keyed by (location, requested variables)
+- Single-flight: concurrent misses for the same key share one upstream fetch
+- Stale-while-revalidate: expired entries are served while a refresh runs
+- Bounded: least recently used entries beyond max_entries are dropped
+  (pinned keys stay)
+- Background refresher keeps hot keys fresh ahead of expiry
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+Fetcher = Callable[[], Awaitable[Any]]
+
+
+@dataclass
+class CacheEntry:
+    """Cached upstream response with its freshness deadlines (monotonic clock)"""
+    value: Any
+    fetched_at: float
+    fresh_until: float
+    stale_until: float
+    # Hash of the forecast data in value - a refetch of unchanged data keeps the version
+    version: str = ""
+
+
+# Parts of an Open-Meteo response that carry forecast data; the rest is fetch
+# metadata (generationtime_ms differs on every call) and must not change the version
+VERSIONED_FIELDS = ("current", "current_units", "hourly", "hourly_units", "daily", "daily_units")
+
+
+def content_version(value: Any) -> str:
+    """
+    Short stable hash of a JSON-serializable value.
+    For an Open-Meteo response only the forecast arrays and their units count.
+    """
+    if isinstance(value, dict) and any(name in value for name in VERSIONED_FIELDS):
+        value = {name: value[name] for name in VERSIONED_FIELDS if name in value}
+    return hashlib.blake2b(orjson.dumps(value, option=orjson.OPT_SORT_KEYS), digest_size=8).hexdigest()
+
+
+class ForecastCache:
+    """TTL cache with single-flight coalescing and stale-while-revalidate"""
+
+    def __init__(self, ttl_seconds: float = 900, stale_seconds: float = 0, max_entries: int = 5000):
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        # Least recently used first
+        self._entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        # Fetch function and last access per key, used by the background refresher
+        self._fetchers: Dict[Hashable, Fetcher] = {}
+        self._last_access: Dict[Hashable, float] = {}
+        self._pinned = set()
+        # Called with (key, entry) after every successful fetch
+        self._listeners: List[Callable[[Hashable, CacheEntry], None]] = []
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.refresh_errors = 0
+        self.evicted = 0
+
+    async def get_or_fetch(self, key: Hashable, fetch: Fetcher) -> Tuple[CacheEntry, bool]:
+        """
+        Return (entry, served_stale) for key.
+        Fresh entries are returned directly, stale entries are returned while a
+        background refresh runs, missing entries are fetched once for all callers.
+        """
+        now = time.monotonic()
+        self._fetchers[key] = fetch
+        self._last_access[key] = now
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        if entry is not None and entry.fresh_until > now:
+            self.hits += 1
+            return entry, False
+        if entry is not None and entry.stale_until > now:
+            self.stale_hits += 1
+            self._start_fetch(key, fetch)
+            return entry, True
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._start_fetch(key, fetch)
+
+        # Shield so a cancelled request (client disconnect) doesn't cancel the
+        # fetch other requests are waiting on
+        return await asyncio.shield(task), False
+
+    def _start_fetch(self, key: Hashable, fetch: Fetcher) -> asyncio.Task:
+        """Start a fetch for key unless one is already running"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_entry(fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._store(key, done))
+        return task
+
+    async def _fetch_entry(self, fetch: Fetcher) -> CacheEntry:
+        value = await fetch()
+        now = time.monotonic()
+        return CacheEntry(
+            value=value,
+            fetched_at=time.time(),
+            fresh_until=now + self.ttl_seconds,
+            stale_until=now + self.ttl_seconds + self.stale_seconds,
+            version=content_version(value),
+        )
+
+    def _store(self, key: Hashable, task: asyncio.Task):
+        """Move a finished fetch into the cache (errors are never cached)"""
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            self.refresh_errors += 1
+            if key in self._entries:
+                logger.warning(f"Forecast refresh failed, keeping stale entry: {error}")
+            return
+        entry = task.result()
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._evict()
+        for listener in self._listeners:
+            try:
+                listener(key, entry)
+            except Exception as e:
+                logger.error(f"Forecast listener failed: {str(e)}")
+
+    def _evict(self):
+        """Drop least recently used entries beyond max_entries, pinned keys stay"""
+        while len(self._entries) > self.max_entries:
+            victim = next((key for key in self._entries if key not in self._pinned), None)
+            if victim is None:
+                return
+            del self._entries[victim]
+            self.evicted += 1
+
+    def add_listener(self, listener: Callable[[Hashable, CacheEntry], None]):
+        """Register a callback for every fresh forecast (initial fetches and refreshes)"""
+        self._listeners.append(listener)
+
+    def pin(self, key: Hashable, fetch: Fetcher):
+        """Always keep key refreshed, even without recent requests"""
+        self._fetchers[key] = fetch
+        self._pinned.add(key)
+
+    def unpin(self, key: Hashable):
+        """Let key go cold again once nobody requests it"""
+        self._pinned.discard(key)
+
+    async def refresh_due(self, within_seconds: float, hot_window: float) -> int:
+        """
+        Refresh pinned keys and keys requested in the last hot_window seconds
+        whose entry expires within within_seconds. Returns the number refreshed.
+        """
+        now = time.monotonic()
+        due = []
+        for key, fetch in list(self._fetchers.items()):
+            hot = key in self._pinned or now - self._last_access.get(key, 0) <= hot_window
+            if not hot:
+                # Cold key - forget it so the registry stays bounded
+                self._fetchers.pop(key, None)
+                self._last_access.pop(key, None)
+                continue
+            entry = self._entries.get(key)
+            if entry is None or entry.fresh_until - now <= within_seconds:
+                due.append(self._start_fetch(key, fetch))
+        if due:
+            await asyncio.gather(*due, return_exceptions=True)
+        return len(due)
+
+    def evict_expired(self):
+        """Drop entries that are past their stale window"""
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e.stale_until <= now]:
+            del self._entries[key]
+
+    def clear(self):
+        """Drop all cached entries"""
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        """Hit/miss counters for monitoring"""
+        lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+        served = self.hits + self.stale_hits + self.coalesced
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "stale_seconds": self.stale_seconds,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "evicted": self.evicted,
+            "inflight": len(self._inflight),
+            "hot_keys": len(self._fetchers),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "refresh_errors": self.refresh_errors,
+            "hit_ratio": round(served / lookups, 4) if lookups else 0.0,
+        }
+
+
+class ForecastRefresher:
+    """
+    Background task that refreshes hot cache keys before they expire.
+    Ticks are aligned to wall-clock multiples of interval_seconds plus
+    offset_seconds, so refreshes land just after Open-Meteo publishes its
+    hourly model update.
+    """
+
+    def __init__(self, cache: ForecastCache, interval_seconds: float,
+                 offset_seconds: float = 0, hot_window: float = 3600):
+        self.cache = cache
+        self.interval_seconds = interval_seconds
+        self.offset_seconds = offset_seconds
+        self.hot_window = hot_window
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Optional[float] = None
+
+    def seconds_until_next_tick(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        phase = (now - self.offset_seconds) % self.interval_seconds
+        return self.interval_seconds - phase
+
+    async def run_once(self) -> int:
+        """Refresh everything that would expire before the next tick"""
+        refreshed = await self.cache.refresh_due(
+            within_seconds=self.interval_seconds,
+            hot_window=self.hot_window,
+        )
+        self.cache.evict_expired()
+        self.last_run = time.time()
+        return refreshed
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.seconds_until_next_tick())
+            try:
+                refreshed = await self.run_once()
+                logger.info(f"Forecast refresher updated {refreshed} location(s)")
+            except Exception as e:
+                logger.error(f"Forecast refresher error: {str(e)}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,191 @@
+"""
+Weather report sections for the API
+Each section has its own builder, so callers (/api, /api/batch) only compute
+the sections they actually return.
+"""
+
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterable, List, Tuple
+
+from resample import resample_hourly
+
+SECTIONS = ("current", "daily", "moisture", "irrigation", "forecast", "raw_data")
+
+# Soil moisture (m³/m³) at or below which irrigation is advised
+IRRIGATION_THRESHOLD = 0.14
+
+
+@dataclass
+class ReportOptions:
+    """Resampling options shared by all sections of one report"""
+    start: datetime
+    window_hours: int
+    days: int
+    aggregations: List[Tuple[str, str]]
+
+
+def forecast_section(periods: list, window_hours: int, days: int) -> dict:
+    """Forecast block of the API response"""
+    section = {
+        "window_hours": window_hours,
+        "days": days,
+        "periods": periods,
+        "forecast_periods": len(periods)
+    }
+    if periods and "precipitation_sum" in periods[0]:
+        section["total_precipitation_mm"] = round(sum(p['precipitation_sum'] or 0 for p in periods), 2)
+    return section
+
+
+def soil_moisture_level(weather_data: dict) -> float:
+    """Soil moisture the irrigation advice is based on"""
+    return weather_data['hourly']['soil_moisture_27_to_81cm'][0]
+
+
+def irrigation_section(soil_moisture: float) -> dict:
+    needs_water = soil_moisture <= IRRIGATION_THRESHOLD
+    return {
+        "advice": "Geef water" if needs_water else "Water geven is nu niet nodig",
+        "advice_english": "Give water" if needs_water else "Watering not needed now",
+        "needs_water": needs_water,
+        "threshold": IRRIGATION_THRESHOLD,
+        "current_level": soil_moisture
+    }
+
+
+def _current(weather_data: dict, options: ReportOptions) -> dict:
+    return {
+        "temperature_celsius": weather_data['current']['temperature_2m'],
+        "temperature_fahrenheit": round(weather_data['current']['temperature_2m'] * 9/5 + 32, 1),
+        "timestamp": weather_data['current']['time']
+    }
+
+
+def _daily(weather_data: dict, options: ReportOptions) -> dict:
+    daylight = weather_data['daily']['daylight_duration'][0]
+    return {
+        "temperature_min_celsius": min(weather_data['daily']['temperature_2m_min']),
+        "temperature_max_celsius": max(weather_data['daily']['temperature_2m_max']),
+        "daylight_duration_seconds": daylight,
+        "daylight_hours": round(daylight / 3600),
+        "daylight_minutes": round((daylight % 3600) / 60),
+        "daylight_formatted": f"{round(daylight / 3600)}h {round((daylight % 3600) / 60)}m"
+    }
+
+
+def _moisture(weather_data: dict, options: ReportOptions) -> dict:
+    soil_moisture = weather_data['hourly']['soil_moisture_27_to_81cm'][0]
+    return {
+        "soil_moisture_27_to_81cm_percentage": round(soil_moisture * 100, 2),
+        "soil_moisture_raw": soil_moisture,
+        "relative_humidity_percentage": weather_data['hourly']['relative_humidity_2m'][0],
+        "timestamp": datetime.utcnow().isoformat() + "Z"
+    }
+
+
+def _irrigation(weather_data: dict, options: ReportOptions) -> dict:
+    return irrigation_section(soil_moisture_level(weather_data))
+
+
+def _forecast(weather_data: dict, options: ReportOptions) -> dict:
+    periods = resample_hourly(
+        weather_data['hourly'], options.aggregations, options.start,
+        options.window_hours, options.days * 24
+    )
+    return forecast_section(periods, options.window_hours, options.days)
+
+
+def _raw_data(weather_data: dict, options: ReportOptions) -> dict:
+    return {
+        "note": "Full hourly and daily data from Open-Meteo API",
+        "daily": weather_data['daily'],
+        "hourly_sample": {
+            "precipitation_first_24h": weather_data['hourly']['precipitation'][:24],
+            "relative_humidity_first_24h": weather_data['hourly']['relative_humidity_2m'][:24],
+            "soil_moisture_first_24h": weather_data['hourly']['soil_moisture_27_to_81cm'][:24]
+        }
+    }
+
+
+_BUILDERS = {
+    "current": _current,
+    "daily": _daily,
+    "moisture": _moisture,
+    "irrigation": _irrigation,
+    "forecast": _forecast,
+    "raw_data": _raw_data,
+}
+
+
+def build_sections(weather_data: dict, options: ReportOptions, sections: Iterable[str] = SECTIONS) -> dict:
+    """Build the requested sections from an Open-Meteo response (in SECTIONS order)"""
+    wanted = set(sections)
+    return {name: _BUILDERS[name](weather_data, options) for name in SECTIONS if name in wanted}
+
+
+def personalize(report: dict, language: str = "nl", units: str = "metric") -> dict:
+    """Apply user preferences to built sections in place: advice language and imperial units"""
+    irrigation = report.get("irrigation")
+    if irrigation is not None and language == "en":
+        irrigation["advice"] = irrigation["advice_english"]
+    if units == "imperial":
+        daily = report.get("daily")
+        if daily is not None:
+            daily["temperature_min_fahrenheit"] = round(daily["temperature_min_celsius"] * 9/5 + 32, 1)
+            daily["temperature_max_fahrenheit"] = round(daily["temperature_max_celsius"] * 9/5 + 32, 1)
+        forecast = report.get("forecast")
+        if forecast is not None and "total_precipitation_mm" in forecast:
+            forecast["total_precipitation_inches"] = round(forecast["total_precipitation_mm"] / 25.4, 2)
+    return report
+
+
+def build_test_sections(options: ReportOptions, sections: Iterable[str] = SECTIONS) -> dict:
+    """Random sections for the test API key"""
+    wanted = set(sections)
+    current_temp = round(random.uniform(15.0, 30.0), 1)
+    soil_moisture = round(random.uniform(0.10, 0.20), 4)
+    report = {}
+
+    if "current" in wanted:
+        report["current"] = {
+            "temperature_celsius": current_temp,
+            "temperature_fahrenheit": round(current_temp * 9/5 + 32, 1),
+            "timestamp": datetime.utcnow().isoformat() + "Z"
+        }
+    if "daily" in wanted:
+        report["daily"] = {
+            "temperature_min_celsius": round(random.uniform(10.0, 18.0), 1),
+            "temperature_max_celsius": round(random.uniform(20.0, 35.0), 1),
+            "daylight_duration_seconds": random.randint(43200, 54000),
+            "daylight_hours": random.randint(12, 15),
+            "daylight_minutes": random.randint(0, 59),
+            "daylight_formatted": f"{random.randint(12, 15)}h {random.randint(0, 59)}m"
+        }
+    if "moisture" in wanted:
+        report["moisture"] = {
+            "soil_moisture_27_to_81cm_percentage": round(soil_moisture * 100, 2),
+            "soil_moisture_raw": soil_moisture,
+            "relative_humidity_percentage": random.randint(40, 80),
+            "timestamp": datetime.utcnow().isoformat() + "Z"
+        }
+    if "irrigation" in wanted:
+        report["irrigation"] = irrigation_section(soil_moisture)
+    if "forecast" in wanted:
+        # Random forecast periods in the requested shape
+        periods = []
+        for i in range(options.days * 24 // options.window_hours):
+            period = {
+                "start": (options.start + timedelta(hours=i * options.window_hours)).strftime("%Y-%m-%dT%H:%M"),
+                "period_hours": options.window_hours
+            }
+            for variable, how in options.aggregations:
+                period[f"{variable}_{how}"] = round(random.uniform(0.0, 15.0), 2)
+            periods.append(period)
+        report["forecast"] = forecast_section(periods, options.window_hours, options.days)
+    if "raw_data" in wanted:
+        report["raw_data"] = {
+            "note": "Random test data - not real measurements"
+        }
+    return report
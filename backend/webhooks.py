@@ -0,0 +1,476 @@
+"""
+Webhooks for advice and forecast changes
+- Registrations are stored in SQLite and grouped in memory by forecast key
+  (grid cell), like alert subscriptions
+- Every fetched or refreshed forecast is summarised once per cell (irrigation
+  advice and forecast totals as served by /api); changes become events
+- Events are delivered as signed JSON over one shared HTTP connection pool,
+  queued per endpoint (origin) with a per-endpoint concurrency limit, batched
+  and signed per webhook, with retries with exponential backoff and full jitter
+- Only https URLs whose host resolves to public addresses are accepted, checked
+  at registration and again before every delivery (requests go to the checked
+  address, so a changed DNS answer can't redirect them to internal services)
+Pending events are kept in memory; they are not replayed after a restart.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import logging
+import random
+import secrets
+import socket
+import sqlite3
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Deque, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+import httpx
+import orjson
+
+from weather_cache import CacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Event types a webhook can subscribe to
+EVENTS = ("advice", "forecast")
+
+SIGNATURE_HEADER = "X-TropoMetrics-Signature"
+TIMESTAMP_HEADER = "X-TropoMetrics-Timestamp"
+DELIVERY_HEADER = "X-TropoMetrics-Delivery"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhooks (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    secret TEXT NOT NULL,
+    events TEXT NOT NULL,
+    latitude REAL NOT NULL,
+    longitude REAL NOT NULL,
+    location_id TEXT,
+    created_at REAL NOT NULL,
+    owner TEXT
+);
+"""
+
+_COLUMNS = "url, secret, events, latitude, longitude, location_id, id, created_at, owner"
+
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    """HMAC-SHA256 over "<timestamp>.<body>", hex encoded"""
+    return hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+
+
+class WebhookUrlError(ValueError):
+    """A webhook URL that must not be called; the message is safe to show the client"""
+
+
+class Target(NamedTuple):
+    """Where a delivery goes: the URL with its host replaced by a checked address"""
+    url: str
+    host: str           # Host header
+    extensions: dict    # TLS server name for certificate checks
+
+
+def endpoint(url: str) -> str:
+    """Normalized origin of a URL - deliveries to it share a queue and concurrency limit"""
+    parsed = httpx.URL(url)
+    return f"{parsed.scheme}://{parsed.host}:{parsed.port or (443 if parsed.scheme == 'https' else 80)}"
+
+
+async def resolve_target(url: str, allow_local: bool = False) -> Target:
+    """
+    Check url against server-side request forgery and pin it to the checked address
+    https only, and every address the host resolves to must be public (no loopback,
+    private, link-local, reserved or multicast ranges). allow_local accepts http and
+    any address, for tests and local development. Raises WebhookUrlError, or
+    socket.gaierror when the host does not resolve.
+    """
+    parsed = httpx.URL(url)
+    if parsed.scheme != "https" and not (allow_local and parsed.scheme == "http"):
+        raise WebhookUrlError("Webhook URL must use https")
+    if not parsed.host:
+        raise WebhookUrlError("Webhook URL must have a host")
+    if parsed.userinfo:
+        raise WebhookUrlError("Webhook URL must not contain credentials")
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        parsed.host, parsed.port or (443 if parsed.scheme == "https" else 80), type=socket.SOCK_STREAM
+    )
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not allow_local and (not ip.is_global or ip.is_multicast):
+            raise WebhookUrlError("Webhook URL must not point to a private, loopback, link-local or reserved address")
+    return Target(
+        str(parsed.copy_with(host=addresses[0])),
+        parsed.netloc.decode(),
+        {"sni_hostname": parsed.host} if parsed.scheme == "https" else {},
+    )
+
+
+@dataclass
+class Webhook:
+    """One registered endpoint watching one location"""
+    url: str
+    secret: str
+    events: str                     # comma-separated subset of EVENTS
+    latitude: float
+    longitude: float
+    location_id: Optional[str] = None
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    created_at: float = field(default_factory=time.time)
+    owner: Optional[str] = None     # API key id that registered it
+
+    def wants(self, event_type: str) -> bool:
+        return event_type.split(".")[0] in self.events.split(",")
+
+    def to_dict(self, include_secret: bool = False) -> dict:
+        data = {
+            "id": self.id,
+            "url": self.url,
+            "events": self.events.split(","),
+            "location": {"id": self.location_id, "latitude": self.latitude, "longitude": self.longitude},
+            "created_at": self.created_at,
+        }
+        if include_secret:
+            data["secret"] = self.secret
+        return data
+
+
+def new_secret() -> str:
+    return secrets.token_hex(24)
+
+
+class WebhookRegistry:
+    """Durable webhook store with an in-memory index per forecast key"""
+
+    def __init__(self, path: str, key_for: Callable[[Webhook], Hashable]):
+        self.path = path
+        self.key_for = key_for
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._db: Optional[sqlite3.Connection] = None
+        self._webhooks: Dict[str, Webhook] = {}
+        self._groups: Dict[Hashable, Dict[str, Webhook]] = {}
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _open(self) -> list:
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(webhooks)")}
+        if "owner" not in columns:
+            # Registrations from before owners were recorded are only visible to admin keys
+            self._db.execute("ALTER TABLE webhooks ADD COLUMN owner TEXT")
+        return self._db.execute(f"SELECT {_COLUMNS} FROM webhooks").fetchall()
+
+    async def open(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webhooks")
+        for row in await self._run(self._open):
+            self._index(Webhook(*row))
+        logger.info(f"Loaded {len(self._webhooks)} webhook(s) for {len(self._groups)} location(s)")
+
+    async def close(self):
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._webhooks.clear()
+        self._groups.clear()
+
+    def _index(self, webhook: Webhook) -> Hashable:
+        key = self.key_for(webhook)
+        self._webhooks[webhook.id] = webhook
+        self._groups.setdefault(key, {})[webhook.id] = webhook
+        return key
+
+    def _insert(self, webhook: Webhook):
+        self._db.execute(
+            f"INSERT INTO webhooks ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (webhook.url, webhook.secret, webhook.events, webhook.latitude, webhook.longitude,
+             webhook.location_id, webhook.id, webhook.created_at, webhook.owner)
+        )
+
+    async def add(self, webhook: Webhook) -> Hashable:
+        """Store and index webhook, returns its forecast key"""
+        await self._run(self._insert, webhook)
+        return self._index(webhook)
+
+    def _delete(self, webhook_id: str):
+        self._db.execute("DELETE FROM webhooks WHERE id = ?", (webhook_id,))
+
+    async def remove(self, webhook_id: str) -> Optional[Tuple[Webhook, Hashable, bool]]:
+        """Delete a webhook; returns (webhook, key, last one for key) or None"""
+        webhook = self._webhooks.pop(webhook_id, None)
+        if webhook is None:
+            return None
+        await self._run(self._delete, webhook_id)
+        key = self.key_for(webhook)
+        group = self._groups[key]
+        group.pop(webhook_id, None)
+        if not group:
+            del self._groups[key]
+        return webhook, key, key not in self._groups
+
+    def get(self, webhook_id: str) -> Optional[Webhook]:
+        return self._webhooks.get(webhook_id)
+
+    def group(self, key: Hashable) -> List[Webhook]:
+        return list(self._groups.get(key, {}).values())
+
+    def keys(self) -> List[Hashable]:
+        return list(self._groups)
+
+    def stats(self) -> dict:
+        return {"webhooks": len(self._webhooks), "locations": len(self._groups)}
+
+
+def change_events(previous: dict, current: dict) -> List[dict]:
+    """Events for the differences between two forecast summaries"""
+    events = []
+    if previous["needs_water"] != current["needs_water"]:
+        fields = ("needs_water", "advice", "soil_moisture", "threshold")
+        events.append({
+            "type": "advice.changed",
+            "previous": {name: previous[name] for name in fields},
+            "current": {name: current[name] for name in fields},
+        })
+    if previous["total_precipitation_mm"] != current["total_precipitation_mm"]:
+        fields = ("total_precipitation_mm", "window_hours", "days")
+        events.append({
+            "type": "forecast.changed",
+            "previous": {name: previous[name] for name in fields},
+            "current": {name: current[name] for name in fields},
+        })
+    return events
+
+
+class WebhookDispatcher:
+    """Detects changes per forecast key and delivers batched, signed events"""
+
+    def __init__(self, registry: WebhookRegistry, summarize: Callable[[dict], dict],
+                 concurrency: int = 2, max_batch: int = 50, batch_window: float = 0.5,
+                 max_attempts: int = 6, backoff_base: float = 1, backoff_max: float = 300,
+                 max_pending: int = 1000, timeout: float = 10, max_connections: int = 50,
+                 allow_local: bool = False):
+        self.registry = registry
+        self.summarize = summarize
+        self.concurrency = concurrency
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.allow_local = allow_local
+        self._client: Optional[httpx.AsyncClient] = None
+        # Last summary per forecast key, the baseline for change detection
+        self._summaries: Dict[Hashable, dict] = {}
+        # Per endpoint (origin): pending (webhook, event) pairs and running delivery tasks
+        self._queues: Dict[str, Deque[Tuple[Webhook, dict]]] = {}
+        self._workers: Dict[str, set] = {}
+        # Per webhook: last delivery result
+        self._status: Dict[str, dict] = {}
+        self.events = 0
+        self.deliveries = 0
+        self.delivered = 0
+        self.retries = 0
+        self.failed = 0
+        self.dropped = 0
+
+    # --- change detection --------------------------------------------------
+
+    def prime(self, key: Hashable, entry: CacheEntry):
+        """Set the baseline for key if it has none yet (new registrations)"""
+        if key not in self._summaries:
+            self.on_forecast(key, entry)
+
+    def on_forecast(self, key: Hashable, entry: CacheEntry):
+        """Cache listener - summarise once per key, fan events out to its webhooks"""
+        webhooks = self.registry.group(key)
+        if not webhooks:
+            self._summaries.pop(key, None)
+            return
+        try:
+            current = self.summarize(entry.value)
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logger.warning(f"Webhook summary failed: {str(e)}")
+            return
+        previous = self._summaries.get(key)
+        self._summaries[key] = current
+        if previous is None:
+            return
+        events = change_events(previous, current)
+        if not events:
+            return
+        occurred_at = datetime.utcnow().isoformat() + "Z"
+        for webhook in webhooks:
+            for event in events:
+                if webhook.wants(event["type"]):
+                    self.enqueue(webhook, {
+                        **event,
+                        "id": uuid.uuid4().hex,
+                        "occurred_at": occurred_at,
+                        "location": webhook.to_dict()["location"],
+                        "data_version": entry.version,
+                    })
+
+    # --- delivery ----------------------------------------------------------
+
+    def enqueue(self, webhook: Webhook, event: dict):
+        target = endpoint(webhook.url)
+        queue = self._queues.setdefault(target, deque(maxlen=self.max_pending))
+        if len(queue) == self.max_pending:
+            # Oldest event is pushed out - a stuck endpoint can't grow memory
+            self.dropped += 1
+        queue.append((webhook, event))
+        self.events += 1
+        workers = self._workers.setdefault(target, set())
+        if self._client is not None and len(workers) < self.concurrency and len(queue) > len(workers) * self.max_batch:
+            workers.add(asyncio.ensure_future(self._drain(target)))
+
+    async def _drain(self, target: str):
+        """Deliver batches for one endpoint until its queue is empty"""
+        try:
+            while True:
+                queue = self._queues.get(target)
+                if queue and len(queue) < self.max_batch and self.batch_window:
+                    # Let the rest of a refresh round join this batch
+                    await asyncio.sleep(self.batch_window)
+                if not queue:
+                    return
+                # One signed delivery per webhook in the batch, each with its own secret
+                batches: Dict[str, List[dict]] = {}
+                for _ in range(min(self.max_batch, len(queue))):
+                    webhook, event = queue.popleft()
+                    batches.setdefault(webhook.id, []).append(event)
+                for webhook_id, batch in batches.items():
+                    webhook = self.registry.get(webhook_id)
+                    if webhook is not None:
+                        await self._deliver(webhook, batch)
+        finally:
+            # Synchronously with the empty-queue check, so enqueue() never sees a finished worker
+            self._workers.get(target, set()).discard(asyncio.current_task())
+
+    async def _deliver(self, webhook: Webhook, batch: List[dict]) -> bool:
+        delivery_id = uuid.uuid4().hex
+        body = orjson.dumps({"delivery_id": delivery_id, "webhook_id": webhook.id, "events": batch})
+        self.deliveries += 1
+        error = reason = None
+        for attempt in range(1, self.max_attempts + 1):
+            retry_after = 0.0
+            try:
+                # Checked before every attempt - the host may resolve elsewhere by now
+                target = await resolve_target(webhook.url, self.allow_local)
+                timestamp = str(int(time.time()))
+                headers = {
+                    "Host": target.host,
+                    "Content-Type": "application/json",
+                    "User-Agent": "TropoMetrics-Webhooks/1.0",
+                    DELIVERY_HEADER: delivery_id,
+                    TIMESTAMP_HEADER: timestamp,
+                    SIGNATURE_HEADER: "sha256=" + sign(webhook.secret, timestamp, body),
+                }
+                response = await self._client.post(target.url, content=body, headers=headers,
+                                                   extensions=target.extensions)
+            except WebhookUrlError as e:
+                error, reason, retryable = str(e), "blocked_address", False
+            except socket.gaierror as e:
+                error, reason, retryable = f"DNS: {str(e)}", "dns_error", True
+            except httpx.TimeoutException as e:
+                error, reason, retryable = f"{type(e).__name__}: {str(e)}", "timeout", True
+            except httpx.HTTPError as e:
+                error, reason, retryable = f"{type(e).__name__}: {str(e)}", "connection_failed", True
+            else:
+                if response.status_code < 300:
+                    self.delivered += len(batch)
+                    self._set_status(webhook, "delivered", None)
+                    return True
+                error, reason = f"HTTP {response.status_code}", "endpoint_error"
+                retryable = response.status_code in (408, 429) or response.status_code >= 500
+                try:
+                    retry_after = float(response.headers.get("Retry-After", 0))
+                except ValueError:
+                    retry_after = 0.0
+            if not retryable or attempt == self.max_attempts:
+                break
+            self.retries += 1
+            # Full jitter: failing endpoints don't get hit by synchronised retries
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+            await asyncio.sleep(max(delay, min(retry_after, self.backoff_max)))
+
+        # The raw error stays in the log; clients only see the reason
+        logger.warning(f"Webhook {webhook.id} delivery {delivery_id} failed: {error}")
+        self.failed += len(batch)
+        self._set_status(webhook, "failed", reason)
+        return False
+
+    def _set_status(self, webhook: Webhook, result: str, reason: Optional[str]):
+        self._status[webhook.id] = {"last_delivery_at": time.time(), "last_result": result, "last_error": reason}
+
+    def status(self, webhook: Webhook) -> dict:
+        """Last delivery result - last_error is one of a fixed set of reasons, never upstream text"""
+        queue = self._queues.get(endpoint(webhook.url), ())
+        return {
+            **self._status.get(webhook.id, {"last_delivery_at": None, "last_result": None, "last_error": None}),
+            "pending": sum(1 for queued, _ in queue if queued.id == webhook.id),
+        }
+
+    def forget(self, webhook: Webhook, key: Hashable, last: bool):
+        """Drop pending events (and the key's baseline) of a deleted webhook"""
+        queue = self._queues.get(endpoint(webhook.url))
+        if queue:
+            # Other webhooks may share the endpoint - keep their events and workers
+            remaining = [item for item in queue if item[0].id != webhook.id]
+            queue.clear()
+            queue.extend(remaining)
+        self._status.pop(webhook.id, None)
+        if last:
+            self._summaries.pop(key, None)
+
+    # --- lifecycle ---------------------------------------------------------
+
+    def start(self):
+        if self._client is None:
+            # One pool for all endpoints, separate from the upstream client
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections),
+            )
+
+    async def stop(self, drain_timeout: float = 5):
+        """Give running deliveries a moment to finish, then cancel and close the pool"""
+        tasks = [task for workers in self._workers.values() for task in workers]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._workers.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            **self.registry.stats(),
+            "events": self.events,
+            "deliveries": self.deliveries,
+            "delivered_events": self.delivered,
+            "retries": self.retries,
+            "failed_events": self.failed,
+            "dropped_events": self.dropped,
+            "pending_events": sum(len(queue) for queue in self._queues.values()),
+        }
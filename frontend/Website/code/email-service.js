@@ -81,7 +81,8 @@ async function sendEmail(to, subject, body, html = false) {
 
         return {
             success: true,
-            message: data.message
+            message: data.message,
+            messageId: data.message_id
         };
     } catch (error) {
         console.error('Email sending failed:', error);
@@ -9,6 +9,8 @@ echo "🔧 Configuring nginx reverse proxy and email API..."
 # Get backend service name from environment variable or use default
 BACKEND_SERVICE_NAME=${BACKEND_SERVICE:-tropometrics-backend}
 BACKEND_PORT=${BACKEND_PORT:-8000}
+# State service (email outbox, subscriptions) - the backend itself when it runs as one container
+STATE_SERVICE_NAME=${STATE_SERVICE:-$BACKEND_SERVICE_NAME}
 
 # Create code directory if it doesn't exist
 mkdir -p /usr/share/nginx/html/code
@@ -31,9 +33,11 @@ EOF
 # Update nginx configuration with actual backend service name
 sed -i "s/BACKEND_SERVICE_PLACEHOLDER/${BACKEND_SERVICE_NAME}/g" /etc/nginx/conf.d/default.conf
 sed -i "s/BACKEND_PORT_PLACEHOLDER/${BACKEND_PORT}/g" /etc/nginx/conf.d/default.conf
+sed -i "s/STATE_SERVICE_PLACEHOLDER/${STATE_SERVICE_NAME}/g" /etc/nginx/conf.d/default.conf
 
 echo "✅ Email API configuration injected successfully"
 echo "📧 Backend service: ${BACKEND_SERVICE_NAME}:${BACKEND_PORT}"
+echo "📧 State service: ${STATE_SERVICE_NAME}:${BACKEND_PORT}"
 echo "📧 Frontend uses same-origin requests (proxied by nginx)"
 echo "📝 Updated nginx config: /etc/nginx/conf.d/default.conf"
 
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+"""
+API Benchmark Suite
+Drives the backend in-process (ASGI transport) with Open-Meteo replaced by a
+recorded forecast (fixtures/open_meteo_forecast.json) and SMTP by a local stub,
+so the numbers need no cluster or network and are comparable between runs:
+- /api with the test key (random data) and the demo key (Open-Meteo data)
+- forecast cache hot (default location) and cold (a new grid cell per request)
+- JSON and HTML output
+- /api/send-email acceptance and background delivery to the stub SMTP server
+Results are written to results/resultatenBenchmark.csv and compared with a stored
+baseline: a scenario whose median latency or throughput is more than
+--threshold percent worse is flagged and the script exits with 1.
+
+Usage:
+    python benchmark_api.py                       # run and compare with results/benchmark_baseline.json
+    python benchmark_api.py --save-baseline       # run and store the results as the new baseline
+    python benchmark_api.py --requests 500 --concurrency 10 --threshold 20
+    python benchmark_api.py --record              # refresh the fixture from the live Open-Meteo API
+"""
+
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from helpers import configure_backend, free_port, results_path
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "open_meteo_forecast.json")
+RESULTS_CSV = results_path("resultatenBenchmark.csv")
+SMTP_USER = "bench@tropometrics.local"
+SMTP_PASSWORD = "bench-password"
+
+
+class CountingHandler:
+    """Stub SMTP server: accepts and counts messages"""
+
+    def __init__(self):
+        self.delivered = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.delivered += 1
+        return "250 Message accepted for delivery"
+
+
+def authenticator(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=auth_data.login.decode() == SMTP_USER)
+
+
+smtp_handler = CountingHandler()
+smtp_port = free_port()
+smtp_server = Controller(
+    smtp_handler, hostname="127.0.0.1", port=smtp_port,
+    authenticator=authenticator, auth_require_tls=False
+)
+
+# Configure the backend for the stand-ins before importing it
+configure_backend(
+    EMAIL_USERNAME=SMTP_USER,
+    EMAIL_PASSWORD=SMTP_PASSWORD,
+    EMAIL_SERVER=f"127.0.0.1:{smtp_port}",
+    EMAIL_STARTTLS="false",
+    RATE_LIMIT_ENABLED="false",
+)
+
+import logging  # noqa: E402
+
+import httpx  # noqa: E402
+import orjson  # noqa: E402
+
+import main  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def load_fixture() -> dict:
+    """The recorded forecast, moved to start today (windows start at the location's current hour)"""
+    with open(FIXTURE, encoding="utf-8") as f:
+        forecast = json.load(f)
+    today = (datetime.utcnow() + timedelta(seconds=forecast["utc_offset_seconds"])).date()
+    shift = today - datetime.fromisoformat(forecast["hourly"]["time"][0]).date()
+
+    def moved(value):
+        pattern = "%Y-%m-%dT%H:%M" if "T" in value else "%Y-%m-%d"
+        return (datetime.strptime(value, pattern) + shift).strftime(pattern)
+
+    forecast["hourly"]["time"] = [moved(value) for value in forecast["hourly"]["time"]]
+    forecast["daily"]["time"] = [moved(value) for value in forecast["daily"]["time"]]
+    forecast["current"]["time"] = moved(forecast["current"]["time"])
+    return forecast
+
+
+class RecordedUpstream:
+    """MockTransport handler answering every forecast request with the fixture"""
+
+    def __init__(self, forecast: dict):
+        self.body = orjson.dumps(forecast)
+        self.calls = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        count = len(request.url.params["latitude"].split(","))
+        content = self.body if count == 1 else b"[" + b",".join([self.body] * count) + b"]"
+        return httpx.Response(200, content=content, headers={"content-type": "application/json"})
+
+
+upstream = RecordedUpstream(load_fixture())
+# The lifespan builds its upstream client through this factory - the warm-up already uses the fixture
+main.create_http_client = lambda: httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+
+# Every cold request asks for a grid cell nobody asked for before
+cold_cells = itertools.count()
+
+
+def cold_location(i: int) -> str:
+    return f"latitude={-60 + (i // 3000) * 0.1:.1f}&longitude={-179.9 + (i % 3000) * 0.1:.1f}"
+
+
+async def get_ok(client, url):
+    response = await client.get(url)
+    assert response.status_code == 200, f"{url}: {response.status_code} {response.text[:200]}"
+
+
+async def post_email(client, i):
+    response = await client.post("/api/send-email", json={
+        "to": f"farmer{i}@example.com", "subject": f"Benchmark {i}", "body": "Heavy rain expected."
+    })
+    assert response.status_code == 202, response.text
+
+
+SCENARIOS = {
+    "test json": lambda client, i: get_ok(client, "/api?api_key=test"),
+    "test html": lambda client, i: get_ok(client, "/api?api_key=test&format=html"),
+    "demo hot json": lambda client, i: get_ok(client, "/api?api_key=demo"),
+    "demo hot html": lambda client, i: get_ok(client, "/api?api_key=demo&format=html"),
+    "demo cold json": lambda client, i: get_ok(client, f"/api?api_key=demo&{cold_location(next(cold_cells))}"),
+    "demo cold html": lambda client, i: get_ok(client, f"/api?api_key=demo&format=html&{cold_location(next(cold_cells))}"),
+    "send_email": post_email,
+}
+
+
+async def load(client, request, requests, concurrency):
+    """requests requests from concurrency concurrent clients, returns (latencies, seconds)"""
+    latencies = []
+    remaining = iter(range(requests))
+
+    async def worker():
+        for i in remaining:
+            tijd_start = time.perf_counter()
+            await request(client, i)
+            latencies.append(time.perf_counter() - tijd_start)
+
+    tijd_start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, time.perf_counter() - tijd_start
+
+
+async def wait_for_delivery(expected, timeout=60):
+    deadline = time.monotonic() + timeout
+    while smtp_handler.delivered < expected:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{smtp_handler.delivered}/{expected} emails delivered")
+        await asyncio.sleep(0.005)
+
+
+async def benchmark(args) -> list:
+    resultaten = []
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            for name, request in SCENARIOS.items():
+                emails = name == "send_email"
+                # Warm-up: imports, template caches, SQLite pages, the hot forecast, the SMTP connections
+                warmup = min(args.requests, 200)
+                expected = smtp_handler.delivered + warmup
+                await load(client, request, warmup, args.concurrency)
+                if emails:
+                    await wait_for_delivery(expected)
+                calls = upstream.calls
+                latencies, rates, delivery_rates = [], [], []
+                for _ in range(args.rounds):
+                    expected = smtp_handler.delivered + args.requests
+                    round_latencies, seconds = await load(client, request, args.requests, args.concurrency)
+                    latencies += round_latencies
+                    rates.append(args.requests / seconds)
+                    if emails:
+                        # Accepted is not sent - the queue drains to the stub SMTP server in the background
+                        tijd_start = time.perf_counter() - seconds
+                        await wait_for_delivery(expected)
+                        delivery_rates.append(args.requests / (time.perf_counter() - tijd_start))
+                latencies.sort()
+                resultaten.append({
+                    "scenario": name,
+                    "requests": args.requests * args.rounds,
+                    "concurrency": args.concurrency,
+                    "requests_per_second": round(statistics.median(rates)),
+                    "p50_ms": round(statistics.median(latencies) * 1000, 3),
+                    "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+                    "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+                    "upstream_calls": upstream.calls - calls,
+                    "emails_per_second": round(statistics.median(delivery_rates)) if emails else None,
+                })
+                print_row(resultaten[-1])
+    return resultaten
+
+
+def print_row(row):
+    delivered = f"  ({row['emails_per_second']} emails/s delivered)" if row["emails_per_second"] else ""
+    print(f"{row['scenario']:<16} {row['requests_per_second']:>8} {row['p50_ms']:>9.3f}ms "
+          f"{row['p95_ms']:>9.3f}ms {row['p99_ms']:>9.3f}ms {row['upstream_calls']:>9}{delivered}")
+
+
+def regressions(resultaten, baseline, threshold):
+    """Scenarios more than threshold percent slower (p50) or lower in throughput than the baseline"""
+    print("-" * 78)
+    print(f"Compared with baseline of {baseline['created']} (threshold {threshold:g}%)")
+    print(f"{'scenario':<16} {'req/s':>20} {'p50':>26}")
+    flagged = []
+    previous = {row["scenario"]: row for row in baseline["scenarios"]}
+    for row in resultaten:
+        base = previous.get(row["scenario"])
+        if base is None:
+            print(f"{row['scenario']:<16} {'(new scenario)':>20}")
+            continue
+        rate_change = (row["requests_per_second"] - base["requests_per_second"]) / base["requests_per_second"] * 100
+        p50_change = (row["p50_ms"] - base["p50_ms"]) / base["p50_ms"] * 100
+        regressed = rate_change < -threshold or p50_change > threshold
+        if regressed:
+            flagged.append(row["scenario"])
+        print(
+            f"{row['scenario']:<16} {base['requests_per_second']:>7} -> {row['requests_per_second']:>6} "
+            f"{rate_change:>+6.1f}%  {base['p50_ms']:>8.3f} -> {row['p50_ms']:>8.3f}ms {p50_change:>+6.1f}%"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    if (baseline["requests"], baseline["concurrency"]) != (resultaten[0]["requests"], resultaten[0]["concurrency"]):
+        print("Note: the baseline was measured with a different number of requests or concurrency")
+    return flagged
+
+
+async def record():
+    """Replace the fixture with a live Open-Meteo response for the default location"""
+    main.app.state.http_client = httpx.AsyncClient(timeout=30)
+    async with main.app.state.http_client:
+        forecast = (await main.fetch_open_meteo([main.WEATHER_LOCATION], main.WEATHER_VARIABLES))[0]
+    with open(FIXTURE, "w", encoding="utf-8") as f:
+        json.dump(forecast, f, ensure_ascii=False, separators=(",", ":"))
+    print(f"Recorded {len(forecast['hourly']['time'])} hours to {FIXTURE}")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="In-process benchmark of the TropoMetrics API")
+    parser.add_argument("-n", "--requests", type=int, default=1000, help="requests per round (default: 1000)")
+    parser.add_argument("-c", "--concurrency", type=int, default=20, help="concurrent clients (default: 20)")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="rounds per scenario, the median throughput is reported (default: 3)")
+    parser.add_argument("--baseline", default=results_path("benchmark_baseline.json"),
+                        help="baseline file (default: results/benchmark_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--threshold", type=float, default=15,
+                        help="percent slower than the baseline that counts as a regression (default: 15)")
+    parser.add_argument("--record", action="store_true",
+                        help="refresh the Open-Meteo fixture from the live API (needs network)")
+    return parser.parse_args()
+
+
+def run():
+    args = parse_arguments()
+    if args.record:
+        asyncio.run(record())
+        return 0
+
+    smtp_server.start()
+    try:
+        print(f"Benchmarking the API in-process ({args.rounds} x {args.requests} requests, "
+              f"{args.concurrency} concurrent)")
+        print("-" * 78)
+        print(f"{'scenario':<16} {'req/s':>8} {'p50':>11} {'p95':>11} {'p99':>11} {'upstream':>9}")
+        print("-" * 78)
+        resultaten = asyncio.run(benchmark(args))
+    finally:
+        smtp_server.stop()
+
+    with open(RESULTS_CSV, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(resultaten[0]))
+        writer.writeheader()
+        writer.writerows(resultaten)
+    print(f"Results written to {RESULTS_CSV}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "created": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "requests": resultaten[0]["requests"],
+                "concurrency": args.concurrency,
+                "scenarios": resultaten,
+            }, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline} - store one with --save-baseline")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    flagged = regressions(resultaten, baseline, args.threshold)
+    if flagged:
+        print(f"Regressed: {', '.join(flagged)}")
+        return 1
+    print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Response Format Benchmark
+Compares encode time, decode time and size of the /api response in every
+supported encoding against the original json.dumps(indent=2)-in-HTML output.
+Runs in-process on a synthetic Open-Meteo forecast, no cluster or network needed.
+
+Usage:
+    python benchmark_formats.py [iterations]
+"""
+
+import csv
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Import the backend modules directly
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import cbor2  # noqa: E402
+import msgpack  # noqa: E402
+import orjson  # noqa: E402
+from rendering import BINARY_FORMATS, html_response, json_response  # noqa: E402
+from resample import window_start  # noqa: E402
+from weather_report import ReportOptions, build_sections  # noqa: E402
+
+from helpers import results_path  # noqa: E402
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+RESULTS_CSV = results_path("resultatenFormats.csv")
+
+
+def synthetic_forecast(days=7):
+    """Open-Meteo shaped response with realistic value ranges"""
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    hours = 24 * days
+    times = [(start + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(hours)]
+    return {
+        "latitude": -5.0,
+        "longitude": -58.375,
+        "utc_offset_seconds": 3600,
+        "timezone": "Europe/Amsterdam",
+        "current": {"time": times[0], "temperature_2m": 27.4},
+        "daily": {
+            "time": times[::24],
+            "temperature_2m_max": [31.2 + (i % 3) * 0.7 for i in range(days)],
+            "temperature_2m_min": [22.1 + (i % 2) * 0.4 for i in range(days)],
+            "daylight_duration": [43512.34 + i * 11.2 for i in range(days)],
+        },
+        "hourly": {
+            "time": times,
+            "precipitation": [round((i * 37 % 11) * 0.13, 2) for i in range(hours)],
+            "relative_humidity_2m": [60 + i * 7 % 35 for i in range(hours)],
+            "soil_moisture_27_to_81cm": [round(0.131 + (i % 24) * 0.0004, 3) for i in range(hours)],
+        },
+    }
+
+
+def build_payload(sections):
+    weather_data = synthetic_forecast()
+    options = ReportOptions(window_start(datetime.utcnow(), 6), 6, 5, [("precipitation", "sum")])
+    return {
+        "metadata": {
+            "service": "TropoMetrics Weather API",
+            "version": "1.0.0",
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "source": "Open-Meteo API",
+            "endpoint": "/api",
+            "served_stale": False,
+        },
+        **build_sections(weather_data, options, sections),
+    }
+
+
+def legacy_html(payload):
+    """The original /api output: indented json.dumps wrapped in an f-string page"""
+    json_str = json.dumps(payload, indent=2)
+    return f"""
+            <!DOCTYPE html>
+            <html lang="en">
+            <head>
+                <meta charset="UTF-8">
+                <title>TropoMetrics Weather API</title>
+            </head>
+            <body>
+                <pre>{json_str}</pre>
+            </body>
+            </html>
+            """.encode()
+
+
+ENCODERS = {
+    "legacy-html": (legacy_html, None),
+    "html": (lambda p: html_response(p).body, None),
+    "json": (lambda p: json_response(p).body, orjson.loads),
+    "msgpack": (BINARY_FORMATS["msgpack"][1], msgpack.unpackb),
+    "cbor": (BINARY_FORMATS["cbor"][1], cbor2.loads),
+}
+
+PAYLOADS = {
+    "full": ("current", "daily", "moisture", "irrigation", "forecast", "raw_data"),
+    "device": ("irrigation", "forecast"),
+}
+
+
+def time_call(function, argument):
+    samples = []
+    for _ in range(ITERATIONS):
+        tijd_start = time.perf_counter()
+        function(argument)
+        samples.append(time.perf_counter() - tijd_start)
+    return samples
+
+
+resultaten = []
+print(f"Benchmarking response encodings ({ITERATIONS} iterations each)")
+print("-" * 88)
+print(f"{'payload':<8} {'format':<12} {'bytes':>8} {'gzip':>8} {'encode p50':>12} {'encode mean':>12} {'decode p50':>12}")
+print("-" * 88)
+
+for payload_name, sections in PAYLOADS.items():
+    payload = build_payload(sections)
+    for format_name, (encode, decode) in ENCODERS.items():
+        body = encode(payload)
+        encode_samples = time_call(encode, payload)
+        decode_samples = time_call(decode, body) if decode else None
+        row = {
+            "payload": payload_name,
+            "format": format_name,
+            "bytes": len(body),
+            "gzip_bytes": len(gzip.compress(body)),
+            "encode_p50_us": round(statistics.median(encode_samples) * 1e6, 2),
+            "encode_mean_us": round(statistics.mean(encode_samples) * 1e6, 2),
+            "decode_p50_us": round(statistics.median(decode_samples) * 1e6, 2) if decode_samples else "",
+        }
+        resultaten.append(row)
+        print(
+            f"{row['payload']:<8} {row['format']:<12} {row['bytes']:>8} {row['gzip_bytes']:>8} "
+            f"{row['encode_p50_us']:>10}us {row['encode_mean_us']:>10}us "
+            f"{(str(row['decode_p50_us']) + 'us') if decode_samples else '-':>12}"
+        )
+
+with open(RESULTS_CSV, "w", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames=list(resultaten[0]))
+    writer.writeheader()
+    writer.writerows(resultaten)
+
+print("-" * 88)
+print(f"Results written to {RESULTS_CSV}")
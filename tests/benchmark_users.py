@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+User Profile Benchmark
+Per-request cost of personalizing /api under concurrent load. Compares a key
+without a user, a key with a cached profile and the same profile with the
+cache disabled (one SQLite read per request), and the bare profile lookup.
+Runs in-process on a synthetic forecast, no cluster or network needed.
+
+Usage:
+    python benchmark_users.py [requests] [concurrency]
+"""
+
+import asyncio
+import csv
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from helpers import configure_backend, results_path
+
+configure_backend()
+
+import logging  # noqa: E402
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+RESULTS_CSV = results_path("resultatenUsers.csv")
+
+main.limiter.enabled = False
+logging.getLogger().setLevel(logging.WARNING)
+
+
+def synthetic_forecast(days):
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    times = [(start + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(24 * days)]
+    return {
+        "utc_offset_seconds": 0,
+        "current": {"time": times[0], "temperature_2m": 27.0},
+        "daily": {
+            "time": times[::24],
+            "temperature_2m_max": [31.0] * days,
+            "temperature_2m_min": [22.0] * days,
+            "daylight_duration": [43500.0] * days,
+        },
+        "hourly": {
+            "time": times,
+            "precipitation": [round((i * 37 % 11) * 0.13, 2) for i in range(len(times))],
+            "relative_humidity_2m": [70] * len(times),
+            "soil_moisture_27_to_81cm": [0.13] * len(times),
+        },
+    }
+
+
+async def fake_open_meteo(locations, variables, forecast_days=7):
+    return [synthetic_forecast(forecast_days) for _ in locations]
+
+
+main.fetch_open_meteo = fake_open_meteo
+
+
+async def load(client, url):
+    """REQUESTS requests from CONCURRENCY concurrent clients, returns (latencies, seconds)"""
+    latencies = []
+    remaining = iter(range(REQUESTS))
+
+    async def worker():
+        for _ in remaining:
+            tijd_start = time.perf_counter()
+            response = await client.get(url)
+            latencies.append(time.perf_counter() - tijd_start)
+            assert response.status_code == 200, response.text
+
+    tijd_start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(CONCURRENCY)])
+    return latencies, time.perf_counter() - tijd_start
+
+
+async def lookups(api_key_id, count=20000):
+    """Mean cost of user_store.profile() with CONCURRENCY concurrent callers"""
+    async def worker(n):
+        for _ in range(n):
+            await main.user_store.profile(api_key_id)
+
+    tijd_start = time.perf_counter()
+    await asyncio.gather(*[worker(count // CONCURRENCY) for _ in range(CONCURRENCY)])
+    return (time.perf_counter() - tijd_start) / count
+
+
+async def run():
+    resultaten = []
+    async with main.app.router.lifespan_context(main.app):
+        store = main.api_key_store
+        _, anonymous = await store._run(store.create, "benchmark anonymous")
+        personal_id, personal = await store._run(store.create, "benchmark personal")
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            await client.put(f"/api/me?api_key={personal}", json={
+                "email": "bench@example.com", "units": "imperial", "language": "en"
+            })
+            farm = (await client.post(f"/api/me/farms?api_key={personal}", json={"name": "Bench"})).json()
+            for i in range(10):
+                await client.post(f"/api/me/farms/{farm['id']}/fields?api_key={personal}",
+                                  json={"name": f"Field {i}", "latitude": 52 + i / 100, "longitude": 4.36})
+
+            scenarios = [
+                ("no user", anonymous, main.USER_CACHE_SIZE),
+                ("profile cached", personal, main.USER_CACHE_SIZE),
+                ("profile uncached", personal, 0),
+            ]
+            print(f"Benchmarking /api personalization ({REQUESTS} requests, {CONCURRENCY} concurrent)")
+            print("-" * 78)
+            print(f"{'scenario':<18} {'req/s':>8} {'p50':>10} {'p95':>10} {'p99':>10} {'lookup':>12}")
+            print("-" * 78)
+            for name, api_key, cache_size in scenarios:
+                main.user_store.cache_size = cache_size
+                main.user_store._cache.clear()
+                url = f"/api?api_key={api_key}&fields=irrigation,forecast"
+                await load(client, url)    # warm-up: forecast cache, profile cache
+                latencies, seconds = await load(client, url)
+                latencies.sort()
+                client_id = personal_id if api_key == personal else ""
+                lookup = await lookups(client_id) if client_id else 0.0
+                row = {
+                    "scenario": name,
+                    "requests": REQUESTS,
+                    "concurrency": CONCURRENCY,
+                    "requests_per_second": round(REQUESTS / seconds),
+                    "p50_ms": round(statistics.median(latencies) * 1000, 3),
+                    "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 3),
+                    "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3),
+                    "profile_lookup_us": round(lookup * 1e6, 2),
+                }
+                resultaten.append(row)
+                print(
+                    f"{row['scenario']:<18} {row['requests_per_second']:>8} {row['p50_ms']:>8}ms "
+                    f"{row['p95_ms']:>8}ms {row['p99_ms']:>8}ms {row['profile_lookup_us']:>10}us"
+                )
+        main.user_store.cache_size = main.USER_CACHE_SIZE
+
+    baseline, cached = resultaten[0]["p50_ms"], resultaten[1]["p50_ms"]
+    print("-" * 78)
+    print(f"Personalization overhead per request (p50, cached profile): {cached - baseline:+.3f}ms")
+    with open(RESULTS_CSV, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(resultaten[0]))
+        writer.writeheader()
+        writer.writerows(resultaten)
+    print(f"Results written to {RESULTS_CSV}")
+
+
+asyncio.run(run())
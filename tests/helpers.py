@@ -0,0 +1,125 @@
+"""
+Shared setup for the in-process test scripts
+- configure_backend(): temporary databases for every store plus the script's own
+  settings, and the backend on sys.path - call it before importing main
+- check() collects failed checks, finish() prints the summary and exits
+- results_path(): where benchmarks write their output (tests/results, not in git)
+- Open-Meteo stand-ins: open_meteo() for httpx.MockTransport (mock_upstream()
+  installs it in the running app) or fake_open_meteo() to replace
+  main.fetch_open_meteo; both serve synthetic_forecast(), driven by weer
+"""
+
+import os
+import socket
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import httpx
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+DATA_DIR = tempfile.mkdtemp()
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# One file (or directory) per store - a new store only needs a line here
+DATA_PATHS = {
+    "EMAIL_OUTBOX_PATH": "email_outbox.db",
+    "SUBSCRIPTIONS_PATH": "subscriptions.db",
+    "WEBHOOKS_PATH": "webhooks.db",
+    "API_KEYS_PATH": "api_keys.db",
+    "USERS_PATH": "users.db",
+    "PROFILE_DIR": "profiles",
+}
+
+lijst_met_error = []
+
+# Synthetic upstream: values of every forecast, status of the mock transport
+weer = {"soil_moisture": 0.16, "precipitation": 0.2, "status": 200}
+upstream_calls = []
+
+
+def configure_backend(**settings) -> str:
+    """Environment for a backend with temporary stores; returns the data directory"""
+    os.environ.update({name: os.path.join(DATA_DIR, filename) for name, filename in DATA_PATHS.items()})
+    os.environ.update({name: str(value) for name, value in settings.items()})
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    return DATA_DIR
+
+
+def data_path(name: str) -> str:
+    """Path of a store, e.g. data_path("API_KEYS_PATH")"""
+    return os.path.join(DATA_DIR, DATA_PATHS[name])
+
+
+def results_path(name: str) -> str:
+    """Output file of a benchmark in tests/results (ignored by git)"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    return os.path.join(RESULTS_DIR, name)
+
+
+def check(condition, message):
+    if condition:
+        print(f"✓ {message}")
+    else:
+        lijst_met_error.append(message)
+        print(f"✗ {message}")
+
+
+def finish(name: str):
+    """Summary and exit code of the script"""
+    print("=" * 60)
+    if lijst_met_error:
+        print(f"{name} failed: {len(lijst_met_error)} check(s) failed")
+        sys.exit(1)
+    print(f"{name} passed")
+    sys.exit(0)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def synthetic_forecast(days: int = 7) -> dict:
+    """Open-Meteo shaped forecast starting today, constant values from weer"""
+    start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    times = [(start + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(24 * days)]
+    return {
+        "utc_offset_seconds": 0,
+        "current": {"time": times[0], "temperature_2m": 27.0},
+        "daily": {
+            "time": times[::24],
+            "temperature_2m_max": [31.0] * days,
+            "temperature_2m_min": [22.0] * days,
+            "daylight_duration": [43500.0] * days,
+        },
+        "hourly": {
+            "time": times,
+            "precipitation": [weer["precipitation"]] * len(times),
+            "relative_humidity_2m": [70] * len(times),
+            "soil_moisture_27_to_81cm": [weer["soil_moisture"]] * len(times),
+        },
+    }
+
+
+def open_meteo(request: httpx.Request) -> httpx.Response:
+    """MockTransport handler: one forecast per coordinate, or weer["status"] as error"""
+    if weer["status"] != 200:
+        return httpx.Response(weer["status"], json={"error": True})
+    latitudes = request.url.params["latitude"].split(",")
+    upstream_calls.extend(zip(map(float, latitudes), map(float, request.url.params["longitude"].split(","))))
+    forecasts = [synthetic_forecast(int(request.url.params.get("forecast_days", 7))) for _ in latitudes]
+    return httpx.Response(200, json=forecasts if len(forecasts) > 1 else forecasts[0])
+
+
+async def fake_open_meteo(locations, variables, forecast_days=7):
+    """Replacement for main.fetch_open_meteo, skips the HTTP layer"""
+    upstream_calls.extend((location["latitude"], location["longitude"]) for location in locations)
+    return [synthetic_forecast(forecast_days) for _ in locations]
+
+
+async def mock_upstream(app):
+    """Swap the running app's upstream client for the open_meteo mock (inside the lifespan)"""
+    await app.state.http_client.aclose()
+    app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(open_meteo))
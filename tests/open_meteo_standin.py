@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Open-Meteo Stand-in
+Local replacement for https://api.open-meteo.com/v1/forecast, so caching, error
+handling and load behavior can be tested without network access:
+- serves the /v1/forecast response shape (current, hourly, daily with their
+  units) for any coordinate, variable list, timezone and forecast_days;
+  comma-separated coordinates return a list like the real API
+- values are synthetic but plausible and deterministic per grid cell and day
+- fault injection: response latency drawn from a distribution, a share of
+  5xx errors, a share of 429 responses with Retry-After, and slow bodies
+  streamed in chunks over a number of seconds
+- faults can be changed while running: GET/PUT /faults, counters on GET /stats
+Point the backend at it with OPEN_METEO_BASE_URL=http://127.0.0.1:8090.
+
+Usage:
+    python open_meteo_standin.py [--port 8090] [--latency lognormal:80,0.5]
+        [--error-rate 0.02] [--throttle-rate 0.05] [--slow-rate 0.1 --slow-seconds 3] [--seed 1]
+    curl -X PUT localhost:8090/faults -d '{"error_rate": 0.5}'
+Latency distributions (milliseconds): none, fixed:MS, uniform:LOW,HIGH,
+normal:MEAN,SD, lognormal:MEDIAN,SIGMA, exponential:MEAN
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Open-Meteo answers with the nearest model grid point
+GRID = 0.125
+MAX_FORECAST_DAYS = 16
+SLOW_BODY_CHUNKS = 20
+
+UNITS = {
+    "temperature": "°C",
+    "precipitation": "mm",
+    "rain": "mm",
+    "showers": "mm",
+    "relative_humidity": "%",
+    "cloud_cover": "%",
+    "soil_moisture": "m³/m³",
+    "wind_speed": "km/h",
+    "daylight_duration": "s",
+    "sunshine_duration": "s",
+}
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Latency spec to a sampler returning seconds; raises ValueError for unknown specs"""
+    name, _, arguments = spec.partition(":")
+    try:
+        values = [float(value) for value in arguments.split(",")] if arguments else []
+    except ValueError:
+        raise ValueError(f"Invalid latency distribution '{spec}'")
+    # Milliseconds; the lognormal sigma is dimensionless
+    samplers = {
+        ("none", 0): lambda rng: 0.0,
+        ("fixed", 1): lambda rng: values[0],
+        ("uniform", 2): lambda rng: rng.uniform(values[0], values[1]),
+        ("normal", 2): lambda rng: max(rng.gauss(values[0], values[1]), 0.0),
+        ("lognormal", 2): lambda rng: values[0] * math.exp(rng.gauss(0, values[1])),
+        ("exponential", 1): lambda rng: rng.expovariate(1 / values[0]) if values[0] else 0.0,
+    }
+    sampler = samplers.get((name, len(values)))
+    if sampler is None:
+        raise ValueError(f"Invalid latency distribution '{spec}'")
+    return lambda rng: sampler(rng) / 1000
+
+
+@dataclass
+class Faults:
+    latency: str = "none"
+    error_rate: float = 0.0
+    error_status: int = 500
+    throttle_rate: float = 0.0
+    retry_after: int = 60
+    slow_rate: float = 0.0
+    slow_seconds: float = 3.0
+
+    def update(self, changes: dict):
+        """Apply a partial update; raises ValueError before changing anything"""
+        unknown = set(changes) - {f.name for f in fields(self)}
+        if unknown:
+            raise ValueError(f"Unknown fault settings: {', '.join(sorted(unknown))}")
+        updated = {**asdict(self), **changes}
+        parse_latency(updated["latency"])
+        for name in ("error_rate", "throttle_rate", "slow_rate"):
+            if not 0 <= float(updated[name]) <= 1:
+                raise ValueError(f"{name} must be between 0 and 1")
+        for name, value in changes.items():
+            setattr(self, name, str(value) if name == "latency" else type(getattr(self, name))(value))
+
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.locations = 0
+        self.errors = 0
+        self.throttled = 0
+        self.slow = 0
+        self.bad_requests = 0
+
+
+def _cell(value: float) -> float:
+    return round(round(value / GRID) * GRID, 4)
+
+
+def _units(variable: str) -> str:
+    return next((unit for prefix, unit in UNITS.items() if variable.startswith(prefix)), "")
+
+
+def _hourly_series(variable: str, rng: random.Random, hours: List[datetime], latitude: float) -> list:
+    """Plausible hourly values: diurnal cycles, afternoon showers, slowly drying soil"""
+    base_temperature = 28 - abs(latitude) * 0.35
+    if variable.startswith("temperature"):
+        return [round(base_temperature + 4.5 * math.sin((t.hour - 9) / 24 * 2 * math.pi) + rng.uniform(-0.6, 0.6), 1)
+                for t in hours]
+    if variable.startswith(("precipitation", "rain", "showers")):
+        values = []
+        for t in hours:
+            afternoon = 0.35 if 13 <= t.hour <= 19 else 0.08
+            values.append(round(rng.expovariate(0.8), 1) if rng.random() < afternoon else 0.0)
+        return values
+    if variable.startswith("relative_humidity"):
+        return [int(min(100, max(35, 78 - 18 * math.sin((t.hour - 9) / 24 * 2 * math.pi) + rng.randint(-5, 5))))
+                for t in hours]
+    if variable.startswith("soil_moisture"):
+        level, values = rng.uniform(0.12, 0.32), []
+        for _ in hours:
+            level = min(max(level + rng.uniform(-0.0015, 0.0009), 0.05), 0.45)
+            values.append(round(level, 3))
+        return values
+    offset = rng.uniform(5, 20)
+    return [round(offset + 3 * math.sin(t.hour / 24 * 2 * math.pi) + rng.uniform(-1, 1), 1) for t in hours]
+
+
+def _daylight(latitude: float, day: datetime) -> float:
+    """Seconds between sunrise and sunset"""
+    declination = math.radians(23.44) * math.sin(2 * math.pi * (day.timetuple().tm_yday - 81) / 365)
+    cos_hour_angle = -math.tan(math.radians(latitude)) * math.tan(declination)
+    return round(2 * math.degrees(math.acos(min(max(cos_hour_angle, -1), 1))) / 15 * 3600, 2)
+
+
+def forecast(latitude: float, longitude: float, variables: Dict[str, List[str]],
+             zone: str, days: int, now: datetime) -> dict:
+    """One location in the /v1/forecast shape, deterministic per grid cell and day"""
+    latitude, longitude = _cell(latitude), _cell(longitude)
+    tz = timezone.utc if zone in ("GMT", "UTC", "auto") else ZoneInfo(zone)
+    local_now = now.astimezone(tz)
+    offset = int(local_now.utcoffset().total_seconds())
+    midnight = local_now.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    seed = f"{latitude}:{longitude}:{midnight:%Y%m%d}"
+    rng = random.Random(seed)
+    hours = [midnight + timedelta(hours=i) for i in range(24 * days)]
+
+    # Hourly series back the current values and the daily aggregates as well
+    wanted = dict.fromkeys([*variables.get("hourly", []), *variables.get("current", []), "temperature_2m",
+                            "precipitation"])
+    # One generator per variable - its values do not depend on what else is requested
+    series = {v: _hourly_series(v, random.Random(f"{seed}:{v}"), hours, latitude) for v in wanted}
+
+    data = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "generationtime_ms": round(rng.uniform(0.05, 0.4), 6),
+        "utc_offset_seconds": offset,
+        "timezone": "GMT" if zone == "auto" else zone,
+        "timezone_abbreviation": local_now.tzname() or "GMT",
+        "elevation": float(rng.randint(0, 400)),
+    }
+    if variables.get("current"):
+        current_time = local_now.replace(minute=local_now.minute // 15 * 15, second=0, microsecond=0, tzinfo=None)
+        index = int((current_time - midnight).total_seconds() // 3600)
+        data["current_units"] = {"time": "iso8601", "interval": "seconds",
+                                 **{v: _units(v) for v in variables["current"]}}
+        data["current"] = {"time": current_time.strftime("%Y-%m-%dT%H:%M"), "interval": 900,
+                           **{v: series[v][index] for v in variables["current"]}}
+    if variables.get("hourly"):
+        data["hourly_units"] = {"time": "iso8601", **{v: _units(v) for v in variables["hourly"]}}
+        data["hourly"] = {"time": [t.strftime("%Y-%m-%dT%H:%M") for t in hours],
+                          **{v: series[v] for v in variables["hourly"]}}
+    if variables.get("daily"):
+        day_starts = hours[::24]
+        per_day = {v: [values[d * 24:(d + 1) * 24] for d in range(days)] for v, values in series.items()}
+        daily = {"time": [day.strftime("%Y-%m-%d") for day in day_starts]}
+        for variable in variables["daily"]:
+            if variable == "temperature_2m_max":
+                daily[variable] = [max(values) for values in per_day["temperature_2m"]]
+            elif variable == "temperature_2m_min":
+                daily[variable] = [min(values) for values in per_day["temperature_2m"]]
+            elif variable == "precipitation_sum":
+                daily[variable] = [round(sum(values), 1) for values in per_day["precipitation"]]
+            elif variable == "daylight_duration":
+                daily[variable] = [_daylight(latitude, day) for day in day_starts]
+            else:
+                daily[variable] = [round(rng.uniform(0, 20), 1) for _ in day_starts]
+        data["daily_units"] = {"time": "iso8601", **{v: _units(v) for v in variables["daily"]}}
+        data["daily"] = daily
+    return data
+
+
+def _parse_request(params) -> tuple:
+    """(latitudes, longitudes, forecast_days, timezone); raises ValueError with Open-Meteo's reasons"""
+    try:
+        latitudes = [float(v) for v in params.get("latitude", "").split(",")]
+        longitudes = [float(v) for v in params.get("longitude", "").split(",")]
+        days = int(params.get("forecast_days", "7"))
+    except ValueError:
+        raise ValueError("Cannot initialize WeatherVariable from invalid String value")
+    if len(latitudes) != len(longitudes):
+        raise ValueError("Parameter 'latitude' and 'longitude' must have the same number of elements")
+    if any(not -90 <= lat <= 90 for lat in latitudes) or any(not -180 <= lon <= 180 for lon in longitudes):
+        raise ValueError("Latitude must be in range of -90 to 90°. Longitude must be in range of -180 to 180°.")
+    if not 0 < days <= MAX_FORECAST_DAYS:
+        raise ValueError(f"Forecast days is invalid. Allowed range 1 to {MAX_FORECAST_DAYS}.")
+    zone = params.get("timezone", "GMT")
+    if zone not in ("GMT", "UTC", "auto"):
+        try:
+            ZoneInfo(zone)
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError("Invalid timezone")
+    return latitudes, longitudes, days, zone
+
+
+def _error(status: int, reason: str, headers: dict = None) -> JSONResponse:
+    # Open-Meteo's error body
+    return JSONResponse({"error": True, "reason": reason}, status_code=status, headers=headers)
+
+
+def create_app(faults: Faults = None, seed: int = None) -> Starlette:
+    faults = faults or Faults()
+    stats = Stats()
+    rng = random.Random(seed)
+
+    async def v1_forecast(request: Request):
+        stats.requests += 1
+        delay = parse_latency(faults.latency)(rng)
+        if delay:
+            await asyncio.sleep(delay)
+        if rng.random() < faults.throttle_rate:
+            stats.throttled += 1
+            return _error(429, "Minutely API request limit exceeded. Please try again in one minute.",
+                          {"Retry-After": str(faults.retry_after)})
+        if rng.random() < faults.error_rate:
+            stats.errors += 1
+            return _error(faults.error_status, "Internal server error (injected)")
+
+        params = request.query_params
+        try:
+            latitudes, longitudes, days, zone = _parse_request(params)
+        except ValueError as e:
+            stats.bad_requests += 1
+            return _error(400, str(e))
+
+        variables = {section: [v for v in params[section].split(",") if v]
+                     for section in ("current", "hourly", "daily") if params.get(section)}
+        now = datetime.now(timezone.utc)
+        locations = [forecast(lat, lon, variables, zone, days, now) for lat, lon in zip(latitudes, longitudes)]
+        stats.locations += len(locations)
+        body = json.dumps(locations if len(locations) > 1 else locations[0], ensure_ascii=False).encode()
+
+        if rng.random() < faults.slow_rate:
+            stats.slow += 1
+            return StreamingResponse(_slow_body(body, faults.slow_seconds), media_type="application/json")
+        return Response(body, media_type="application/json")
+
+    async def get_faults(request: Request):
+        return JSONResponse(asdict(faults))
+
+    async def put_faults(request: Request):
+        try:
+            faults.update(await request.json())
+        except (ValueError, TypeError) as e:
+            return _error(400, str(e))
+        return JSONResponse(asdict(faults))
+
+    async def get_stats(request: Request):
+        return JSONResponse(vars(stats))
+
+    app = Starlette(routes=[
+        Route("/v1/forecast", v1_forecast),
+        Route("/faults", get_faults, methods=["GET"]),
+        Route("/faults", put_faults, methods=["PUT"]),
+        Route("/stats", get_stats),
+    ])
+    app.state.faults = faults
+    app.state.stats = stats
+    return app
+
+
+async def _slow_body(body: bytes, seconds: float):
+    """The body in equal chunks spread over seconds - headers arrive at once"""
+    size = -(-len(body) // SLOW_BODY_CHUNKS)
+    for start in range(0, len(body), size):
+        await asyncio.sleep(seconds / SLOW_BODY_CHUNKS)
+        yield body[start:start + size]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Local Open-Meteo stand-in with fault injection")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", default="none", help="latency distribution, e.g. lognormal:80,0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 5xx responses (0-1)")
+    parser.add_argument("--error-status", type=int, default=500, help="status of injected errors (default: 500)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of 429 responses (0-1)")
+    parser.add_argument("--retry-after", type=int, default=60, help="Retry-After of 429 responses in seconds")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of slowly streamed bodies (0-1)")
+    parser.add_argument("--slow-seconds", type=float, default=3.0, help="time to stream a slow body")
+    parser.add_argument("--seed", type=int, default=None, help="seed for latency and fault draws")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_arguments()
+    faults = Faults()
+    try:
+        faults.update({
+            "latency": args.latency, "error_rate": args.error_rate, "error_status": args.error_status,
+            "throttle_rate": args.throttle_rate, "retry_after": args.retry_after,
+            "slow_rate": args.slow_rate, "slow_seconds": args.slow_seconds,
+        })
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f"Open-Meteo stand-in on http://{args.host}:{args.port}/v1/forecast - faults: {asdict(faults)}")
+    uvicorn.run(create_app(faults, args.seed), host=args.host, port=args.port, log_level="warning")
@@ -1,10 +1,33 @@
-import requests
-import pandas as pd
-import time
+#!/usr/bin/env python3
+"""
+API Load Test
+Concurrent load against /api?api_key=<key> on a running deployment:
+- closed loop: N users, each sends its next request when the previous one answered
+- open loop: requests arrive at a fixed rate whether or not earlier ones answered;
+  latency is measured from the scheduled arrival time, so a slow server is not
+  hidden by the generator slowing down with it (coordinated omission)
+- a warm-up phase whose results are discarded, then a request count or a duration
+- latencies go into an HDR-style histogram (3 significant digits) for p50/p90/p99/p99.9
+Successful latencies are written to results/resultatenAPI.csv, the summary to results/resultatenAPI.json.
+
+Usage:
+    python test_API.py                                   # 10 users, 2000 requests
+    python test_API.py --users 50 --duration 60
+    python test_API.py --rate 200 --duration 60 --warmup 10
+    python test_API.py --users 1 --requests 2000         # the old sequential run
+Target and key come from TEST_BASE_URL / TEST_API_KEY (see run-tests.py).
+"""
+
+import argparse
+import asyncio
+import csv
+import json
 import os
 import sys
-import json
+import time
+from collections import Counter
 
+import httpx
 
 # Get base URL and API key from environment variables or use defaults
 BASE_URL = os.environ.get("TEST_BASE_URL", "http://10.0.0.101:30081")
@@ -16,107 +39,251 @@ if API_KEY:
 else:
     TEST_URL = f"{BASE_URL}/api"
 
-# Debug output to show the actual URL being called
-print(f"DEBUG: API_KEY value = {API_KEY}")
-print(f"DEBUG: API_KEY type = {type(API_KEY)}")
-print(f"DEBUG: Full URL = {TEST_URL}")
-print()
-
-lijst_zonder_error = []
-lijst_met_error = []
-lijst_tijden = []
-teller = 0 
-aantal = 2000
-
-print(f"Testing API endpoint: {TEST_URL}")
-print(f"Number of requests: {aantal}")
-print("-" * 60)
-
-while teller < aantal:
-    teller += 1
-    tijd_start = time.time()
-    
-    try:
-        # Make HTTP GET request to the API endpoint
-        response = requests.get(TEST_URL, timeout=20)
-        tijd_eind = time.time()
-        tijd_verschil = tijd_eind - tijd_start
-        
-        # Check if request was successful (HTTP 200)
-        if response.status_code == 200:
-            # Try to parse JSON response
-            try:
-                data = response.json()
-                
-                # Validate that response contains expected fields
-                # Adjust these validations based on your actual API response structure
-                if isinstance(data, dict):
-                    lijst_zonder_error.append(tijd_verschil)
-                    print(f"✓ Request {teller}: Success - {tijd_verschil:.3f}s - Status: {response.status_code}")
-                else:
-                    lijst_met_error.append(tijd_verschil)
-                    print(f"✗ Request {teller}: Invalid JSON structure - {tijd_verschil:.3f}s")
-            except json.JSONDecodeError:
-                # If response is not JSON, check if it contains expected text
-                response_text = response.text.lower()
-                if 'geef water' in response_text or 'water geven' in response_text:
-                    lijst_zonder_error.append(tijd_verschil)
-                    print(f"✓ Request {teller}: Success (HTML response) - {tijd_verschil:.3f}s")
-                else:
-                    lijst_met_error.append(tijd_verschil)
-                    print(f"✗ Request {teller}: Unexpected response format - {tijd_verschil:.3f}s")
+# Output next to this script in results/ (ignored by git)
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+RESULTS_CSV = os.path.join(RESULTS_DIR, "resultatenAPI.csv")
+RESULTS_JSON = os.path.join(RESULTS_DIR, "resultatenAPI.json")
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of microsecond values: 2048 linear sub-buckets per power
+    of two, so every recorded value is kept within 0.1% (3 significant digits)
+    in constant memory, however many requests are recorded
+    """
+
+    SUB_BUCKET_BITS = 11
+
+    def __init__(self):
+        # (exponent, sub-bucket) -> count; values in a bucket share sub << exponent
+        self.counts = Counter()
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.sum = 0
+
+    def record(self, seconds: float):
+        value = max(int(seconds * 1e6), 0)
+        exponent = max(value.bit_length() - self.SUB_BUCKET_BITS, 0)
+        self.counts[(exponent, value >> exponent)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, percentile: float) -> float:
+        """Milliseconds below which percentile% of the values fall (highest equivalent value)"""
+        if not self.total:
+            return 0.0
+        wanted = max(percentile / 100 * self.total, 1)
+        seen = 0
+        for exponent, sub in sorted(self.counts, key=lambda bucket: bucket[1] << bucket[0]):
+            seen += self.counts[(exponent, sub)]
+            if seen >= wanted:
+                return min(((sub + 1) << exponent) - 1, self.max) / 1000
+        return self.max / 1000
+
+    def summary(self) -> dict:
+        return {
+            "count": self.total,
+            "min_ms": (self.min or 0) / 1000,
+            "mean_ms": round(self.sum / self.total / 1000, 3) if self.total else 0.0,
+            **{f"p{p:g}_ms": self.percentile(p) for p in PERCENTILES},
+            "max_ms": self.max / 1000,
+        }
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, url: str):
+        self.client = client
+        self.url = url
+        self.recording = False
+        self.histogram = LatencyHistogram()
+        self.lijst_zonder_error = []
+        self.errors = Counter()
+        self.requests = 0
+
+    async def request(self, scheduled: float):
+        """One request; latency counts from scheduled (perf_counter)"""
+        try:
+            response = await self.client.get(self.url)
+            error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+            if error is None and not self.valid(response):
+                error = "unexpected response format"
+        except httpx.TimeoutException:
+            error = "timeout"
+        except httpx.TransportError as e:
+            error = type(e).__name__
+        tijd_verschil = time.perf_counter() - scheduled
+        if not self.recording:
+            return
+        self.requests += 1
+        if error is None:
+            self.histogram.record(tijd_verschil)
+            self.lijst_zonder_error.append(tijd_verschil)
         else:
-            lijst_met_error.append(tijd_verschil)
-            print(f"✗ Request {teller}: HTTP {response.status_code} - {tijd_verschil:.3f}s")
-            
-    except requests.exceptions.Timeout:
-        tijd_eind = time.time()
-        tijd_verschil = tijd_eind - tijd_start
-        lijst_met_error.append(tijd_verschil)
-        print(f"✗ Request {teller}: Timeout after {tijd_verschil:.3f}s")
-        
-    except requests.exceptions.ConnectionError as e:
-        tijd_eind = time.time()
-        tijd_verschil = tijd_eind - tijd_start
-        lijst_met_error.append(tijd_verschil)
-        print(f"✗ Request {teller}: Connection error - {tijd_verschil:.3f}s")
-        
-    except Exception as e:
-        tijd_eind = time.time()
-        tijd_verschil = tijd_eind - tijd_start
-        lijst_met_error.append(tijd_verschil)
-        print(f"✗ Request {teller}: Error - {str(e)[:50]} - {tijd_verschil:.3f}s")
-
-# Print summary
-print("\n" + "=" * 60)
-print("API Test Summary")
-print("=" * 60)
-print(f"Total requests: {aantal}")
-print(f"Successful: {len(lijst_zonder_error)}")
-print(f"Failed: {len(lijst_met_error)}")
-print(f"Success rate: {(len(lijst_zonder_error)/aantal)*100:.1f}%")
-
-df = pd.DataFrame(lijst_zonder_error, columns=["data"])
-df.to_csv("resultatenAPI.csv", index=False)
-
-if lijst_zonder_error:
-    average = sum(lijst_zonder_error) / len(lijst_zonder_error)
-    min_time = min(lijst_zonder_error)
-    max_time = max(lijst_zonder_error)
-    print(f"\nLatency Statistics (Successful requests):")
-    print(f"  Average: {average:.3f}s")
-    print(f"  Min: {min_time:.3f}s")
-    print(f"  Max: {max_time:.3f}s")
-else:
-    print("\nNo successful requests to calculate latency.")
+            self.errors[error] += 1
 
-if lijst_met_error:
-    print(f"\nFailed requests average time: {sum(lijst_met_error)/len(lijst_met_error):.3f}s")
+    @staticmethod
+    def valid(response: httpx.Response) -> bool:
+        # Validate that response contains expected fields
+        try:
+            return isinstance(response.json(), dict)
+        except json.JSONDecodeError:
+            # If response is not JSON, check if it contains expected text
+            response_text = response.text.lower()
+            return "geef water" in response_text or "water geven" in response_text
 
-print("=" * 60)
+    async def closed_loop(self, users: int, deadline: float, requests: int = 0):
+        """users concurrent users until deadline or until requests are sent"""
+        remaining = iter(range(requests)) if requests else None
 
-# Exit with error code if any requests failed
-if lijst_met_error:
-    sys.exit(1)
-else:
-    sys.exit(0)
\ No newline at end of file
+        async def user():
+            while time.perf_counter() < deadline:
+                if remaining is not None and next(remaining, None) is None:
+                    return
+                await self.request(time.perf_counter())
+
+        await asyncio.gather(*[user() for _ in range(users)])
+
+    async def open_loop(self, rate: float, deadline: float, requests: int = 0):
+        """rate arrivals per second until deadline or until requests are sent"""
+        tasks = set()
+        start = time.perf_counter()
+        sent = 0
+        while not requests or sent < requests:
+            scheduled = start + sent / rate
+            if scheduled >= deadline:
+                break
+            await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+            task = asyncio.ensure_future(self.request(scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            sent += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def phase(self, args, seconds: float, requests: int = 0):
+        deadline = time.perf_counter() + seconds
+        if args.rate:
+            await self.open_loop(args.rate, deadline, requests)
+        else:
+            await self.closed_loop(args.users, deadline, requests)
+
+
+async def progress(load_test: LoadTest):
+    """One line per second while measuring"""
+    vorige = 0
+    while True:
+        await asyncio.sleep(1)
+        aantal = load_test.requests
+        print(f"  {aantal:>8} requests  {aantal - vorige:>6} req/s  "
+              f"{sum(load_test.errors.values()):>6} errors  p99 {load_test.histogram.percentile(99):.1f}ms")
+        vorige = aantal
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Concurrent load test of the TropoMetrics API")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("-u", "--users", type=int, default=10,
+                      help="closed loop: number of concurrent users (default: 10)")
+    mode.add_argument("-r", "--rate", type=float, default=0,
+                      help="open loop: requests per second, independent of response times")
+    parser.add_argument("-n", "--requests", type=int, default=0,
+                        help="stop after this many measured requests (default: 2000 without --duration)")
+    parser.add_argument("-d", "--duration", type=float, default=0,
+                        help="stop after this many seconds of measuring")
+    parser.add_argument("-w", "--warmup", type=float, default=2,
+                        help="seconds of load before measuring, results discarded (default: 2)")
+    parser.add_argument("--timeout", type=float, default=20, help="request timeout in seconds (default: 20)")
+    parser.add_argument("--connections", type=int, default=100,
+                        help="maximum open connections (default: 100)")
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        args.requests = 2000
+    return args
+
+
+async def run(args) -> dict:
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        load_test = LoadTest(client, TEST_URL)
+        if args.warmup:
+            print(f"Warming up for {args.warmup:g}s...")
+            await load_test.phase(args, args.warmup)
+
+        print("Measuring...")
+        load_test.recording = True
+        reporter = asyncio.ensure_future(progress(load_test))
+        tijd_start = time.perf_counter()
+        try:
+            await load_test.phase(args, args.duration or float("inf"), args.requests)
+        finally:
+            reporter.cancel()
+        seconds = time.perf_counter() - tijd_start
+
+    return {
+        "url": TEST_URL,
+        "mode": "open" if args.rate else "closed",
+        "users": None if args.rate else args.users,
+        "rate": args.rate or None,
+        "warmup_seconds": args.warmup,
+        "duration_seconds": round(seconds, 3),
+        "requests": load_test.requests,
+        "successful": len(load_test.lijst_zonder_error),
+        "failed": sum(load_test.errors.values()),
+        "errors": dict(load_test.errors),
+        "throughput_rps": round(load_test.requests / seconds, 1) if seconds else 0.0,
+        "latency": load_test.histogram.summary(),
+    }, load_test.lijst_zonder_error
+
+
+def main():
+    args = parse_arguments()
+    mode = f"open loop, {args.rate:g} req/s" if args.rate else f"closed loop, {args.users} users"
+    limit = f"{args.duration:g}s" if args.duration else ""
+    if args.requests:
+        limit = f"{limit} or {args.requests} requests" if limit else f"{args.requests} requests"
+    print(f"Testing API endpoint: {TEST_URL}")
+    print(f"Load: {mode}, {limit}, {args.warmup:g}s warm-up")
+    print("-" * 60)
+
+    resultaten, lijst_zonder_error = asyncio.run(run(args))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(RESULTS_CSV, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["data"])
+        writer.writerows([tijd] for tijd in lijst_zonder_error)
+    with open(RESULTS_JSON, "w") as f:
+        json.dump(resultaten, f, indent=2)
+
+    # Print summary
+    latency = resultaten["latency"]
+    print("\n" + "=" * 60)
+    print("API Test Summary")
+    print("=" * 60)
+    print(f"Total requests: {resultaten['requests']} in {resultaten['duration_seconds']:.1f}s "
+          f"({resultaten['throughput_rps']} req/s)")
+    print(f"Successful: {resultaten['successful']}")
+    print(f"Failed: {resultaten['failed']}")
+    for error, count in sorted(resultaten["errors"].items(), key=lambda item: -item[1]):
+        print(f"  {error}: {count}")
+    if resultaten["requests"]:
+        print(f"Success rate: {resultaten['successful'] / resultaten['requests'] * 100:.1f}%")
+    if latency["count"]:
+        print("\nLatency Statistics (Successful requests):")
+        print(f"  Min: {latency['min_ms']:.1f}ms  Mean: {latency['mean_ms']:.1f}ms  Max: {latency['max_ms']:.1f}ms")
+        print("  " + "  ".join(f"p{p:g}: {latency[f'p{p:g}_ms']:.1f}ms" for p in PERCENTILES))
+    else:
+        print("\nNo successful requests to calculate latency.")
+    print(f"\nResults written to {RESULTS_CSV} and {RESULTS_JSON}")
+    print("=" * 60)
+
+    # Exit with error code if any requests failed
+    sys.exit(1 if resultaten["failed"] or not resultaten["requests"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+API Key Store Test
+Drives the backend in-process with a temporary key database (no cluster needed):
+- keys created with the management command work, only their hash is stored
+- plans restrict locations, response formats and the per-key rate
+- usage is counted in memory, flushed in batches and exported as CSV
+- revocations apply within API_KEY_CACHE_TTL, without a restart
+Forecasts are synthetic (Open-Meteo is not called).
+
+Usage:
+    python test_api_keys.py
+"""
+
+import asyncio
+import contextlib
+import csv
+import io
+import sqlite3
+import time
+
+from helpers import check, configure_backend, data_path, fake_open_meteo, finish
+
+configure_backend(
+    API_KEY_CACHE_TTL="0.5",
+    API_KEY_USAGE_FLUSH_SECONDS="0.2",
+    WEATHER_LOCATIONS="field-1=52.01,4.36;field-2=51.5,5.0",
+)
+KEYS_DB = data_path("API_KEYS_PATH")
+
+import httpx  # noqa: E402
+
+import api_keys  # noqa: E402
+import main  # noqa: E402
+
+
+main.fetch_open_meteo = fake_open_meteo
+
+
+def command(*argv):
+    """Run a management command, returns (exit code, stdout)"""
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        code = api_keys.main(["--db", KEYS_DB, *argv])
+    return code, output.getvalue()
+
+
+async def run():
+    check(command("plan", "basic", "--rate", "5/minute", "--formats", "json", "--locations", "field-1")[0] == 0,
+          "Plan created")
+    check(command("plan", "broken", "--rate", "lots")[0] == 1, "Invalid plan rate is rejected")
+    code, output = command("create", "--name", "Farm 1", "--plan", "basic")
+    key = next(line.split()[1] for line in output.splitlines() if line.startswith("key:"))
+    key_id = next(line.split()[1] for line in output.splitlines() if line.startswith("id:"))
+    check(code == 0 and key.startswith("tm_"), "Key created")
+    with sqlite3.connect(KEYS_DB) as db:
+        stored = [row[0] for row in db.execute("SELECT key_hash FROM api_keys")]
+    check(key not in stored and api_keys.hash_key(key) in stored, "Only the key hash is stored")
+
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            async def get(query):
+                return await client.get(f"/api?api_key={key}&{query}")
+
+            check((await get("location=field-1")).status_code == 200, "Key works for its plan's location")
+            check((await get("location=field-2")).status_code == 403, "Other locations are refused")
+            check((await get("location=field-1&format=html")).status_code == 403, "Formats outside the plan are refused")
+            statuses = [(await get("location=field-1")).status_code for _ in range(2)]
+            limited = await get("location=field-1")
+            check(statuses == [200] * 2 and limited.status_code == 429, "Plan rate of 5/minute applies to the key")
+            check((await client.get("/api?api_key=demo")).status_code == 200, "Built-in demo key still works")
+            check((await client.get("/api?api_key=nope")).status_code == 401, "Unknown key is refused")
+
+            lookups = 100000
+            start = time.perf_counter()
+            for _ in range(lookups):
+                await main.api_key_store.lookup(key)
+            per_lookup = (time.perf_counter() - start) / lookups * 1e6
+            check(main.api_key_store.stats()["cache_hits"] >= lookups, f"Cached lookups ({per_lookup:.2f} µs each)")
+
+            await asyncio.sleep(0.5)
+            code, output = command("export", "--since", time.strftime("%Y-%m-%d", time.gmtime()))
+            rows = [row for row in csv.DictReader(io.StringIO(output)) if row["key_id"] == key_id]
+            check(code == 0 and [(r["endpoint"], r["requests"]) for r in rows] == [("/api", "5")],
+                  f"Usage flushed and exported ({rows})")
+
+            check(command("revoke", key_id)[0] == 0, "Key revoked")
+            await asyncio.sleep(0.6)
+            check((await get("location=field-1")).status_code == 401, "Revocation applies without a restart")
+
+            async def unreachable(digest):
+                raise OSError("key database unreachable")
+            main.api_key_store._fetch = unreachable
+            await asyncio.sleep(0.6)
+            check((await client.get("/api?api_key=demo")).status_code == 200,
+                  "Expired entries keep answering while lookups fail")
+            print(f"  Key store: {main.api_key_store.stats()}")
+
+
+asyncio.run(run())
+
+finish("API key test")
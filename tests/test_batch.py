@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Batch API Test
+Runs the backend with uvicorn in-process against a scripted Open-Meteo stand-in:
+- every location gets exactly one NDJSON line tagged with its index, failures
+  (unknown field, broken forecast, upstream error) included as error lines
+- lines arrive in completion order: locations without a lookup come first
+- the fields of the key's user resolve as location ids, as on /api
+- a client that disconnects stops the lookups nobody will read
+
+Usage:
+    python test_batch.py
+"""
+
+import asyncio
+
+import orjson
+
+from helpers import check, configure_backend, fake_open_meteo, finish, free_port, upstream_calls
+
+# One lookup at a time, so each upstream call holds exactly one location
+configure_backend(BATCH_CONCURRENCY="1")
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+
+main.limiter.enabled = False
+BROKEN, DOWN, HELD = 53.0, 54.0, 55.0
+gate = {}
+
+
+async def scripted_open_meteo(locations, variables, forecast_days=7):
+    latitude = locations[0]["latitude"]
+    if latitude == HELD:
+        upstream_calls.append((latitude, locations[0]["longitude"]))
+        await gate["open"].wait()
+    if latitude == DOWN:
+        raise httpx.ConnectError("Open-Meteo unreachable")
+    forecasts = await fake_open_meteo(locations, variables, forecast_days)
+    if latitude == BROKEN:
+        del forecasts[0]["current"]
+    return forecasts
+
+
+main.fetch_open_meteo = scripted_open_meteo
+
+
+def point(latitude: float) -> dict:
+    return {"latitude": latitude, "longitude": 4.36}
+
+
+async def run():
+    gate["open"] = asyncio.Event()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, port=port, log_level="warning"))
+    serving = asyncio.ensure_future(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=10) as client:
+            mixed = await client.post("/api/batch?api_key=demo", json={"locations": [
+                point(52.0), {"location": "nope"}, point(BROKEN), point(DOWN), point(52.0)
+            ]})
+            lines = [orjson.loads(line) for line in mixed.text.splitlines()]
+            statuses = {line["index"]: line["status"] for line in lines}
+            check(mixed.status_code == 200 and sorted(line["index"] for line in lines) == [0, 1, 2, 3, 4],
+                  "One line per location, each index exactly once")
+            check(statuses == {0: 200, 1: 400, 2: 500, 3: 503, 4: 200},
+                  f"Failures are error lines next to the reports ({statuses})")
+            check(lines[0]["index"] == 1, "Lines arrive in completion order (no lookup first)")
+            check(all("forecast" in line for line in lines if line["status"] == 200),
+                  "Successful lines carry the requested sections")
+
+            # The key's user owns a field, its id works as a location
+            await client.put("/api/me?api_key=demo", json={"email": "farmer@example.com", "name": "Farm 1"})
+            farm = await client.post("/api/me/farms?api_key=demo", json={"name": "North"})
+            field = await client.post(f"/api/me/farms/{farm.json()['id']}/fields?api_key=demo",
+                                      json={"name": "Field A", "latitude": 51.5, "longitude": 5.1})
+            field_id = field.json()["id"]
+            personal = await client.post("/api/batch?api_key=demo", json={"locations": [{"location": field_id}]})
+            line = orjson.loads(personal.text)
+            check(line["status"] == 200 and line["location"]["id"] == field_id
+                  and line["location"]["latitude"] == 51.5, "A field of the key's user resolves by its id")
+
+            # Disconnect after the first line while the held lookup is in flight
+            queued = [point(56.0), point(57.0)]
+            async with client.stream("POST", "/api/batch?api_key=demo", json={
+                "locations": [{"location": "nope"}, point(HELD), *queued]
+            }) as response:
+                async for line in response.aiter_lines():
+                    first = orjson.loads(line)
+                    break
+            check(first["index"] == 0 and first["status"] == 400, "First line streamed before the batch finished")
+            await asyncio.sleep(0.3)
+            gate["open"].set()
+            await asyncio.sleep(0.5)
+            fetched = {latitude for latitude, _ in upstream_calls}
+            check(HELD in fetched and not fetched & {56.0, 57.0},
+                  "Lookups waiting behind the disconnect are never started")
+    finally:
+        server.should_exit = True
+        await serving
+
+
+asyncio.run(run())
+
+finish("Batch API test")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Forecast Version Test
+Drives the backend in-process with synthetic forecasts (no cluster needed):
+- the forecast version only hashes the forecast arrays and units, so two
+  upstream responses that differ in fetch metadata (generationtime_ms) keep
+  the same data_version and ETag, and a conditional request gets 304
+- changed forecast data gives a new version
+- /api responses are private (keyed per API key)
+The forecast cache is disabled, so every request refetches.
+
+Usage:
+    python test_caching.py
+"""
+
+import asyncio
+import random
+
+from helpers import check, configure_backend, fake_open_meteo, finish, synthetic_forecast, upstream_calls, weer
+
+configure_backend(FORECAST_CACHE_TTL=0, FORECAST_STALE_TTL=0, FORECAST_REFRESH_INTERVAL=3600)
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from weather_cache import content_version  # noqa: E402
+
+main.limiter.enabled = False
+
+
+async def open_meteo_with_metadata(locations, variables, forecast_days=7):
+    """Synthetic forecasts with the fetch metadata Open-Meteo adds to every response"""
+    forecasts = await fake_open_meteo(locations, variables, forecast_days)
+    for forecast in forecasts:
+        forecast.update({"generationtime_ms": random.uniform(0.01, 5.0), "elevation": 3.0})
+    return forecasts
+
+
+main.fetch_open_meteo = open_meteo_with_metadata
+
+
+def test_content_version():
+    first, second = synthetic_forecast(), synthetic_forecast()
+    first["generationtime_ms"], second["generationtime_ms"] = 0.21, 1.7
+    check(content_version(first) == content_version(second), "generationtime_ms does not change the version")
+    second["hourly"]["precipitation"][5] += 1.0
+    check(content_version(first) != content_version(second), "A changed forecast value changes the version")
+    second = synthetic_forecast()
+    second["hourly_units"] = {"precipitation": "inch"}
+    check(content_version(first) != content_version(second), "Changed units change the version")
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            calls = len(upstream_calls)
+            first = await client.get("/api?api_key=demo")
+            etag = first.headers.get("etag")
+            check(first.status_code == 200 and etag, "First request has an ETag")
+            check(first.headers.get("cache-control", "").startswith("private"), "Responses are private")
+
+            second = await client.get("/api?api_key=demo")
+            check(len(upstream_calls) == calls + 2, "Every request refetched the forecast")
+            check(second.json()["metadata"]["data_version"] == first.json()["metadata"]["data_version"],
+                  "A refetch that only differs in generationtime_ms keeps the data_version")
+            check(second.headers.get("etag") == etag, "... and the ETag")
+
+            revalidated = await client.get("/api?api_key=demo", headers={"If-None-Match": etag})
+            check(revalidated.status_code == 304, "A conditional request after a refetch gets 304")
+
+            weer["soil_moisture"] = 0.09
+            changed = await client.get("/api?api_key=demo", headers={"If-None-Match": etag})
+            check(changed.status_code == 200 and changed.headers.get("etag") != etag,
+                  "Changed forecast data gives a new ETag")
+
+
+test_content_version()
+asyncio.run(run())
+
+finish("Forecast version test")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Change Feed Test
+Drives the backend in-process with synthetic forecasts (no cluster needed):
+- /api/changes?since=<data_version> lists what changed since an /api response
+- window, days and agg shape the diff like they shape /api: hourly cells only
+  within the requested days, deltas of every requested aggregation
+- an irrigation advice flip is reported, an unknown version returns 410
+- the user's fields work as ?location= like on /api
+- the tracker stays within its key and byte bounds
+
+Usage:
+    python test_changes.py
+"""
+
+import asyncio
+from datetime import datetime
+
+from helpers import check, configure_backend, fake_open_meteo, finish, synthetic_forecast, weer
+
+configure_backend()
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from changes import ChangeTracker  # noqa: E402
+from weather_cache import CacheEntry, content_version  # noqa: E402
+
+main.limiter.enabled = False
+main.fetch_open_meteo = fake_open_meteo
+LOCATION = "latitude=52.01&longitude=4.36"
+
+
+def hours_between(first: str, last: str) -> float:
+    return (datetime.fromisoformat(last) - datetime.fromisoformat(first)).total_seconds() / 3600
+
+
+async def new_version(client, query=LOCATION) -> str:
+    """Forget the cached forecast and load /api again - the tracker records the new version"""
+    main.forecast_cache.clear()
+    return (await client.get(f"/api?api_key=demo&{query}")).json()["metadata"]["data_version"]
+
+
+def test_bounds():
+    tracker = ChangeTracker(history=2, max_keys=3, max_bytes=10**9)
+    for key in range(5):
+        forecast = synthetic_forecast()
+        tracker.on_forecast(key, CacheEntry(forecast, 0, 0, 0, content_version(forecast)))
+    check(tracker.stats()["tracked_keys"] == 3, "Least recently updated keys dropped beyond max_keys")
+
+    for i in range(5):
+        weer["precipitation"] = 0.2 + i
+        forecast = synthetic_forecast()
+        tracker.on_forecast(4, CacheEntry(forecast, 0, 0, 0, content_version(forecast)))
+    weer["precipitation"] = 0.2
+    check(len(tracker._tracks[4]) == 3, "History keeps history + 1 versions per key")
+
+    per_key = tracker.bytes // sum(len(snapshots) for snapshots in tracker._tracks.values())
+    small = ChangeTracker(max_bytes=per_key * 4)
+    for key in range(10):
+        forecast = synthetic_forecast()
+        small.on_forecast(key, CacheEntry(forecast, 0, 0, 0, content_version(forecast)))
+    stats = small.stats()
+    check(stats["bytes"] <= small.max_bytes and stats["tracked_keys"] < 10 and stats["evicted_keys"] > 0,
+          f"Byte budget respected ({stats['tracked_keys']} keys, {stats['bytes']} bytes)")
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            first = await new_version(client)
+            weer["precipitation"] = 1.0
+            weer["soil_moisture"] = 0.12
+            second = await new_version(client)
+            check(first != second, "New forecast gets a new data_version")
+
+            feed = await client.get(f"/api/changes?api_key=demo&{LOCATION}&since={first}&days=2&window=6h")
+            body = feed.json()
+            check(feed.status_code == 200 and body["metadata"]["data_version"] == second
+                  and len(body["changes"]) == 1, "One change set since the first version")
+            change = body["changes"][0] if body.get("changes") else {}
+            check((change.get("advice") or {}).get("current", {}).get("needs_water") is True,
+                  "Advice flip reported")
+            windows = change.get("periods", {}).get("precipitation_sum", [])
+            check(0 < len(windows) <= 8 and all(w["period_hours"] == 6 and w["delta"] > 0 for w in windows),
+                  f"Precipitation deltas per requested 6h window over 2 days ({len(windows)} windows)")
+            cells = change.get("hourly", {}).get("precipitation", [])
+            check(0 < len(cells) <= 48 and hours_between(cells[0]["time"], cells[-1]["time"]) < 48,
+                  f"Hourly cells limited to the requested days ({len(cells)} cells)")
+
+            daily = (await client.get(f"/api/changes?api_key=demo&{LOCATION}&since={first}"
+                                      "&days=1&window=1d&agg=precipitation:sum,precipitation:max")).json()
+            periods = daily["changes"][0]["periods"] if daily.get("changes") else {}
+            check(set(periods) == {"precipitation_sum", "precipitation_max"}
+                  and len(periods["precipitation_sum"]) == 1,
+                  "Every requested aggregation is diffed with the requested window")
+
+            latest = await client.get(f"/api/changes?api_key=demo&{LOCATION}&since={second}")
+            check(latest.status_code == 200 and latest.json()["changes"] == [], "No changes since the latest version")
+            gone = await client.get(f"/api/changes?api_key=demo&{LOCATION}&since=unknown")
+            check(gone.status_code == 410, "Unknown version returns 410")
+
+            await client.put("/api/me?api_key=demo", json={"email": "farmer@example.com", "name": "Farm 1"})
+            farm = (await client.post("/api/me/farms?api_key=demo", json={"name": "North"})).json()
+            field = (await client.post(f"/api/me/farms/{farm['id']}/fields?api_key=demo",
+                                       json={"name": "Field A", "latitude": 51.5, "longitude": 5.1})).json()
+            by_field = await client.get(f"/api/changes?api_key=demo&location={field['id']}")
+            check(by_field.status_code == 200 and by_field.json()["metadata"]["location"]["id"] == field["id"],
+                  "User's fields work as ?location= like on /api")
+
+    test_bounds()
+
+
+asyncio.run(run())
+
+finish("Change feed test")
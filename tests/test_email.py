@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Email Queue Test
+Drives the backend in-process against a local SMTP stand-in (aiosmtpd):
+- /api/send-email answers 202 with a message id
+- every queued message is delivered and reported as "sent"
+- SMTP connections are reused across messages (at most one per worker)
+- resubmitting with the same Idempotency-Key does not send twice; keys are
+  per sender and can't be reused for a different email
+- delivery status survives a restart (durable outbox)
+- outbox: failed commits, retention sweep, status counters, older databases
+No cluster, network or real mailbox needed.
+
+Usage:
+    python test_email.py [number_of_emails]
+"""
+
+import asyncio
+import sqlite3
+import sys
+import time
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from helpers import DATA_DIR, check, configure_backend, finish, free_port
+
+AANTAL = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+SMTP_USER = "tester@tropometrics.local"
+SMTP_PASSWORD = "test-password"
+
+
+class RecordingHandler:
+    """Stores delivered messages and counts SMTP sessions"""
+
+    def __init__(self):
+        self.messages = []
+        self.sessions = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        self.sessions += 1
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return "250 Message accepted for delivery"
+
+
+def authenticator(server, session, envelope, mechanism, auth_data):
+    ok = auth_data.login.decode() == SMTP_USER and auth_data.password.decode() == SMTP_PASSWORD
+    return AuthResult(success=ok)
+
+
+handler = RecordingHandler()
+smtp_port = free_port()
+controller = Controller(
+    handler, hostname="127.0.0.1", port=smtp_port,
+    authenticator=authenticator, auth_require_tls=False
+)
+controller.start()
+
+# Configure the backend for the stand-in before importing it
+configure_backend(
+    EMAIL_USERNAME=SMTP_USER,
+    EMAIL_PASSWORD=SMTP_PASSWORD,
+    EMAIL_SERVER=f"127.0.0.1:{smtp_port}",
+    EMAIL_STARTTLS="false",
+    EMAIL_WORKERS="2",
+)
+
+import httpx  # noqa: E402
+import main  # noqa: E402
+from email_outbox import EmailOutbox  # noqa: E402
+from email_queue import EmailJob, IdempotencyConflictError  # noqa: E402
+
+main.limiter.enabled = False
+
+async def wait_for_delivery(client, message_ids):
+    statuses = []
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        statuses = [(await client.get(f"/api/send-email/{mid}")).json()["status"] for mid in message_ids]
+        if all(status in ("sent", "failed") for status in statuses):
+            break
+        await asyncio.sleep(0.1)
+    return statuses
+
+
+async def run():
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            tijd_start = time.time()
+            responses = await asyncio.gather(*[
+                client.post("/api/send-email", json={
+                    "to": f"farmer{i}@example.com",
+                    "subject": f"Weather Alert {i}",
+                    "body": "Heavy rain expected in the next 6 hours."
+                })
+                for i in range(AANTAL)
+            ])
+            accept_time = time.time() - tijd_start
+
+            check(all(r.status_code == 202 for r in responses), f"{AANTAL} emails accepted with 202")
+            message_ids = [r.json()["message_id"] for r in responses]
+            check(len(set(message_ids)) == AANTAL, "Every email has a unique message id")
+            print(f"  Accepted {AANTAL} emails in {accept_time:.3f}s")
+
+            # Wait for the workers to deliver everything
+            statuses = await wait_for_delivery(client, message_ids)
+
+            check(statuses.count("sent") == AANTAL, f"All emails reported as sent ({statuses.count('sent')}/{AANTAL})")
+            check(len(handler.messages) == AANTAL, f"SMTP stand-in received {len(handler.messages)} messages")
+            check(handler.sessions <= main.EMAIL_WORKERS,
+                  f"SMTP connections reused ({handler.sessions} session(s) for {AANTAL} messages)")
+            check(main.smtp_send_seconds.count("sent") >= AANTAL, "SMTP send latency recorded per message")
+
+            status = (await client.get(f"/api/send-email/{message_ids[0]}")).json()
+            check("to" not in status and "farmer" not in str(status), "The status does not reveal the recipient")
+
+            unknown = await client.get("/api/send-email/does-not-exist")
+            check(unknown.status_code == 404, "Unknown message id returns 404")
+
+            # Same Idempotency-Key twice (also concurrently) -> one message
+            email = {"to": "retry@example.com", "subject": "Retry", "body": "Sent once"}
+            headers = {"Idempotency-Key": "order-42"}
+            first, second = await asyncio.gather(
+                client.post("/api/send-email", json=email, headers=headers),
+                client.post("/api/send-email", json=email, headers=headers),
+            )
+            third = await client.post("/api/send-email", json=email, headers=headers)
+            ids = {r.json()["message_id"] for r in (first, second, third)}
+            check(len(ids) == 1, "Idempotency-Key resubmissions return the same message id")
+            check(third.json()["duplicate"], "Resubmission is reported as duplicate")
+            await wait_for_delivery(client, list(ids))
+            check(len(handler.messages) == AANTAL + 1, "Idempotent email delivered exactly once")
+
+            changed = await client.post("/api/send-email", json={**email, "body": "Something else"}, headers=headers)
+            check(changed.status_code == 422, "Same Idempotency-Key for a different email returns 422")
+            keyed = await client.post("/api/send-email?api_key=demo", json=email, headers=headers)
+            check(keyed.status_code == 202 and not keyed.json()["duplicate"]
+                  and keyed.json()["message_id"] not in ids, "Idempotency-Keys are scoped per sender")
+            await wait_for_delivery(client, [keyed.json()["message_id"]])
+
+            by_status = (await main.email_queue.stats())["outbox"]["by_status"]
+            with sqlite3.connect(main.EMAIL_OUTBOX_PATH) as db:
+                stored = dict(db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            check(by_status == {"queued": 0, "sending": 0, "sent": AANTAL + 2, "failed": 0}
+                  and by_status["sent"] == stored["sent"], f"Status counters match the outbox without a scan ({by_status})")
+
+    # Restart: statuses come from the outbox on disk, nothing is sent again
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            after = [(await client.get(f"/api/send-email/{mid}")).json()["status"] for mid in message_ids]
+            check(after.count("sent") == AANTAL, "Delivery status survives a restart")
+            await asyncio.sleep(0.5)
+            check(len(handler.messages) == AANTAL + 2, "Nothing is redelivered after a restart")
+
+
+async def test_outbox():
+    """EmailOutbox on its own: write errors, retention and an outbox from before per-client keys"""
+    outbox = EmailOutbox(f"{DATA_DIR}/outbox_unit.db", commit_interval=0, retention=86400)
+    await outbox.open()
+    write_batch = outbox._write_batch
+
+    def broken(inserts, updates):
+        outbox._write_batch = write_batch
+        raise sqlite3.OperationalError("disk I/O error")
+
+    first_id, _ = await outbox.add(EmailJob(to="a@example.com", subject="s", body="b"))
+    [job] = await outbox.claim(1)
+    job.sent_at = time.time()
+    outbox._write_batch = broken
+    outbox.record_sent(job)
+    try:
+        await outbox.add(EmailJob(to="b@example.com", subject="s", body="b"))
+        failed_add = None
+    except sqlite3.OperationalError as e:
+        failed_add = e
+    check(failed_add is not None, "A failed commit fails the waiting submissions")
+    await outbox._flush()
+    check((await outbox.get(first_id)).status == "sent", "Status updates of a failed commit are written by the next one")
+
+    await outbox.add(EmailJob(to="c@example.com", subject="s", body="b"), "order-1", "key:a")
+    try:
+        await outbox.add(EmailJob(to="c@example.com", subject="s", body="other"), "order-1", "key:a")
+        conflict = False
+    except IdempotencyConflictError:
+        conflict = True
+    _, duplicate = await outbox.add(EmailJob(to="c@example.com", subject="s", body="other"), "order-1", "key:b")
+    check(conflict and not duplicate, "Key reuse for another email is refused, other clients have their own keys")
+
+    swept = await outbox.sweep(now=time.time() + 2 * 86400)
+    stats = await outbox.stats()
+    check(swept == 1 and await outbox.get(first_id) is None and stats["by_status"]["sent"] == 0
+          and stats["by_status"]["queued"] == 2, "Sweep deletes sent messages past the retention, queued ones stay")
+    await outbox.close()
+
+    path = f"{DATA_DIR}/outbox_old.db"
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE outbox (id TEXT PRIMARY KEY, idempotency_key TEXT NOT NULL UNIQUE, "
+                   "recipient TEXT NOT NULL, subject TEXT NOT NULL, body TEXT NOT NULL, html INTEGER NOT NULL DEFAULT 0, "
+                   "status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+                   "next_attempt_at REAL NOT NULL, error TEXT, created_at REAL NOT NULL, sent_at REAL)")
+        db.execute("INSERT INTO outbox (id, idempotency_key, recipient, subject, body, next_attempt_at, created_at) "
+                   "VALUES ('old', 'alert:1', 'a@example.com', 's', 'b', 0, 0)")
+    outbox = EmailOutbox(path)
+    await outbox.open()
+    message_id, duplicate = await outbox.add(EmailJob(to="x@example.com", subject="s", body="new"), "alert:1")
+    stats = await outbox.stats()
+    check(message_id == "old" and duplicate and stats["by_status"]["queued"] == 1,
+          "Older outbox migrated, its keys still deduplicate")
+    await outbox.close()
+
+
+try:
+    asyncio.run(run())
+    asyncio.run(test_outbox())
+finally:
+    controller.stop()
+
+finish("Email queue test")
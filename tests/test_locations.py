@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Locations and Forecast Cache Test
+Drives the backend in-process against a mocked Open-Meteo (no cluster needed):
+- coordinates snap to the model grid, field ids and coordinates resolve,
+  invalid input is refused
+- nearby fields share one cached forecast and one upstream lookup, lookups
+  for different grid cells arriving together go upstream as one request
+- the forecast cache drops least recently used entries beyond its bound,
+  pinned keys stay; the upstream batcher keeps its running requests
+
+Usage:
+    python test_locations.py
+"""
+
+import asyncio
+
+from helpers import check, configure_backend, finish, open_meteo, synthetic_forecast, upstream_calls
+
+configure_backend(WEATHER_LOCATIONS="field-1=52.01,4.36;field-2=51.98,4.37", WEATHER_GRID_RESOLUTION="0.1")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from locations import parse_locations, resolve_location, snap, snap_location  # noqa: E402
+from upstream_batch import UpstreamBatcher  # noqa: E402
+from weather_cache import ForecastCache  # noqa: E402
+
+main.limiter.enabled = False
+upstream_requests = []
+
+
+def counting_open_meteo(request: httpx.Request) -> httpx.Response:
+    upstream_requests.append(request.url.params["latitude"])
+    return open_meteo(request)
+
+
+def test_snapping():
+    check(snap(52.01, 0.1) == 52.0 and snap(52.06, 0.1) == 52.1 and snap(-4.36, 0.1) == -4.4,
+          "Coordinates snap to the nearest grid point")
+    check(snap(52.123456, 0) == 52.1235, "Resolution 0 keeps 4 decimals")
+    check(snap_location({"latitude": 52.01, "longitude": 4.36}, 0.25) == {"latitude": 52.0, "longitude": 4.25},
+          "Grid cells follow the configured resolution")
+    known = parse_locations(" field-1=52.01,4.36 ; field-2=51.98,4.37;")
+    check(known == {"field-1": {"latitude": 52.01, "longitude": 4.36},
+                    "field-2": {"latitude": 51.98, "longitude": 4.37}}, "Field ids parsed from WEATHER_LOCATIONS")
+    default = {"latitude": 52.0, "longitude": 4.3}
+    check(resolve_location(known, default, location_id="field-2")["id"] == "field-2"
+          and resolve_location(known, default)["id"] == "default"
+          and resolve_location(known, default, 10.5, -20.25)["latitude"] == 10.5,
+          "Field id, default and coordinates resolve")
+    refused = 0
+    for arguments in ({"location_id": "nope"}, {"latitude": 52.0}, {"latitude": 91, "longitude": 0},
+                      {"latitude": 0, "longitude": 181}):
+        try:
+            resolve_location(known, default, **arguments)
+        except ValueError:
+            refused += 1
+    check(refused == 4, "Unknown ids, half coordinates and out-of-range coordinates refused")
+
+
+async def test_bounds():
+    cache = ForecastCache(ttl_seconds=60, max_entries=2)
+    fetch = {}
+
+    async def fetch_key(key):
+        fetch[key] = fetch.get(key, 0) + 1
+        return synthetic_forecast(1)
+
+    cache.pin("pinned", lambda: fetch_key("pinned"))
+    for key in ("pinned", "a", "b"):
+        await cache.get_or_fetch(key, lambda key=key: fetch_key(key))
+    await cache.get_or_fetch("b", lambda: fetch_key("b"))
+    await cache.get_or_fetch("c", lambda: fetch_key("c"))
+    stats = cache.stats()
+    check(stats["entries"] == 2 and stats["evicted"] == 2 and set(cache._entries) == {"pinned", "c"},
+          f"Least recently used entries dropped beyond max_entries, pinned key kept ({list(cache._entries)})")
+    await cache.get_or_fetch("a", lambda: fetch_key("a"))
+    check(fetch["a"] == 2, "Dropped entry is fetched again")
+
+    release = asyncio.Event()
+
+    async def fetch_many(group, items):
+        await release.wait()
+        return items
+
+    batcher = UpstreamBatcher(fetch_many, window_seconds=0)
+    lookup = asyncio.ensure_future(batcher.fetch("group", 1))
+    await asyncio.sleep(0.01)
+    running = batcher.stats()["running"]
+    release.set()
+    result = await lookup
+    await asyncio.sleep(0)
+    check(running == 1 and result == 1 and batcher.stats()["running"] == 0,
+          "Batcher keeps its running request until it is done")
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        await main.app.state.http_client.aclose()
+        main.app.state.http_client = httpx.AsyncClient(transport=httpx.MockTransport(counting_open_meteo))
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            main.forecast_cache.clear()
+            upstream_calls.clear()
+            first = (await client.get("/api?api_key=demo&location=field-1")).json()["metadata"]["location"]
+            second = (await client.get("/api?api_key=demo&location=field-2")).json()["metadata"]["location"]
+            cells = {(location["grid_latitude"], location["grid_longitude"]) for location in (first, second)}
+            check(cells == {(52.0, 4.4)}, "Nearby fields share one grid cell")
+            check(first["latitude"] == 52.01 and second["latitude"] == 51.98, "Requested points are reported too")
+            check(upstream_calls == [(52.0, 4.4)], f"One upstream lookup for both fields ({upstream_calls})")
+
+            upstream_requests.clear()
+            responses = await asyncio.gather(*[
+                client.get(f"/api?api_key=demo&latitude={latitude}&longitude=5.0") for latitude in (50.0, 50.5, 51.0)
+            ])
+            check(all(r.status_code == 200 for r in responses) and len(upstream_requests) == 1
+                  and upstream_requests[0].count(",") == 2,
+                  f"Three grid cells fetched in one upstream request ({upstream_requests})")
+            bad = await client.get("/api?api_key=demo&latitude=52.0")
+            check(bad.status_code == 400, "Half-specified coordinates return 400")
+
+    test_snapping()
+    await test_bounds()
+
+
+asyncio.run(run())
+
+finish("Locations test")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Event Loop Monitor Test
+Drives the backend in-process with temporary databases (no cluster needed):
+- the lag sampler fills tropometrics_event_loop_lag_seconds on /metrics
+- a blocking call on the loop is counted as a stall
+- in debug mode the watchdog logs the loop thread's stack while it is blocked,
+  naming the blocking function
+Uses the test key (random data), Open-Meteo is not called.
+
+Usage:
+    python test_loop_monitor.py
+"""
+
+import asyncio
+import logging
+import time
+
+from helpers import check, configure_backend, finish
+
+configure_backend(LOOP_LAG_INTERVAL="0.02", LOOP_STALL_THRESHOLD_MS="100", LOOP_DEBUG="true")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+main.limiter.enabled = False
+
+
+class Recorder(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def blocking_report_builder():
+    """Stands in for synchronous work on the loop"""
+    time.sleep(0.4)
+
+
+async def run():
+    recorder = Recorder()
+    logging.getLogger("loop_monitor").addHandler(recorder)
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            await asyncio.gather(*[client.get("/api?api_key=test") for _ in range(20)])
+            await asyncio.sleep(0.3)
+            quiet = main.loop_monitor.stats()
+            check(quiet["samples"] > 5, f"Lag is sampled ({quiet['samples']} samples)")
+            check(quiet["stacks_logged"] == 0, "No stack logged without a stall")
+
+            blocking_report_builder()
+            await asyncio.sleep(0.1)
+            stats = main.loop_monitor.stats()
+            check(stats["stalls"] > quiet["stalls"] and stats["max_lag_seconds"] >= 0.3,
+                  f"Blocking call counted as a stall ({stats})")
+            stacks = [m for m in recorder.messages if "Event loop blocked" in m]
+            check(len(stacks) == 1, f"One stack trace logged per stall ({len(stacks)})")
+            check(stacks and "blocking_report_builder" in stacks[0] and "time.sleep" in stacks[0],
+                  "Stack names the blocking call")
+
+            text = (await client.get("/metrics")).text
+            check('tropometrics_event_loop_lag_seconds_bucket{le="+Inf"}' in text, "Lag histogram on /metrics")
+            check("tropometrics_event_loop_stalls_total 1" in text, "Stall counter on /metrics")
+
+
+asyncio.run(run())
+
+finish("Event loop monitor test")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Metrics Test
+Drives the backend in-process with temporary databases (no cluster needed):
+- /metrics answers in the Prometheus text format
+- requests are counted per route template, method and status
+- /api stage histograms (upstream, derivation, serialization, html) are filled
+- Open-Meteo errors are counted per status code, cache lookups and 429s show up
+Open-Meteo is replaced by a local mock transport.
+
+Usage:
+    python test_metrics.py
+"""
+
+import asyncio
+import re
+
+from helpers import check, configure_backend, finish, mock_upstream, weer
+
+configure_backend()
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+
+def sample(text, name, **labels):
+    """Value of one sample in the exposition text, None when absent"""
+    for line in text.splitlines():
+        match = re.match(r"^([a-z_]+)(?:\{(.*)\})? (\S+)$", line)
+        if not match or match.group(1) != name:
+            continue
+        found = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2) or ""))
+        if all(found.get(k) == v for k, v in labels.items()):
+            return float(match.group(3))
+    return None
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        await mock_upstream(main.app)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            for _ in range(3):
+                await client.get("/api?api_key=demo")
+            await client.get("/api?api_key=demo&format=html")
+            await client.get("/api?api_key=nope")
+            await client.get("/api/subscriptions/unknown?api_key=demo")
+
+            # A new location with Open-Meteo failing
+            weer["status"] = 503
+            failed = await client.get("/api?api_key=demo&latitude=40.1&longitude=-3.7")
+            weer["status"] = 200
+            check(failed.status_code == 503, "Upstream failure returns 503")
+
+            # Exhaust the client's route limit
+            for _ in range(40):
+                await client.get("/api/changes?api_key=demo")
+
+            response = await client.get("/metrics")
+            check(response.status_code == 200 and response.headers["content-type"].startswith("text/plain"),
+                  "/metrics answers in the text format")
+            text = response.text
+
+            requests = sample(text, "tropometrics_http_requests_total", route="/api", method="GET", status="200")
+            check(requests == 4, f"Requests counted per route and status ({requests})")
+            check(sample(text, "tropometrics_http_requests_total", route="/api", status="401") == 1,
+                  "Unauthorized requests counted under their own status")
+            check(sample(text, "tropometrics_http_requests_total",
+                         route="/api/subscriptions/{subscription_id}", status="404") == 1,
+                  "Path parameters are labelled by route template")
+            check(sample(text, "tropometrics_http_request_duration_seconds_count", route="/api", status="200") == 4,
+                  "Latency histogram per route")
+            check(sample(text, "tropometrics_http_request_duration_seconds_bucket",
+                         route="/api", status="200", le="+Inf") == 4, "Histogram has a +Inf bucket")
+
+            for stage in ("upstream", "derivation", "serialization", "html"):
+                count = sample(text, "tropometrics_api_stage_seconds_count", stage=stage)
+                check(count and count >= 1, f"Stage histogram for {stage} ({count})")
+            check(sample(text, "tropometrics_upstream_request_seconds_count", outcome="503") == 1,
+                  "Upstream errors counted by status code")
+            check(sample(text, "tropometrics_upstream_request_seconds_count", outcome="ok") >= 1,
+                  "Successful upstream requests counted")
+
+            hits = sample(text, "tropometrics_forecast_cache_lookups_total", result="hits")
+            check(hits and hits >= 3, f"Forecast cache hits exposed ({hits})")
+            check(sample(text, "tropometrics_forecast_cache_hit_ratio") is not None, "Cache hit ratio exposed")
+            rejected = sample(text, "tropometrics_rate_limit_rejections_total", scope="client")
+            check(rejected == 10, f"Rate-limit rejections exposed ({rejected})")
+            check(sample(text, "tropometrics_http_requests_in_flight") == 1, "In-flight gauge includes the scrape")
+            check("# TYPE tropometrics_api_stage_seconds histogram" in text, "Histograms are typed")
+
+
+asyncio.run(run())
+
+finish("Metrics test")
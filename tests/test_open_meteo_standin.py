@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Open-Meteo Stand-in Test
+Runs the stand-in on a local port and the backend in-process pointed at it
+through OPEN_METEO_BASE_URL (no cluster or network needed):
+- /v1/forecast has the shape /api consumes, for one or several coordinates,
+  and is deterministic per grid cell
+- /api serves demo-key data fetched from the stand-in
+- injected latency, 5xx errors, 429s and slow bodies reach the backend
+  (timings on the upstream histogram, 503 for a forecast that cannot be fetched)
+- faults can be changed at runtime
+
+Usage:
+    python test_open_meteo_standin.py
+"""
+
+import asyncio
+import threading
+import time
+
+from helpers import check, configure_backend, finish, free_port
+
+STANDIN_URL = f"http://127.0.0.1:{free_port()}"
+configure_backend(OPEN_METEO_BASE_URL=STANDIN_URL, RATE_LIMIT_ENABLED="false")
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+from open_meteo_standin import create_app  # noqa: E402
+
+standin = create_app(seed=1)
+cells = iter(range(1000))
+
+
+def new_cell():
+    """Coordinates of a grid cell the backend has not cached yet"""
+    return f"latitude={10 + next(cells) * 0.5}&longitude=20.0"
+
+
+async def timed_get(client, url):
+    tijd_start = time.perf_counter()
+    response = await client.get(url)
+    return response, time.perf_counter() - tijd_start
+
+
+async def run():
+    async with httpx.AsyncClient(base_url=STANDIN_URL) as upstream:
+        params = {
+            "latitude": "-5.013", "longitude": "-58.381", "timezone": "Europe/Amsterdam",
+            **{section: ",".join(names) for section, names in main.WEATHER_VARIABLES.items()},
+        }
+        forecast = (await upstream.get("/v1/forecast", params=params)).json()
+        check(len(forecast["hourly"]["time"]) == 168 and len(forecast["daily"]["time"]) == 7
+              and all(len(forecast["hourly"][v]) == 168 for v in main.WEATHER_VARIABLES["hourly"])
+              and all(len(forecast["daily"][v]) == 7 for v in main.WEATHER_VARIABLES["daily"])
+              and "temperature_2m" in forecast["current"], "Forecast has current, hourly and daily variables")
+        check((forecast["latitude"], forecast["longitude"]) == (-5.0, -58.375) and forecast["hourly_units"],
+              "Coordinates snap to the model grid, units included")
+        again = (await upstream.get("/v1/forecast", params=params)).json()
+        check(again["hourly"] == forecast["hourly"], "Same cell, same data")
+        several = (await upstream.get("/v1/forecast", params={**params, "latitude": "1,2,3",
+                                                               "longitude": "4,5,6"})).json()
+        check(isinstance(several, list) and len(several) == 3, "Several coordinates return a list")
+        bad = await upstream.get("/v1/forecast", params={**params, "latitude": "95"})
+        check(bad.status_code == 400 and bad.json()["error"] is True, "Invalid coordinates answer 400 with a reason")
+
+        direct_requests = standin.state.stats.requests
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+                response = await client.get("/api?api_key=demo")
+                check(response.status_code == 200 and "irrigation" in response.json()
+                      and response.json()["forecast"]["periods"], "/api serves data from the stand-in")
+                check(standin.state.stats.requests > direct_requests, "Backend fetched through OPEN_METEO_BASE_URL")
+
+                await upstream.put("/faults", json={"latency": "fixed:300"})
+                response, seconds = await timed_get(client, f"/api?api_key=demo&{new_cell()}")
+                check(response.status_code == 200 and seconds >= 0.3, f"Injected latency reaches /api ({seconds:.2f}s)")
+
+                await upstream.put("/faults", json={"latency": "none", "error_rate": 1, "error_status": 502})
+                response = await client.get(f"/api?api_key=demo&{new_cell()}")
+                check(response.status_code == 503 and main.upstream_request_seconds.count("502") == 1,
+                      "Injected 502 is a 503 for an uncached forecast")
+
+                await upstream.put("/faults", json={"error_rate": 0, "throttle_rate": 1})
+                response = await client.get(f"/api?api_key=demo&{new_cell()}")
+                check(response.status_code == 503 and main.upstream_request_seconds.count("429") == 1,
+                      "Injected 429 is counted per status")
+                check((await client.get("/api?api_key=demo")).status_code == 200,
+                      "Cached forecasts are still served while upstream fails")
+
+                await upstream.put("/faults", json={"throttle_rate": 0, "slow_rate": 1, "slow_seconds": 1})
+                response, seconds = await timed_get(client, f"/api?api_key=demo&{new_cell()}")
+                check(response.status_code == 200 and seconds >= 1, f"Slow body delays /api ({seconds:.2f}s)")
+
+                rejected = await upstream.put("/faults", json={"error_rate": 2})
+                check(rejected.status_code == 400, "Invalid fault settings are rejected")
+                print(f"  Stand-in: {(await upstream.get('/stats')).json()}")
+
+
+server = uvicorn.Server(uvicorn.Config(standin, port=int(STANDIN_URL.rsplit(":", 1)[1]), log_level="warning"))
+thread = threading.Thread(target=server.run, daemon=True)
+thread.start()
+while not server.started:
+    time.sleep(0.05)
+
+asyncio.run(run())
+server.should_exit = True
+thread.join()
+
+finish("Open-Meteo stand-in test")
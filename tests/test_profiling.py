@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Profiling Test
+Drives the backend in-process with temporary databases (no cluster needed):
+- only admin keys may profile a request (?profile=1 / X-Profile header)
+- a profiled request answers normally and its report is saved and downloadable
+- ?profile=inline returns the report instead of the response
+- the report directory stays bounded
+- the continuous sampler writes folded stacks of the event loop
+Open-Meteo is replaced by a local mock transport.
+
+Usage:
+    python test_profiling.py
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+
+from helpers import check, configure_backend, data_path, finish, mock_upstream
+
+configure_backend(
+    PROFILE_KEEP="3",
+    PROFILE_SAMPLER="true",
+    PROFILE_SAMPLER_INTERVAL_MS="5",
+    PROFILE_SAMPLER_DUMP_SECONDS="0.3",
+)
+KEYS_DB = data_path("API_KEYS_PATH")
+PROFILE_DIR = data_path("PROFILE_DIR")
+
+import httpx  # noqa: E402
+
+import api_keys  # noqa: E402
+import main  # noqa: E402
+
+main.limiter.enabled = False
+
+
+def create_key(*flags):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        api_keys.main(["--db", KEYS_DB, "create", "--name", "Profiling", *flags])
+    return next(line.split()[1] for line in output.getvalue().splitlines() if line.startswith("key:"))
+
+
+async def run():
+    admin, regular = create_key("--admin"), create_key()
+    async with main.app.router.lifespan_context(main.app):
+        await mock_upstream(main.app)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            await asyncio.sleep(0.5)
+            folded = [r["id"] for r in main.profile_ring.reports() if r["id"].endswith(".folded")]
+            check(folded, f"Sampler wrote folded stacks ({main.stack_sampler.stats()})")
+            if folded:
+                stacks = main.profile_ring.read(folded[0]).decode().splitlines()
+                check(all(line.rsplit(" ", 1)[1].isdigit() and ";" in line for line in stacks),
+                      "Folded format: frame;frame;frame count")
+
+            refused = await client.get(f"/api?api_key={regular}&profile=1")
+            check(refused.status_code == 403, "Non-admin keys cannot profile")
+            check((await client.get("/api?api_key=demo", headers={"X-Profile": "1"})).status_code == 403,
+                  "Built-in keys cannot profile")
+            check((await client.get(f"/api/admin/profiles?api_key={regular}")).status_code == 403,
+                  "Profile list needs an admin key")
+
+            profiled = await client.get(f"/api?api_key={admin}&profile=1")
+            report_id = profiled.headers.get("x-profile-id", "")
+            check(profiled.status_code == 200 and "irrigation" in profiled.json(),
+                  "Profiled request answers normally")
+            report = await client.get(f"/api/admin/profiles/{report_id}?api_key={admin}")
+            check(report.status_code == 200 and "weather_data_api" in report.text,
+                  f"Saved {main.request_profiler.backend} report names the endpoint")
+            check((await client.get(f"/api/admin/profiles/..%2Fapi_keys.db?api_key={admin}")).status_code == 404,
+                  "Only report ids can be read")
+
+            inline = await client.get(f"/api?api_key={admin}", headers={"X-Profile": "inline"})
+            check(inline.status_code == 200 and inline.headers.get("x-profiled-status") == "200"
+                  and "weather_data_api" in inline.text, "Inline profile replaces the response")
+
+            for _ in range(5):
+                await client.get(f"/api?api_key={admin}&profile=1")
+            listing = (await client.get(f"/api/admin/profiles?api_key={admin}")).json()
+            check(len(listing["reports"]) <= 3 and len(os.listdir(PROFILE_DIR)) <= 3,
+                  f"Report ring stays bounded ({len(listing['reports'])} kept)")
+
+
+asyncio.run(run())
+
+finish("Profiling test")
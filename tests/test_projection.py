@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Field Projection Test
+Drives the backend in-process with synthetic forecasts (no cluster needed):
+- ?fields= returns only the selected paths, nested paths included (also
+  through lists such as forecast.periods)
+- ?exclude= drops paths, an unknown field returns 400
+- sections that are not selected are never built, and each selection has
+  its own ETag
+
+Usage:
+    python test_projection.py
+"""
+
+import asyncio
+
+from helpers import check, configure_backend, fake_open_meteo, finish
+
+configure_backend()
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+import weather_report  # noqa: E402
+from projection import FieldProjection  # noqa: E402
+
+main.limiter.enabled = False
+main.fetch_open_meteo = fake_open_meteo
+built = []
+raw_data_builder = weather_report._BUILDERS["raw_data"]
+
+
+def counting_raw_data(weather_data, options):
+    built.append("raw_data")
+    return raw_data_builder(weather_data, options)
+
+
+weather_report._BUILDERS["raw_data"] = counting_raw_data
+
+
+def test_overlapping_paths():
+    projection = FieldProjection("irrigation.needs_water,irrigation", None, ("metadata", "irrigation"))
+    report = {"metadata": {}, "irrigation": {"needs_water": True, "threshold": 0.14}}
+    check(projection.apply(report) == {"irrigation": {"needs_water": True, "threshold": 0.14}},
+          "A whole section wins over one of its paths")
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            async def get(query):
+                return await client.get(f"/api?api_key=demo&{query}")
+
+            built.clear()
+            valve = await get("fields=irrigation.needs_water")
+            check(valve.status_code == 200 and list(valve.json()) == ["irrigation"]
+                  and list(valve.json()["irrigation"]) == ["needs_water"],
+                  f"Only the selected field is returned ({valve.text})")
+            check(not built, "Unselected sections are not built")
+
+            nested = (await get("fields=metadata.location.grid_latitude,forecast.periods.start")).json()
+            periods = nested.get("forecast", {}).get("periods", [])
+            check(list(nested) == ["metadata", "forecast"] and list(nested["metadata"]) == ["location"]
+                  and list(nested["metadata"]["location"]) == ["grid_latitude"],
+                  "Nested paths select inside a section")
+            check(periods and all(list(period) == ["start"] for period in periods),
+                  f"Paths apply to every element of a list ({len(periods)} periods)")
+
+            excluded = (await get("exclude=raw_data,forecast.periods,metadata")).json()
+            check("raw_data" not in excluded and "metadata" not in excluded and "periods" not in excluded["forecast"]
+                  and "forecast_periods" in excluded["forecast"] and "irrigation" in excluded,
+                  "Excluded paths are dropped, everything else stays")
+
+            full = await get("")
+            check("raw_data" in full.json() and built == ["raw_data"], "Without a selection every section is built")
+
+            for query in ("fields=bogus", "exclude=bogus.x", "fields=irrigation,weather"):
+                unknown = await get(query)
+                check(unknown.status_code == 400 and "Unknown field" in unknown.json()["message"],
+                      f"Unknown field returns 400 ({query})")
+
+            check(len({valve.headers["etag"], full.headers["etag"]}) == 2, "Each selection has its own ETag")
+            test_key = await client.get("/api?api_key=test&fields=irrigation.needs_water")
+            check(test_key.json() == {"irrigation": {"needs_water": test_key.json()["irrigation"]["needs_water"]}},
+                  "Projection also applies to test-key data")
+
+    test_overlapping_paths()
+
+
+asyncio.run(run())
+
+finish("Field projection test")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Rate Limiter Test
+Drives the backend in-process (no cluster needed):
+- the client address is taken from X-Forwarded-For only behind a trusted proxy
+- route limits apply per client, the API key quota across clients, and the
+  quota covers every route that takes an api_key
+- a request refused by one bucket takes no token from the other
+- rejected requests get a 429 with Retry-After
+- bucket checks stay O(1) and memory stays bounded with many keys
+- the Redis backend's Lua script runs against fakeredis when it is installed
+  (tests/requirements.txt); a stub client checks keys, arguments and failing open
+
+Usage:
+    python test_rate_limit.py
+"""
+
+import asyncio
+import importlib.util
+import inspect
+import time
+
+from helpers import check, configure_backend, finish
+
+configure_backend(API_KEY_RATE_LIMIT="40/minute")
+
+import httpx  # noqa: E402
+from fastapi.routing import APIRoute  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+import main  # noqa: E402
+from rate_limit import MemoryBackend, RedisBackend, client_address, parse_networks, parse_rate  # noqa: E402
+
+
+def request_from(peer, headers=None):
+    return Request({
+        "type": "http",
+        "client": (peer, 1234),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    })
+
+
+def test_client_address():
+    proxies = parse_networks("10.0.0.0/8")
+    check(client_address(request_from("10.0.0.5", {"X-Forwarded-For": "203.0.113.9"}), 1, proxies) == "203.0.113.9",
+          "Client address taken from X-Forwarded-For behind the proxy")
+    check(client_address(request_from("10.0.0.5", {"X-Forwarded-For": "1.1.1.1, 203.0.113.9"}), 1, proxies)
+          == "203.0.113.9", "Spoofed X-Forwarded-For entries are ignored")
+    check(client_address(request_from("10.0.0.5", {"X-Forwarded-For": "203.0.113.9, 10.0.0.7"}), 2, proxies)
+          == "203.0.113.9", "Two trusted hops skip both proxies")
+    check(client_address(request_from("10.0.0.5", {"X-Real-IP": "203.0.113.9"}), 1, proxies) == "203.0.113.9",
+          "X-Real-IP is used without X-Forwarded-For")
+    check(client_address(request_from("198.51.100.1", {"X-Forwarded-For": "203.0.113.9"}), 1, proxies)
+          == "198.51.100.1", "Forwarding headers from untrusted peers are ignored")
+
+
+async def test_buckets(backend, name):
+    rate = parse_rate("5/second")
+    results = [(await backend.acquire("bucket", rate))[0] for _ in range(6)]
+    check(results == [True] * 5 + [False], f"{name}: burst of 5 allowed, 6th rejected")
+    _, retry_after, _ = await backend.acquire("bucket", rate)
+    check(0 < retry_after <= 0.21, f"{name}: retry after one emission interval ({retry_after:.3f}s)")
+    await asyncio.sleep(0.25)
+    check((await backend.acquire("bucket", rate))[0], f"{name}: bucket refills over time")
+
+
+async def test_all_or_nothing(backend, name):
+    wide, narrow = parse_rate("5/second"), parse_rate("1/second")
+    first = await backend.acquire_all([("wide", wide), ("narrow", narrow)])
+    second = await backend.acquire_all([("wide", wide), ("narrow", narrow)])
+    check(first[0] and not second[0] and second[2] == 1, f"{name}: the empty bucket refuses, reported by index")
+    rest = [(await backend.acquire("wide", wide))[0] for _ in range(5)]
+    check(rest == [True] * 4 + [False], f"{name}: a refused request takes no token from the other bucket")
+
+
+class StubScript:
+    """Stands in for redis' registered script: records calls, answers or fails"""
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = []
+
+    async def __call__(self, keys, args):
+        self.calls.append((keys, args))
+        if isinstance(self.reply, Exception):
+            raise self.reply
+        return self.reply
+
+
+class StubRedis:
+    def __init__(self, reply):
+        self.script = StubScript(reply)
+
+    def register_script(self, source):
+        self.source = source
+        return self.script
+
+
+async def test_redis_stub():
+    client = StubRedis([0, "1.5", 1])
+    backend = RedisBackend(client)
+    decision = await backend.acquire_all([("ip:a", parse_rate("30/minute")), ("key:b", parse_rate("2/second"))])
+    keys, args = client.script.calls[0]
+    check(keys == ["ratelimit:ip:a", "ratelimit:key:b"] and args == [2.0, 60, 0.5, 1],
+          "Redis: one script call with prefixed keys and (interval, period) per bucket")
+    check(decision == (False, 1.5, 1), "Redis: the script's refusal and retry time are passed on")
+    down = RedisBackend(StubRedis(ConnectionError("refused")))
+    check((await down.acquire("ip:a", parse_rate("1/minute")))[0] and down.stats()["errors"] == 1,
+          "Redis: requests are let through while Redis is unreachable")
+
+
+def test_routes_limited():
+    unlimited = [route.path for route in main.app.routes
+                 if isinstance(route, APIRoute) and "api_key" in inspect.signature(route.endpoint).parameters
+                 and not hasattr(route.endpoint, "rate_limit")]
+    check(not unlimited, f"Every route taking an api_key counts against the key quota {unlimited or ''}")
+
+
+async def test_bounded_memory():
+    backend = MemoryBackend(max_keys=10000)
+    rate = parse_rate("30/minute")
+    count = 200000
+    start = time.perf_counter()
+    for i in range(count):
+        await backend.acquire(f"ip:{i}", rate)
+    per_check = (time.perf_counter() - start) / count * 1e6
+    check(backend.stats()["keys"] == 10000, f"Memory bounded at 10000 of {count} keys")
+    print(f"  {per_check:.2f} µs per check")
+
+
+async def test_app():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            async def get(ip):
+                return await client.get("/api?api_key=test", headers={"X-Forwarded-For": ip})
+
+            first = [(await get("203.0.113.1")).status_code for _ in range(31)]
+            check(first[:30] == [200] * 30 and first[30] == 429, "Route limit of 30/minute per client")
+            second = [(await get("203.0.113.2")).status_code for _ in range(10)]
+            check(second == [200] * 10, "Another client behind the same proxy has its own limit")
+            third = await get("203.0.113.3")
+            check(third.status_code == 429 and third.json()["detail"] == "40/minute per API key",
+                  "API key quota of 40/minute applies across clients")
+            check(int(third.headers.get("Retry-After", 0)) >= 1, "429 carries Retry-After")
+            profile = await client.get("/api/me?api_key=test", headers={"X-Forwarded-For": "203.0.113.4"})
+            check(profile.status_code == 429 and profile.json()["detail"] == "40/minute per API key",
+                  "The quota also covers routes without a route limit (/api/me)")
+            print(f"  Limiter: {main.limiter.stats()}")
+
+
+async def run():
+    test_client_address()
+    await test_buckets(MemoryBackend(), "memory")
+    await test_all_or_nothing(MemoryBackend(), "memory")
+    if importlib.util.find_spec("fakeredis") is not None and importlib.util.find_spec("lupa") is not None:
+        import fakeredis
+        await test_buckets(RedisBackend(fakeredis.FakeAsyncRedis()), "redis")
+        await test_all_or_nothing(RedisBackend(fakeredis.FakeAsyncRedis()), "redis")
+    else:
+        print("- fakeredis[lua] not installed, Redis script skipped")
+    await test_redis_stub()
+    test_routes_limited()
+    await test_bounded_memory()
+    await test_app()
+
+
+asyncio.run(run())
+
+finish("Rate limit test")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Rendering Test
+Drives the backend in-process with synthetic forecasts (no cluster needed):
+- the same report as JSON, MessagePack, CBOR and HTML
+- HTML pages escape the JSON they wrap, so location ids, windows and field
+  paths echoed in error messages cannot inject markup
+
+Usage:
+    python test_rendering.py
+"""
+
+import asyncio
+
+from helpers import check, configure_backend, fake_open_meteo, finish
+
+configure_backend()
+
+import cbor2  # noqa: E402
+import httpx  # noqa: E402
+import msgpack  # noqa: E402
+
+import main  # noqa: E402
+from rendering import html_response  # noqa: E402
+
+main.limiter.enabled = False
+main.fetch_open_meteo = fake_open_meteo
+PAYLOAD = "<script>alert(1)</script>"
+
+
+def test_html_response():
+    page = html_response({"error": PAYLOAD, "note": "a & b"}).body.decode()
+    check("&lt;script&gt;alert(1)&lt;/script&gt;" in page and PAYLOAD not in page,
+          "html_response escapes markup in the payload")
+    check("a &amp; b" in page and '"error"' in page, "Ampersands are escaped, JSON quotes stay readable")
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            response = await client.get("/api?api_key=demo")
+            check(response.status_code == 200 and "irrigation" in response.json(), "JSON report")
+            report = response.json()
+            packed = await client.get("/api?api_key=demo&format=msgpack")
+            check(msgpack.unpackb(packed.content)["irrigation"] == report["irrigation"],
+                  "MessagePack carries the same report")
+            packed = await client.get("/api?api_key=demo&format=cbor")
+            check(cbor2.loads(packed.content)["irrigation"] == report["irrigation"], "CBOR carries the same report")
+            page = await client.get("/api?api_key=demo", headers={"Accept": "text/html"})
+            check(page.headers["content-type"].startswith("text/html") and "<pre>" in page.text,
+                  "Browsers get an HTML page")
+
+            # Each parameter ends up in an error message that the page shows
+            for parameter in ("location", "window", "fields"):
+                page = await client.get("/api", params={"api_key": "demo", parameter: PAYLOAD, "format": "html"})
+                check(page.status_code == 400 and "&lt;script&gt;" in page.text and PAYLOAD not in page.text,
+                      f"An invalid {parameter} is escaped on the error page")
+
+
+test_html_response()
+asyncio.run(run())
+
+finish("Rendering test")
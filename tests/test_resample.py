@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Resampling Test
+Checks the forecast resampling directly, no backend or network:
+- sum/mean/min/max per window, windows aligned to the local clock
+- missing hours are skipped, a window without any value is null for every
+  aggregation (a sum of nothing is not 0.0)
+- window and aggregation parsing
+
+Usage:
+    python test_resample.py
+"""
+
+from datetime import datetime, timedelta
+
+from helpers import check, configure_backend, finish
+
+configure_backend()
+
+from resample import parse_aggregations, parse_window, resample_hourly, window_start  # noqa: E402
+
+START = datetime(2026, 6, 1)
+AGGREGATIONS = [("precipitation", "sum"), ("precipitation", "mean"), ("precipitation", "min"),
+                ("precipitation", "max"), ("temperature_2m", "max")]
+
+
+def hourly(precipitation):
+    times = [(START + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(len(precipitation))]
+    return {"time": times, "precipitation": precipitation, "temperature_2m": [20.0 + i for i in range(len(times))]}
+
+
+def test_aggregations():
+    windows = resample_hourly(hourly([1.0, 2.0, 3.0, 0.0, 0.5, 0.5]), AGGREGATIONS, START, 3, 6)
+    check(len(windows) == 2 and windows[0]["start"] == "2026-06-01T00:00" and windows[1]["period_hours"] == 3,
+          "Two 3h windows from six hours")
+    first = windows[0]
+    check((first["precipitation_sum"], first["precipitation_mean"], first["precipitation_min"],
+           first["precipitation_max"], first["temperature_2m_max"]) == (6.0, 2.0, 1.0, 3.0, 22.0),
+          "sum, mean, min and max of a window")
+
+
+def test_missing_values():
+    windows = resample_hourly(hourly([None, 2.0, None, None, None, None]), AGGREGATIONS, START, 3, 6)
+    check(windows[0]["precipitation_sum"] == 2.0 and windows[0]["precipitation_mean"] == 2.0,
+          "Missing hours are skipped")
+    empty = windows[1]
+    check(all(empty[f"precipitation_{how}"] is None for how in ("sum", "mean", "min", "max")),
+          "A window without values is null for every aggregation, also sum")
+    check(empty["temperature_2m_max"] == 25.0, "Other variables of that window keep their values")
+
+
+def test_parsing():
+    check([parse_window(value) for value in ("6", "3h", "1d")] == [6, 3, 24], "Windows in hours and days")
+    for value in ("0h", "17d", "soon"):
+        try:
+            parse_window(value)
+            check(False, f"Window {value!r} is rejected")
+        except ValueError:
+            check(True, f"Window {value!r} is rejected")
+    check(parse_aggregations("precipitation,temperature_2m:max")
+          == [("precipitation", "sum"), ("temperature_2m", "max")], "Aggregation defaults to sum")
+    check(window_start(datetime(2026, 6, 1, 7, 30), 6) == datetime(2026, 6, 1, 6), "Windows align to the clock")
+
+
+test_aggregations()
+test_missing_values()
+test_parsing()
+
+finish("Resampling test")
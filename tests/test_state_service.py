@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+State Service Test
+Runs the backend twice, as the Kubernetes deployment does (no cluster needed):
+- the state service with its own temporary databases, in a uvicorn subprocess
+- this process as a scaled API replica with STATE_SERVICE_URL pointing at it
+Checks that the API replica serves /api without owning any state - no email
+outbox, subscription, webhook, API key or user database, no email credentials
+for /health - and leaves the stateful endpoints to the state service, which
+serves them. Keys and profiles saved on the state service work on the replica,
+its usage is counted there, and the internal endpoints need the shared token.
+
+Usage:
+    python test_state_service.py
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from helpers import BACKEND_DIR, DATA_DIR, DATA_PATHS, check, configure_backend, fake_open_meteo, finish, free_port
+
+STATE_PORT = free_port()
+STATE_URL = f"http://127.0.0.1:{STATE_PORT}"
+STATE_DIR = os.path.join(DATA_DIR, "state")
+STATE_TOKEN = "state-test-token"
+configure_backend(STATE_SERVICE_URL=STATE_URL, STATE_SERVICE_TOKEN=STATE_TOKEN, USER_CACHE_CHECK_SECONDS="0.2")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from api_keys import STATE_TOKEN_HEADER, hash_key  # noqa: E402
+
+main.limiter.enabled = False
+main.fetch_open_meteo = fake_open_meteo
+
+
+def start_state_service() -> subprocess.Popen:
+    """The state service: same app, own databases, email credentials, no STATE_SERVICE_URL"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    env = {name: value for name, value in os.environ.items() if name != "STATE_SERVICE_URL"}
+    env.update({name: os.path.join(STATE_DIR, filename) for name, filename in DATA_PATHS.items()})
+    env.update({
+        "EMAIL_USERNAME": "alerts@tropometrics.local",
+        "EMAIL_PASSWORD": "unused",
+        # Nothing listens on these - deliveries and forecasts fail fast, requests still answer
+        "EMAIL_SERVER": f"127.0.0.1:{free_port()}",
+        "OPEN_METEO_BASE_URL": f"http://127.0.0.1:{free_port()}",
+        "RATE_LIMIT_ENABLED": "false",
+        "WEBHOOK_ALLOW_LOCAL": "true",
+        "API_KEY_USAGE_FLUSH_SECONDS": "0.2",
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(STATE_PORT), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_until_up(url: str, timeout: float = 30) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url + "/").status_code == 200:
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def manage_keys(*args: str) -> str:
+    """Run api_keys.py against the state service's database, as kubectl exec would"""
+    return subprocess.run(
+        [sys.executable, "api_keys.py", "--db", os.path.join(STATE_DIR, DATA_PATHS["API_KEYS_PATH"]), *args],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+    ).stdout
+
+
+def usage_on_state_service() -> dict:
+    """Requests per endpoint in the state service's usage export"""
+    usage = {}
+    for row in manage_keys("export", "--since", "2000-01-01").splitlines()[1:]:
+        endpoint, requests = row.split(",")[-2:]
+        usage[endpoint] = usage.get(endpoint, 0) + int(requests)
+    return usage
+
+
+ENGLISH = ("Give water", "Watering not needed now")
+DUTCH = ("Geef water", "Water geven is nu niet nodig")
+
+
+async def profiles(replica: httpx.AsyncClient):
+    """Profiles written on the state service personalize /api on the replica"""
+    profile = {"email": "farmer@example.com", "language": "en"}
+    check((await replica.put("/api/me?api_key=test", json=profile)).status_code == 404,
+          "The API replica does not accept profile writes")
+    async with httpx.AsyncClient(base_url=STATE_URL, timeout=10) as state:
+        check((await state.put("/api/me?api_key=test", json=profile)).status_code == 200,
+              "The state service saves profiles")
+        farm = (await state.post("/api/me/farms?api_key=test", json={"name": "North"})).json()
+        field = (await state.post(f"/api/me/farms/{farm['id']}/fields?api_key=test",
+                                  json={"name": "Field A", "latitude": 52.01, "longitude": 4.36})).json()
+        await asyncio.sleep(0.5)
+        report = (await replica.get(f"/api?api_key=test&location={field['id']}")).json()
+        check(report["irrigation"]["advice"] in ENGLISH and report["metadata"]["location"]["latitude"] == 52.01,
+              "The API replica uses the language and fields saved on the state service")
+        await state.put("/api/me?api_key=test", json={**profile, "language": "nl"})
+        await asyncio.sleep(0.5)
+        report = (await replica.get("/api?api_key=test")).json()
+        check(report["irrigation"]["advice"] in DUTCH, "The API replica picks up profile changes")
+
+
+async def run():
+    created = manage_keys("create", "--name", "Farm on the state service")
+    api_key = created.split("key: ")[1].split()[0]
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as replica:
+            check((await replica.get("/api?api_key=demo")).status_code == 200, "The API replica serves /api")
+            check((await replica.get(f"/api?api_key={api_key}")).status_code == 200,
+                  "A key created on the state service works on the API replica")
+            check((await replica.get("/api?api_key=tm_unknown")).status_code == 401,
+                  "The API replica rejects keys the state service doesn't know")
+            check((await replica.get("/health")).status_code == 200,
+                  "The API replica is healthy without email credentials")
+            email = {"to": "farmer@example.com", "subject": "Test", "body": "Hello"}
+            check((await replica.post("/api/send-email", json=email)).status_code == 404,
+                  "The API replica does not accept email")
+            subscription = {"email": "farmer@example.com", "threshold": 0.14}
+            check((await replica.post("/api/subscriptions?api_key=demo", json=subscription)).status_code == 404,
+                  "The API replica does not accept subscriptions")
+            webhook = {"url": f"http://127.0.0.1:{free_port()}/hook"}
+            check((await replica.post("/api/webhooks?api_key=demo", json=webhook)).status_code == 404,
+                  "The API replica does not accept webhooks")
+            check(await main.api_key_store.flush() > 0, "The API replica flushes usage to the state service")
+            await profiles(replica)
+
+        async with httpx.AsyncClient(base_url=STATE_URL, timeout=10) as state:
+            queued = await state.post("/api/send-email", json=email)
+            check(queued.status_code == 202, "The state service queues email")
+            created = await state.post("/api/subscriptions?api_key=demo", json=subscription)
+            check(created.status_code == 201, "The state service takes subscriptions")
+            registered = await state.post("/api/webhooks?api_key=demo", json=webhook)
+            check(registered.status_code == 201, "The state service registers webhooks")
+            digest = hash_key(api_key)
+            check((await state.get(f"/internal/api-keys/{digest}")).status_code == 403,
+                  "Internal endpoints need the state service token")
+            wrong = {STATE_TOKEN_HEADER: "wrong"}
+            check((await state.get(f"/internal/api-keys/{digest}", headers=wrong)).status_code == 403,
+                  "Internal endpoints refuse a wrong token")
+
+    await asyncio.sleep(0.5)
+    check(usage_on_state_service().get("/api", 0) >= 2, "Usage on the API replica is counted by the state service")
+
+    for name in ("EMAIL_OUTBOX_PATH", "SUBSCRIPTIONS_PATH", "WEBHOOKS_PATH", "API_KEYS_PATH", "USERS_PATH"):
+        check(not os.path.exists(os.path.join(DATA_DIR, DATA_PATHS[name])), f"No {name} file on the API replica")
+        check(os.path.exists(os.path.join(STATE_DIR, DATA_PATHS[name])), f"{name} lives with the state service")
+
+
+state_service = start_state_service()
+try:
+    check(wait_until_up(STATE_URL), "State service started")
+    asyncio.run(run())
+finally:
+    state_service.terminate()
+    state_service.wait(timeout=30)
+
+finish("State service test")
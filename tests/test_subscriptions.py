@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Subscription Test
+Drives the backend in-process with temporary databases (no cluster needed):
+- a new subscription gets a confirmation email and no alerts until the
+  link in it is opened (double opt-in)
+- a wrong token does not confirm; confirmed subscriptions get alerts
+- the forecast is only kept refreshed once confirmed; unconfirmed
+  subscriptions expire
+- every alert links to an unsubscribe endpoint that needs no API key
+- confirmations count against the per-recipient email limit of /api/send-email
+- the fields of the key's user resolve as location ids, as on /api
+- subscriptions are only visible to the API key that created them
+- databases from before owners and opt-in get the new columns on open
+Emails are recorded instead of sent, forecasts are synthetic.
+
+Usage:
+    python test_subscriptions.py
+"""
+
+import asyncio
+import re
+import sqlite3
+import time
+import uuid
+
+from helpers import DATA_DIR, check, configure_backend, fake_open_meteo, finish, weer
+
+configure_backend(ALERT_MIN_INTERVAL="0", PUBLIC_BASE_URL="https://tropometrics.example",
+                  EMAIL_RECIPIENT_RATE_LIMIT="2/hour")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from subscriptions import SubscriptionRegistry  # noqa: E402
+
+main.limiter.enabled = False
+main.fetch_open_meteo = fake_open_meteo
+main.EMAIL_USERNAME = main.EMAIL_PASSWORD = "configured"
+emails = []
+
+
+async def record_email(to, subject, body, html=False, idempotency_key=None, scope=None):
+    emails.append({"to": to, "subject": subject, "body": body, "key": idempotency_key})
+    return uuid.uuid4().hex, False
+
+
+main.email_queue.submit = record_email
+
+
+async def flip_advice():
+    """Soil dries out or gets wet again - every subscription's advice changes"""
+    weer["soil_moisture"] = 0.12 if weer["soil_moisture"] > 0.14 else 0.16
+    main.forecast_cache.clear()
+    await main.forecast_refresher.run_once()
+    await main.alert_engine.flush()
+
+
+def alerts():
+    return [email for email in emails if email["key"].startswith("alert:")]
+
+
+async def test_migration():
+    path = f"{DATA_DIR}/old_subscriptions.db"
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE subscriptions (id TEXT PRIMARY KEY, recipient TEXT NOT NULL, latitude REAL NOT NULL, "
+                   "longitude REAL NOT NULL, location_id TEXT, threshold REAL NOT NULL, created_at REAL NOT NULL)")
+        db.execute("INSERT INTO subscriptions VALUES ('old', 'a@example.com', 52.0, 4.3, NULL, 0.14, 0)")
+    registry = SubscriptionRegistry(path, key_for=lambda s: (s.latitude, s.longitude))
+    await registry.open()
+    old = registry.get("old")
+    check(old is not None and old.owner is None and not old.confirmed,
+          "Older database migrated, its subscriptions stay unconfirmed and ownerless")
+    check(old is not None and old.unsubscribe_token, "Older subscriptions get an unsubscribe token")
+    await registry.close()
+
+
+async def test_expiry(client):
+    entries, links = [], []
+    for recipient in ("late@example.com", "kept@example.com"):
+        created = await client.post("/api/subscriptions?api_key=demo", json={
+            "email": recipient, "latitude": 51.2, "longitude": 5.9, "threshold": 0.14
+        })
+        entries.append(main.subscription_registry.get(created.json()["id"]))
+        links.append(re.search(r"(/api/subscriptions/\S+/confirm\?token=\S+)", emails[-1]["body"]).group(1))
+    late, kept = entries
+    await client.get(links[1])
+    for entry in entries:
+        entry.created_at -= main.SUBSCRIPTION_CONFIRM_HOURS * 3600
+    expired = await client.get(links[0])
+    check(expired.status_code == 404 and not late.confirmed, "Confirmation link void after SUBSCRIPTION_CONFIRM_HOURS")
+    await main.subscription_registry.sweep(time.time())
+    check(main.subscription_registry.get(late.id) is None, "Sweep deletes the expired unconfirmed subscription")
+    check(main.subscription_registry.get(kept.id) is kept, "Sweep keeps confirmed subscriptions")
+
+
+async def test_recipient_limit(client):
+    main.limiter.enabled = True
+    try:
+        statuses = [(await client.post("/api/subscriptions?api_key=demo", json={
+            "email": "Limited@example.com", "latitude": 52.1, "longitude": 4.4, "threshold": 0.14
+        })).status_code for _ in range(3)]
+        check(statuses == [201, 201, 429], f"Confirmations limited per recipient ({statuses})")
+        email = await client.post("/api/send-email", json={
+            "to": "limited@example.com", "subject": "Hello", "body": "Hello"
+        })
+        check(email.status_code == 429 and "recipient" in email.json()["detail"],
+              "/api/send-email shares the recipient's budget")
+        other = await client.post("/api/send-email", json={
+            "to": "someone@example.com", "subject": "Hello", "body": "Hello"
+        })
+        check(other.status_code == 202, "Other recipients are not affected")
+    finally:
+        main.limiter.enabled = False
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            created = await client.post("/api/subscriptions?api_key=demo", json={
+                "email": "farmer@example.com", "latitude": 52.01, "longitude": 4.36, "threshold": 0.14
+            })
+            check(created.status_code == 201 and created.json()["confirmed"] is False,
+                  "Subscription created unconfirmed")
+            body = created.json()
+            check("owner" not in body and "confirm_token" not in body, "Owner and token hash are not shown")
+            subscription_id = body["id"]
+            key = main.subscription_registry.key_for(main.subscription_registry.get(subscription_id))
+            check(key not in main.forecast_cache._pinned, "Forecast not kept refreshed before confirmation")
+            link = re.search(r"https://tropometrics\.example(/api/subscriptions/\S+/confirm\?token=\S+)",
+                             emails[0]["body"]) if emails else None
+            check(len(emails) == 1 and emails[0]["to"] == "farmer@example.com" and link,
+                  "Confirmation email with the link sent")
+
+            await flip_advice()
+            check(not alerts(), "No alert before the link is opened")
+
+            other = await client.get(f"/api/subscriptions/{subscription_id}?api_key=test")
+            check(other.status_code == 404, "Other API keys can't see the subscription")
+            check((await client.delete(f"/api/subscriptions/{subscription_id}?api_key=test")).status_code == 404,
+                  "Other API keys can't delete the subscription")
+
+            wrong = await client.get(f"/api/subscriptions/{subscription_id}/confirm?token=guess")
+            check(wrong.status_code == 404, "Wrong token does not confirm")
+            if link:
+                confirmed = await client.get(link.group(1))
+                check(confirmed.status_code == 200 and confirmed.json()["confirmed"] is True, "Link confirms")
+                again = await client.get(link.group(1))
+                check(again.status_code == 200, "Opening the link twice is harmless")
+                check(key in main.forecast_cache._pinned, "Forecast kept refreshed once confirmed")
+            own = (await client.get(f"/api/subscriptions/{subscription_id}?api_key=demo")).json()
+            check(own["confirmed"] is True and own["confirmed_at"], "Owner sees the confirmed subscription")
+
+            await flip_advice()
+            check(len(alerts()) == 1 and alerts()[0]["to"] == "farmer@example.com",
+                  "Confirmed subscription gets the alert")
+            unsubscribe = re.search(r"https://tropometrics\.example(/api/subscriptions/\S+/unsubscribe\?token=\S+)",
+                                    alerts()[0]["body"]) if alerts() else None
+            check(unsubscribe, "Alert carries the unsubscribe link")
+
+            second = await client.post("/api/subscriptions?api_key=demo", json={
+                "email": "neighbour@example.com", "latitude": 52.01, "longitude": 4.36, "threshold": 0.2
+            })
+            deleted = await client.delete(f"/api/subscriptions/{second.json()['id']}?api_key=demo")
+            check(deleted.status_code == 204, "Owner deletes the subscription")
+
+            wrong = await client.get(f"/api/subscriptions/{subscription_id}/unsubscribe?token=guess")
+            check(wrong.status_code == 404, "Wrong token does not unsubscribe")
+            if unsubscribe:
+                gone = await client.get(unsubscribe.group(1))
+                check(gone.status_code == 200 and gone.json()["unsubscribed"] is True, "Unsubscribe link works")
+                after = await client.get(f"/api/subscriptions/{subscription_id}?api_key=demo")
+                check(after.status_code == 404 and key not in main.forecast_cache._pinned,
+                      "Unsubscribed: subscription gone, forecast no longer kept refreshed")
+
+            # The key's user owns a field, its id works as a location
+            await client.put("/api/me?api_key=demo", json={"email": "farmer@example.com", "name": "Farm 1"})
+            farm = await client.post("/api/me/farms?api_key=demo", json={"name": "North"})
+            field = await client.post(f"/api/me/farms/{farm.json()['id']}/fields?api_key=demo",
+                                      json={"name": "Field A", "latitude": 51.5, "longitude": 5.1})
+            personal = await client.post("/api/subscriptions?api_key=demo", json={
+                "email": "farmer@example.com", "location": field.json()["id"], "threshold": 0.14
+            })
+            check(personal.status_code == 201 and personal.json()["location_id"] == field.json()["id"]
+                  and personal.json()["latitude"] == 51.5, "A field of the key's user resolves by its id")
+
+            await test_expiry(client)
+            await test_recipient_limit(client)
+
+    await test_migration()
+
+
+asyncio.run(run())
+
+finish("Subscription test")
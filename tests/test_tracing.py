@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Tracing Test
+Drives the backend in-process with temporary databases (no cluster needed):
+- every response carries a Server-Timing header with the /api stages
+- /api/send-email times the outbox write
+- spans are exported as OTLP JSON (file target), children under the request span
+- a W3C traceparent header continues the caller's trace
+Open-Meteo is replaced by a local mock transport, SMTP is unreachable on purpose.
+
+Usage:
+    python test_tracing.py
+"""
+
+import asyncio
+import json
+import os
+import re
+
+from helpers import DATA_DIR, check, configure_backend, finish, mock_upstream
+
+SPANS_FILE = os.path.join(DATA_DIR, "spans.jsonl")
+configure_backend(
+    EMAIL_USERNAME="tester@tropometrics.local",
+    EMAIL_PASSWORD="test-password",
+    EMAIL_SERVER="127.0.0.1:1",
+    EMAIL_STARTTLS="false",
+    TRACE_EXPORT=SPANS_FILE,
+)
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+main.limiter.enabled = False
+
+PARENT_TRACE = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_SPAN = "00f067aa0ba902b7"
+
+
+def server_timing(response):
+    """Server-Timing header as {name: milliseconds}"""
+    return {
+        name: float(duration)
+        for name, duration in re.findall(r"([\w.]+);dur=([\d.]+)", response.headers.get("server-timing", ""))
+    }
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        await mock_upstream(main.app)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            timings = server_timing(await client.get("/api?api_key=demo"))
+            check(all(stage in timings for stage in ("auth", "upstream", "derivation", "serialization", "total")),
+                  f"/api has Server-Timing per stage ({timings})")
+            check(sum(v for k, v in timings.items() if k != "total") <= timings["total"],
+                  "Stages add up to at most the total")
+            check("html" in server_timing(await client.get("/api?api_key=demo&format=html")),
+                  "HTML rendering is its own stage")
+            check("total" in server_timing(await client.get("/api?api_key=nope")),
+                  "Error responses are timed as well")
+
+            email = await client.post("/api/send-email", json={
+                "to": "farmer@example.com", "subject": "Rain", "body": "Heavy rain expected."
+            })
+            check(email.status_code == 202 and "outbox" in server_timing(email),
+                  "/api/send-email times the outbox write")
+
+            await client.get("/api?api_key=demo", headers={
+                "traceparent": f"00-{PARENT_TRACE}-{PARENT_SPAN}-01"
+            })
+            # Give the worker time for its (failing) SMTP attempt
+            await asyncio.sleep(0.5)
+            print(f"  Exporter: {main.tracer.exporter.stats()}")
+
+    with open(SPANS_FILE) as f:
+        spans = [span for line in f for resource in json.loads(line)["resourceSpans"]
+                 for scope in resource["scopeSpans"] for span in scope["spans"]]
+    roots = {span["spanId"]: span for span in spans if span["kind"] == 2}
+    check(any(span["name"] == "GET /api" for span in roots.values()), "Request spans named by route")
+    children = [span for span in spans if span["kind"] == 1]
+    check(children and all(span["parentSpanId"] in roots for span in children),
+          "Stage spans are children of their request span")
+    check(all(int(span["endTimeUnixNano"]) >= int(span["startTimeUnixNano"]) for span in spans),
+          "Span timestamps are ordered")
+    continued = [span for span in roots.values() if span["traceId"] == PARENT_TRACE]
+    check(len(continued) == 1 and continued[0].get("parentSpanId") == PARENT_SPAN,
+          "traceparent continues the caller's trace")
+    check(any(span["name"] == "smtp.send" for span in roots.values()), "Background SMTP sends exported")
+
+
+asyncio.run(run())
+
+finish("Tracing test")
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+User Store Test
+Drives the backend in-process with temporary databases (no cluster needed):
+- /api/me creates and updates the user of an API key, with farms and fields
+- /api follows the user's advice language, units, fields and default location
+- repeated requests are served from the profile cache, writes invalidate it
+- writes by another process (another connection) are picked up
+Uses the test key (random data), Open-Meteo is not called.
+
+Usage:
+    python test_users.py
+"""
+
+import asyncio
+import sqlite3
+
+from helpers import check, configure_backend, data_path, finish
+
+configure_backend(USER_CACHE_CHECK_SECONDS="0.2")
+USERS_DB = data_path("USERS_PATH")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+main.limiter.enabled = False
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            async def report(query=""):
+                return (await client.get(f"/api?api_key=test&{query}")).json()
+
+            check((await client.get("/api/me?api_key=test")).status_code == 404, "No user before PUT /api/me")
+            dutch = await report()
+            check(dutch["irrigation"]["advice"] in ("Geef water", "Water geven is nu niet nodig"),
+                  "Default advice is Dutch")
+
+            saved = await client.put("/api/me?api_key=test", json={
+                "email": "farmer@example.com", "name": "Farm 1", "units": "imperial", "language": "en"
+            })
+            check(saved.status_code == 200 and saved.json()["preferences"]["language"] == "en", "User created")
+            personal = await report()
+            check(personal["irrigation"]["advice"] in ("Give water", "Watering not needed now"),
+                  "Advice follows the language preference")
+            check("temperature_max_fahrenheit" in personal["daily"], "Imperial units added")
+
+            farm = await client.post("/api/me/farms?api_key=test", json={"name": "North"})
+            check(farm.status_code == 201, "Farm created")
+            field = await client.post(f"/api/me/farms/{farm.json()['id']}/fields?api_key=test",
+                                      json={"name": "Field A", "latitude": 52.01, "longitude": 4.36})
+            check(field.status_code == 201, "Field created")
+            field_id = field.json()["id"]
+            check((await client.post("/api/me/farms/nope/fields?api_key=test",
+                                     json={"name": "X", "latitude": 1, "longitude": 1})).status_code == 404,
+                  "Fields need one of the user's farms")
+
+            by_id = await report(f"location={field_id}")
+            check(by_id["metadata"]["location"]["latitude"] == 52.01, "Field id usable as ?location=")
+            bad = await client.put("/api/me?api_key=test", json={"email": "farmer@example.com",
+                                                                  "default_location": "nowhere"})
+            check(bad.status_code == 400, "Unknown default location is rejected")
+            await client.put("/api/me?api_key=test", json={
+                "email": "farmer@example.com", "units": "imperial", "language": "en", "default_location": field_id
+            })
+            check((await report())["metadata"]["location"]["latitude"] == 52.01, "Default location from the profile")
+
+            misses = main.user_store.stats()["cache_misses"]
+            for _ in range(20):
+                await report()
+            check(main.user_store.stats()["cache_misses"] == misses, "Repeated requests hit the profile cache")
+
+            # Another process changes the language
+            with sqlite3.connect(USERS_DB) as db:
+                db.execute("UPDATE users SET language = 'nl'")
+            await asyncio.sleep(0.5)
+            check((await report())["irrigation"]["advice"] in ("Geef water", "Water geven is nu niet nodig"),
+                  "Write by another process is picked up")
+
+            check((await client.delete(f"/api/me/fields/{field_id}?api_key=test")).status_code == 204, "Field deleted")
+            check((await report())["metadata"]["location"]["latitude"] == main.WEATHER_LOCATION["latitude"],
+                  "Default falls back when the field is gone")
+            check((await client.delete("/api/me?api_key=test")).status_code == 204, "User deleted")
+            check((await client.get("/api/me?api_key=test")).status_code == 404, "Deleted user is gone")
+            print(f"  User store: {main.user_store.stats()}")
+
+
+asyncio.run(run())
+
+finish("User store test")
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Webhook Delivery Test
+Drives the backend in-process against a local HTTP stand-in receiver:
+- advice and forecast changes are delivered as signed JSON batches
+- endpoints only get the event types they registered for
+- failing endpoints (503) are retried until delivery succeeds
+- an endpoint (origin) never sees more than WEBHOOK_CONCURRENCY requests at
+  once, however many webhooks point at it
+- one upstream forecast lookup serves every webhook of a location
+- http, loopback, private and link-local URLs are refused at registration and
+  at delivery; the status shows a reason, not the raw error
+- webhooks are only visible to the API key that registered them
+- the fields of the key's user resolve as location ids, as on /api
+The receiver is local, so WEBHOOK_ALLOW_LOCAL is on except where the URL checks
+are tested. Forecasts are synthetic (Open-Meteo is not called), no cluster needed.
+
+Usage:
+    python test_webhooks.py
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from helpers import check, configure_backend, fake_open_meteo, finish, upstream_calls, weer
+
+CONCURRENCY = 2
+
+
+class Receiver(BaseHTTPRequestHandler):
+    """Records every delivery; /flaky fails twice, /slow takes its time"""
+    deliveries = []
+    flaky_failures = 2
+    active = {}
+    max_active = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with Receiver.lock:
+            # Per path and for the whole origin ("*")
+            for name in (self.path, "*"):
+                Receiver.active[name] = Receiver.active.get(name, 0) + 1
+                Receiver.max_active[name] = max(Receiver.max_active.get(name, 0), Receiver.active[name])
+            fail = self.path == "/flaky" and Receiver.flaky_failures > 0
+            if fail:
+                Receiver.flaky_failures -= 1
+        if self.path == "/slow":
+            time.sleep(0.3)
+        with Receiver.lock:
+            Receiver.active[self.path] -= 1
+            Receiver.active["*"] -= 1
+            if not fail:
+                Receiver.deliveries.append((self.path, dict(self.headers), body))
+        self.send_response(503 if fail else 204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+RECEIVER = f"http://127.0.0.1:{server.server_address[1]}"
+
+configure_backend(
+    WEBHOOK_CONCURRENCY=CONCURRENCY,
+    WEBHOOK_BATCH_SIZE="5",
+    WEBHOOK_BATCH_WINDOW_MS="100",
+    WEBHOOK_RETRY_BASE="0.05",
+    WEBHOOK_ALLOW_LOCAL="true",
+)
+
+import httpx  # noqa: E402
+import main  # noqa: E402
+import webhooks  # noqa: E402
+
+main.limiter.enabled = False
+main.fetch_open_meteo = fake_open_meteo
+
+
+def verify(secret, headers, body):
+    expected = hmac.new(secret.encode(), headers["X-TropoMetrics-Timestamp"].encode() + b"." + body,
+                        hashlib.sha256).hexdigest()
+    return hmac.compare_digest(headers["X-TropoMetrics-Signature"], "sha256=" + expected)
+
+
+def events_for(path):
+    return [event for p, _, body in Receiver.deliveries if p == path for event in json.loads(body)["events"]]
+
+
+async def refresh():
+    main.forecast_cache.clear()
+    await main.forecast_refresher.run_once()
+
+
+async def wait_until(condition, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline and not condition():
+        await asyncio.sleep(0.05)
+
+
+async def test_url_checks(client, location):
+    rebind = await client.post("/api/webhooks?api_key=demo",
+                               json={"url": RECEIVER + "/rebind", "events": ["forecast"], **location})
+    main.webhook_dispatcher.allow_local = False
+    for url in (RECEIVER + "/x", "https://127.0.0.1/x", "https://localhost/x", "https://10.1.2.3/x",
+                "https://169.254.169.254/latest/meta-data", "https://[::1]/x", "https://[::ffff:192.168.0.1]/x"):
+        response = await client.post("/api/webhooks?api_key=demo", json={"url": url, **location})
+        check(response.status_code == 400, f"Refused at registration: {url}")
+
+    target = await webhooks.resolve_target("https://93.184.215.14:8443/hook?x=1")
+    check(target == ("https://93.184.215.14:8443/hook?x=1", "93.184.215.14:8443",
+                     {"sni_hostname": "93.184.215.14"}), "Public https URL accepted")
+
+    # Registered while allowed - checked again at delivery (a host resolving elsewhere later)
+    weer["precipitation"] += 1
+    await refresh()
+    hook_id = rebind.json()["id"]
+    await wait_until(lambda: main.webhook_dispatcher.status(main.webhook_registry.get(hook_id))["last_result"])
+    delivery = (await client.get(f"/api/webhooks/{hook_id}?api_key=demo")).json()["delivery"]
+    check(delivery["last_result"] == "failed" and delivery["last_error"] == "blocked_address"
+          and not events_for("/rebind"), f"Refused at delivery, reason only ({delivery})")
+    main.webhook_dispatcher.allow_local = True
+
+
+async def run():
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://backend") as client:
+            location = {"latitude": 52.01, "longitude": 4.36}
+            secrets = {}
+            for path, events in [("/all", ["advice", "forecast"]), ("/advice", ["advice"]),
+                                 ("/flaky", ["advice", "forecast"]), ("/slow", ["forecast"])]:
+                response = await client.post("/api/webhooks?api_key=demo",
+                                             json={"url": RECEIVER + path, "events": events, **location})
+                check(response.status_code == 201, f"Webhook {path} registered")
+                secrets[path] = response.json()["secret"]
+            hook_id = response.json()["id"]
+
+            invalid = await client.post("/api/webhooks?api_key=demo",
+                                        json={"url": RECEIVER + "/x", "events": ["rain"], **location})
+            check(invalid.status_code == 400, "Unknown event type is rejected")
+
+            # Drier soil (advice flips) and more rain (forecast total changes)
+            upstream_calls.clear()
+            weer.update(soil_moisture=0.12, precipitation=0.5)
+            await refresh()
+            cell = main.snap_location(location, main.WEATHER_GRID_RESOLUTION)
+            check(upstream_calls.count((cell["latitude"], cell["longitude"])) == 1,
+                  "One upstream lookup for all webhooks of the location")
+
+            await wait_until(lambda: len(events_for("/flaky")) >= 2 and len(events_for("/all")) >= 2)
+            all_types = sorted(event["type"] for event in events_for("/all"))
+            check(all_types == ["advice.changed", "forecast.changed"], f"/all received both events {all_types}")
+            check([e["type"] for e in events_for("/advice")] == ["advice.changed"], "/advice only gets advice events")
+            advice = next(e for e in events_for("/all") if e["type"] == "advice.changed")
+            check(advice["previous"]["needs_water"] is False and advice["current"]["needs_water"] is True,
+                  "Advice event carries previous and current advice")
+            check(len(events_for("/flaky")) == 2, "Failing endpoint is retried until delivered")
+            check(all(verify(secrets[path], headers, body) for path, headers, body in Receiver.deliveries),
+                  "Every delivery has a valid signature")
+            check(len([d for d in Receiver.deliveries if d[0] == "/all"]) == 1,
+                  "Events of one refresh are batched into one delivery")
+
+            # Many forecast changes for the slow endpoint - concurrency limit and batching
+            for i in range(12):
+                weer["precipitation"] = 0.6 + i * 0.1
+                await refresh()
+            await wait_until(lambda: len(events_for("/slow")) >= 13)
+            slow_deliveries = len([d for d in Receiver.deliveries if d[0] == "/slow"])
+            check(len(events_for("/slow")) == 13, f"Slow endpoint received all 13 events in {slow_deliveries} deliveries")
+            check(Receiver.max_active.get("*", 0) <= CONCURRENCY,
+                  f"At most {CONCURRENCY} concurrent requests per endpoint ({Receiver.max_active.get('*')})")
+
+            status = (await client.get(f"/api/webhooks/{hook_id}?api_key=demo")).json()
+            check("secret" not in status and status["delivery"]["last_result"] == "delivered",
+                  "Status shows the last delivery without the secret")
+            check((await client.get(f"/api/webhooks/{hook_id}?api_key=test")).status_code == 404
+                  and (await client.delete(f"/api/webhooks/{hook_id}?api_key=test")).status_code == 404,
+                  "Other API keys can't see or delete the webhook")
+
+            # The key's user owns a field, its id works as a location
+            await client.put("/api/me?api_key=demo", json={"email": "farmer@example.com", "name": "Farm 1"})
+            farm = await client.post("/api/me/farms?api_key=demo", json={"name": "North"})
+            field = await client.post(f"/api/me/farms/{farm.json()['id']}/fields?api_key=demo",
+                                      json={"name": "Field A", "latitude": 51.5, "longitude": 5.1})
+            personal = await client.post("/api/webhooks?api_key=demo", json={
+                "url": RECEIVER + "/field", "events": ["advice"], "location": field.json()["id"]
+            })
+            check(personal.status_code == 201 and personal.json()["location"]["id"] == field.json()["id"]
+                  and personal.json()["location"]["latitude"] == 51.5, "A field of the key's user resolves by its id")
+            if personal.status_code == 201:
+                await client.delete(f"/api/webhooks/{personal.json()['id']}?api_key=demo")
+
+            await test_url_checks(client, location)
+            deleted = await client.delete(f"/api/webhooks/{hook_id}?api_key=demo")
+            check(deleted.status_code == 204, "Webhook deleted")
+            missing = await client.get(f"/api/webhooks/{hook_id}?api_key=demo")
+            check(missing.status_code == 404, "Deleted webhook returns 404")
+            print(f"  Dispatcher: {main.webhook_dispatcher.stats()}")
+
+
+try:
+    asyncio.run(run())
+finally:
+    server.shutdown()
+
+finish("Webhook test")